@@ -1,11 +1,21 @@
 """Ming Base module.  Good stuff here.
 """
+from __future__ import with_statement
+import re
 import decimal
+import random
 import hashlib
+import weakref
+import threading
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, MutableMapping
 
 import pymongo
+from pymongo.bson import BSON
+
+from . import schema
+from . import exc
+from .migration import MigrationRunner
 
 def build_mongometa(bases, dct):
     mm_bases = []
@@ -48,6 +58,319 @@ class Object(dict):
         safe_self = _safe_bson(self)
         self.update(safe_self)
 
+class ObjectView(MutableMapping):
+    '''Object-like attr access to a dict (e.g. a document as returned by the
+    driver) without converting it.  Nested dicts are wrapped in views only
+    when they are accessed, and lists are copied (with their dicts wrapped in
+    views) the first time they are accessed, as they may then be modified in
+    place.
+
+    The wrapped dict is never modified: the first write to a view replaces
+    the dict it wraps with a shallow copy (a view nested in it keeps its own
+    changes).  A view is not a dict, so schemas do not validate it: convert
+    it with to_object() before validating or saving it.'''
+    __slots__ = ('_data', '_owned', '_views')
+
+    def __init__(self, data):
+        set = object.__setattr__
+        set(self, '_data', data)
+        set(self, '_owned', False)
+        # name => the view or list returned for the field
+        set(self, '_views', {})
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError, name
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError, name
+
+    def __getitem__(self, name):
+        value = self._views.get(name, schema.Missing)
+        if value is not schema.Missing:
+            return value
+        value = self._data[name]
+        if isinstance(value, (dict, list)):
+            value = self._views[name] = _view(value)
+        return value
+
+    def __setitem__(self, name, value):
+        self._views.pop(name, None)
+        self._own()[name] = value
+
+    def __delitem__(self, name):
+        self._views.pop(name, None)
+        del self._own()[name]
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'ObjectView(%r)' % (self.to_object(),)
+
+    def to_object(self):
+        '''Convert to a (deep) Object, with the changes made through the view
+        and the views nested in it'''
+        views = self._views
+        return Object((k, _unview(views.get(k, v)))
+                      for k, v in self._data.iteritems())
+
+    def _own(self):
+        if not self._owned:
+            object.__setattr__(self, '_data', dict(self._data))
+            object.__setattr__(self, '_owned', True)
+        return self._data
+
+def _view(value):
+    if isinstance(value, dict):
+        return ObjectView(value)
+    elif isinstance(value, list):
+        return [ _view(v) for v in value ]
+    return value
+
+def _unview(value):
+    if isinstance(value, ObjectView):
+        return value.to_object()
+    elif isinstance(value, list):
+        return [ _unview(v) for v in value ]
+    return Object.from_bson(value)
+
+class Record(object):
+    '''Base of the compact classes that DocumentMeta generates for Documents
+    whose __mongometa__ sets slots=True.  A Record stores the fields of the
+    schema in __slots__ rather than in a dict, but provides the same mapping
+    and attribute API as Object (and the .m manager of its Document class).
+    It is converted to a dict (to_dict) only to be validated or saved, and
+    cannot hold keys that are not fields of the schema.
+
+    A Record is an instance of its Document class (as far as isinstance() is
+    concerned), and the sessions, make() and make_many() accept it; code
+    which needs a real dict (schema validate(), BSON.from_dict, ...) must
+    convert it with to_dict() first.'''
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    _document_class = None
+
+    @classmethod
+    def from_dict(cls, d):
+        self = cls.__new__(cls)
+        self.update(d)
+        return self
+
+    def to_dict(self):
+        return Object(self.iteritems())
+
+    def make_safe(self):
+        self.update(_safe_bson(self.to_dict()))
+
+    def __getstate__(self):
+        return dict(self.iteritems())
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def __reduce__(self):
+        # The record class is generated, so rebuild it through its Document
+        return (_unpickle_record, (self._document_class,), self.__getstate__())
+
+    def __getitem__(self, name):
+        if name not in self._field_set:
+            raise KeyError, name
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError, name
+
+    def __setitem__(self, name, value):
+        if name not in self._field_set:
+            raise KeyError, '%r is not a field of %s' % (
+                name, self.__class__.__name__)
+        object.__setattr__(self, name, value)
+
+    def __delitem__(self, name):
+        if name not in self._field_set:
+            raise KeyError, name
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            raise KeyError, name
+
+    def __contains__(self, name):
+        return name in self._field_set and hasattr(self, name)
+    has_key = __contains__
+
+    def iteritems(self):
+        for name in self._fields:
+            value = getattr(self, name, _unset)
+            if value is not _unset:
+                yield name, value
+
+    def iterkeys(self):
+        for name, value in self.iteritems():
+            yield name
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for name, value in self.iteritems():
+            yield value
+
+    def items(self): return list(self.iteritems())
+    def keys(self): return list(self.iterkeys())
+    def values(self): return list(self.itervalues())
+
+    def __len__(self):
+        return sum(1 for name in self.iterkeys())
+
+    def get(self, name, default=None):
+        if name not in self._field_set:
+            return default
+        return getattr(self, name, default)
+
+    def setdefault(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            self[name] = default
+            return default
+
+    def pop(self, name, *args):
+        try:
+            value = self[name]
+        except KeyError:
+            if args: return args[0]
+            raise
+        del self[name]
+        return value
+
+    def update(self, *args, **kwargs):
+        for d in args + (kwargs,):
+            if hasattr(d, 'iteritems'):
+                d = d.iteritems()
+            for name, value in d:
+                self[name] = value
+
+    def copy(self):
+        return self.from_dict(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented: return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+MutableMapping.register(Record)
+
+_unset = object()
+
+class LazyDocument(object):
+    '''Methods installed by DocumentMeta on Document classes whose
+    __mongometa__ is lazy.  The fields of documents loaded by make() are kept
+    unvalidated in the instance's _lazy dict and are validated the first time
+    they are accessed.  Operations on the whole document (iteration, copying,
+    comparison, make_safe, saving, ...) validate all remaining fields first.
+
+    The C fast paths which copy a dict without calling its methods
+    (dict(doc), other.update(doc), Object(doc), BSON.from_dict(doc), f(**doc))
+    do not see the fields not yet validated: call doc.resolve() first, as in
+    dict(doc.resolve()).'''
+
+    def __missing__(self, name):
+        pending = self.__dict__.get('_lazy')
+        if pending and name in pending:
+            value = self._resolve(name)
+            if value is not schema.Missing:
+                return value
+        return self._not_loaded(name)
+
+    def _resolve(self, name):
+        pending = self.__dict__['_lazy']
+        value = pending[name]
+        field = self.__mongometa__.schema.fields[name]
+        try:
+            value = field.validate(value)
+        except schema.Invalid, inv:
+            raise schema.Invalid(
+                '%s:%s' % (name, inv), value, None, error_dict={name:inv})
+        del pending[name]
+        if value is not schema.Missing:
+            dict.__setitem__(self, name, value)
+        return value
+
+    def _resolve_all(self):
+        pending = self.__dict__.get('_lazy')
+        if pending:
+            for name in sorted(pending):
+                self._resolve(name)
+
+    def resolve(self):
+        '''Validate all the fields not yet validated, returning self'''
+        self._resolve_all()
+        return self
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        pending = self.__dict__.get('_lazy')
+        return dict.__contains__(self, name) or bool(pending and name in pending)
+    has_key = __contains__
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.__dict__.get('_lazy', ()))
+
+    def __setitem__(self, name, value):
+        pending = self.__dict__.get('_lazy')
+        if pending: pending.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        pending = self.__dict__.get('_lazy')
+        if pending and name in pending:
+            del pending[name]
+        else:
+            dict.__delitem__(self, name)
+
+def _resolving(name):
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwargs):
+        self._resolve_all()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for name in ('keys', 'values', 'items', 'iterkeys', 'itervalues', 'iteritems',
+             '__iter__', 'copy', 'pop', 'popitem', 'setdefault', 'update',
+             '__eq__', '__ne__', '__repr__'):
+    setattr(LazyDocument, name, _resolving(name))
+del name
+
 class Field(object):
 
     def __init__(self, field_type, *args, **kwargs):
@@ -71,13 +394,29 @@ class Field(object):
 class ManagerDescriptor(object):
     '''Python descriptor to provide a way to add the .m. attribute to mapped
     classes (which is a Manager - see below) such that the object at the
-    attribute "knows" which instance it's attached to.'''
+    attribute "knows" which instance it's attached to.
+
+    Managers are cached, per class and (for instances with a __dict__) per
+    instance.'''
 
     def __init__(self, mgr_cls):
         self.mgr_cls = mgr_cls
+        self._class_managers = weakref.WeakKeyDictionary()
 
     def __get__(self, instance, cls):
-        return self.mgr_cls(instance, cls)
+        if instance is None:
+            result = self._class_managers.get(cls)
+            if result is None:
+                result = self._class_managers[cls] = self.mgr_cls(None, cls)
+            return result
+        d = getattr(instance, '__dict__', None)
+        if d is None:
+            return self.mgr_cls(instance, cls)
+        result = d.get('_manager')
+        if (result is None or result.instance is not instance
+            or result.cls is not cls):
+            result = d['_manager'] = self.mgr_cls(instance, cls)
+        return result
 
 
 class Manager(object):
@@ -85,11 +424,24 @@ class Manager(object):
     the managed class/instance.'''
 
     def __init__(self, instance, cls):
-        self.session = cls.__mongometa__.session
         self.instance = instance
         self.cls = cls
-        if self.session is not None:
-            self.ensure_indexes()
+        self._session = None
+        self.session
+
+    def _get_session(self):
+        '''The session given to __call__, or the class's session, whose
+        indexes are ensured (only the first time, see
+        Session.ensure_indexes)'''
+        session = self._session
+        if session is None:
+            session = self.cls.__mongometa__.session
+        if session is not None:
+            session.ensure_indexes(self.cls)
+        return session
+    def _set_session(self, session):
+        self._session = session
+    session = property(_get_session, _set_session)
 
     def __call__(self, session):
         '''In order to use an alternate session, just use Class.mgr(other_session)'''
@@ -106,7 +458,7 @@ class Manager(object):
                 raise TypeError("%s() may not be called on an instance's manager, only a class' manager"
                                 % method.__name__)
             else:
-                method(self, *args, **kw)
+                return method(self, *args, **kw)
         return ensure_not_instance
     
     def get(self, **kwargs):
@@ -134,6 +486,17 @@ class Manager(object):
         """
         return self.session.remove(self.cls, *args, **kwargs)
 
+    @class_only
+    def insert_many(self, docs, batch_size=1000, **kwargs):
+        """
+        Inserts many documents in batches, returning a list of (doc, error)
+        pairs for the documents that could not be inserted
+        e.g.
+            failures = model.CustomPage.m.insert_many(pages)
+        """
+        return self.session.insert_many(self.cls, docs, batch_size=batch_size,
+                                        **kwargs)
+
     def find_by(self, **kwargs):
         """
         same as find(spec=kwargs)
@@ -142,8 +505,9 @@ class Manager(object):
         """
         return self.session.find_by(self.cls, **kwargs)
 
-    def count(self):
-        return self.session.count(self.cls)
+    def count(self, *args, **kwargs):
+        '''count(spec=None, approximate=False), see Session.count'''
+        return self.session.count(self.cls, *args, **kwargs)
 
     def ensure_index(self, fields, **kwargs):
         return self.session.ensure_index(self.cls, fields, **kwargs)
@@ -151,13 +515,17 @@ class Manager(object):
     def ensure_indexes(self):
         return self.session.ensure_indexes(self.cls)
 
+    def sync_indexes(self):
+        return self.session.sync_indexes(self.cls)
+
     def group(self, *args, **kwargs):
         return self.session.group(self.cls, *args, **kwargs)
 
-    def update_partial(self, spec, fields, upsert=False):
-        return self.session.update_partial(self.cls, spec, fields, upsert)
+    def update_partial(self, spec, fields, upsert=False, **kwargs):
+        return self.session.update_partial(self.cls, spec, fields, upsert,
+                                           **kwargs)
 
-    def save(self, *args):
+    def save(self, *args, **kwargs):
         """
         Acts on object instance
         e.g.
@@ -166,18 +534,21 @@ class Manager(object):
             cp.m.save()
         with parameters, only sets specified fields
             cp.m.save('foo')
+        the write concern of any of these methods may be given as a
+        keyword argument (see Session._write_options)
+            cp.m.save(write_concern=dict(w=2))
         """
-        return self.session.save(self.instance, *args)
+        return self.session.save(self.instance, *args, **kwargs)
 
-    def insert(self):
+    def insert(self, **kwargs):
         """
         Acts on object instance
         e.g.
             model.CustomPage(...).m.insert()
         """
-        return self.session.insert(self.instance)
+        return self.session.insert(self.instance, **kwargs)
 
-    def upsert(self, spec_fields):
+    def upsert(self, spec_fields, **kwargs):
         """
         Acts on object instance.
         spec_fields is a field or list of fields used to see if the record already exists
@@ -185,23 +556,81 @@ class Manager(object):
             model.CustomPage(...).m.upsert('my_key_field')
             model.CustomPage(...).m.upsert(['field1','field2'])
         """
-        return self.session.upsert(self.instance, spec_fields)
+        return self.session.upsert(self.instance, spec_fields, **kwargs)
 
-    def delete(self):
+    def delete(self, **kwargs):
         """
         Acts on object instance
         e.g.
             model.CustomPage(...).m.delete()
         """
-        return self.session.delete(self.instance)
+        return self.session.delete(self.instance, **kwargs)
+
+    def atomic(self, operator, fields_values, **kwargs):
+        """
+        Acts on object instance; applies an update operator to it in the
+        database and locally (see Session.atomic)
+        e.g.
+            cp.m.atomic('$set', {'stats.last_view': datetime.utcnow()})
+        """
+        return self.session.atomic(
+            self.instance, operator, fields_values, **kwargs)
+
+    def inc(self, fields_values, **kwargs):
+        """
+        Acts on object instance
+        e.g.
+            cp.m.inc({'views': 1, 'stats.hits': 1})
+        """
+        return self.atomic('$inc', fields_values, **kwargs)
+
+    def max(self, fields_values, **kwargs):
+        """
+        Acts on object instance; sets a field if the value is greater
+        e.g.
+            cp.m.max({'last_seen': now})
+        """
+        return self.atomic('$max', fields_values, **kwargs)
+
+    def min(self, fields_values, **kwargs):
+        """
+        Acts on object instance; sets a field if the value is smaller
+        e.g.
+            cp.m.min({'first_seen': now})
+        """
+        return self.atomic('$min', fields_values, **kwargs)
 
-    def set(self, fields_values):
+    def push(self, fields_values, **kwargs):
+        """
+        Acts on object instance
+        e.g.
+            cp.m.push({'tags': 'new'})
+        """
+        return self.atomic('$push', fields_values, **kwargs)
+
+    def add_to_set(self, fields_values, **kwargs):
+        """
+        Acts on object instance
+        e.g.
+            cp.m.add_to_set({'tags': 'new'})
+        """
+        return self.atomic('$addToSet', fields_values, **kwargs)
+
+    def pull(self, fields_values, **kwargs):
+        """
+        Acts on object instance
+        e.g.
+            cp.m.pull({'tags': 'old'})
+        """
+        return self.atomic('$pull', fields_values, **kwargs)
+
+    def set(self, fields_values, **kwargs):
         """
         Acts on object instance
         e.g.
             model.CustomPage(...).m.set({'foo':'bar'})
         """
-        return self.session.set(self.instance, fields_values)
+        return self.session.set(self.instance, fields_values, **kwargs)
     
     def increase_field(self, **kwargs):
         """
@@ -213,11 +642,12 @@ class Manager(object):
         """
         return self.session.increase_field(self.instance, **kwargs)
 
-    def migrate(self):
-        '''Load each object in the collection and immediately save it.
+    def migrate(self, **kwargs):
+        '''Load each object in the collection and save the fields that changed
+        (see ming.migration.MigrationRunner for the keyword arguments).
+        Returns the migration stats.
         '''
-        for m in self.find({}):
-            m.m.save()
+        return MigrationRunner(self.cls, session=self.session, **kwargs).run()
     
     def index_information(self):
         return self.session.index_information(self.cls)
@@ -238,47 +668,131 @@ class DocumentMeta(type):
       discriminator ("polymorphic_on")
     '''
 
+    def __instancecheck__(cls, instance):
+        # A Record counts as an instance of its Document class
+        document_class = getattr(type(instance), '_document_class', None)
+        if document_class is not None and issubclass(document_class, cls):
+            return True
+        return type.__instancecheck__(cls, instance)
+
     def __init__(cls, name, bases, dct):
-        from . import schema
         # Build mongometa (make it inherit from base classes' mongometas
         mm = cls.__mongometa__ = build_mongometa(bases, dct)
 
         if not hasattr(mm, 'polymorphic_on'):
             mm.polymorphic_on = None
             mm.polymorphic_registry = None
+        fields = []
+        for k,v in dct.iteritems():
+            if isinstance(v, Field):
+                v.name = k
+                fields.append((k, v))
+        declared = mm.__dict__.get('schema')
+        mm._has_fields = (
+            bool(fields) or _declares_fields(declared)
+            or any(getattr(base, '_has_fields', False)
+                   for base in mm.__bases__))
+        if mm._has_fields:
+            # Register with the polymorphic registry now so that loading through
+            # a base class works before this class's schema is built
+            # (a class which is not polymorphic gets a registry of its own, so
+            # it does not see the classes of a polymorphic base's registry)
+            if mm.polymorphic_registry is None or not mm.polymorphic_on:
+                mm.polymorphic_registry = {}
+            if mm.polymorphic_on:
+                polymorphic_identity = getattr(mm, 'polymorphic_identity',
+                                               cls.__name__)
+                mm.polymorphic_registry[polymorphic_identity] = cls
+            if mm.slots and mm.lazy:
+                raise ValueError, '%s: lazy documents cannot use slots' % cls
+        # The schema (and record class) are built the first time they are used
+        build = _SchemaBuilder(cls, declared, fields)
+        mm.schema = _Deferred(build, 'schema')
+        mm.record_class = _Deferred(build, 'record_class')
+        if getattr(mm, 'lazy', False):
+            for k, v in LazyDocument.__dict__.iteritems():
+                if k not in ('__dict__', '__weakref__', '__module__', '__doc__'):
+                    setattr(cls, k, v)
+        cls._registry[cls.__name__] = cls
+
+class _Deferred(object):
+    '''Stands in for an attribute of a Document's __mongometa__ that is built
+    by a _SchemaBuilder the first time it is used'''
+
+    def __init__(self, build, name):
+        self.build = build
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return self.build(self.name)
+
+class _SchemaBuilder(object):
+    '''Build the schema of a Document class (incorporating the schemas of its
+    bases and any Migrate chain) and its record class'''
+    _lock = threading.RLock()
+
+    def __init__(self, cls, declared, fields):
+        self.cls = cls
+        self.declared = declared
+        self.fields = fields
+        self.built = None
+
+    def __call__(self, name):
+        with self._lock:
+            if self.built is None:
+                self.built = self._build()
+                mm = self.cls.__mongometa__
+                for k, v in self.built.iteritems():
+                    if isinstance(mm.__dict__.get(k), _Deferred):
+                        setattr(mm, k, v)
+        return self.built[name]
+
+    def _build(self):
+        cls = self.cls
+        mm = cls.__mongometa__
         # Make sure mongometa's schema incorporates base schemas
         my_schema = schema.Object()
         for base in mm.__bases__:
             if hasattr(base, 'schema'):
                 if base.schema:
                     my_schema.extend(schema.SchemaItem.make(base.schema))
-        if mm.schema:
-            my_schema.extend(schema.SchemaItem.make(mm.schema))
+        if self.declared:
+            my_schema.extend(schema.SchemaItem.make(self.declared))
         # Collect fields
-        for k,v in dct.iteritems():
-            if isinstance(v, Field):
-                v.name = k
-                si = schema.SchemaItem.make(v.type, *v.args, **v.kwargs)
-                my_schema.fields[k] = si
+        for k,v in self.fields:
+            si = schema.SchemaItem.make(v.type, *v.args, **v.kwargs)
+            my_schema.fields[k] = si
         if not my_schema.fields:
-            mm.schema = None
+            return dict(schema=None, record_class=None)
+        polymorphic_identity = getattr(mm, 'polymorphic_identity',
+                                       cls.__name__)
+        prev_version = getattr(mm, 'version_of', None)
+        if mm.schema_version is not None:
+            my_schema.fields[mm.version_field] = schema.Value(
+                mm.schema_version, if_missing=mm.schema_version)
+        my_schema.managed_class = cls
+        my_schema.set_polymorphic(
+            mm.polymorphic_on, mm.polymorphic_registry, polymorphic_identity)
+        if prev_version:
+            version_field = None
+            if mm.schema_version is not None:
+                version_field = mm.version_field
+            result = schema.Migrate(prev_version.__mongometa__.schema,
+                                    my_schema,
+                                    mm.migrate.im_func,
+                                    version_field, mm.schema_version)
         else:
-            polymorphic_identity = getattr(mm, 'polymorphic_identity',
-                                           cls.__name__)
-            prev_version = getattr(mm, 'version_of', None)
-            my_schema.managed_class = cls
-            if mm.polymorphic_registry is None:
-                mm.polymorphic_registry = {}
-            my_schema.set_polymorphic(
-                mm.polymorphic_on, mm.polymorphic_registry, polymorphic_identity)
-            if prev_version:
-                mm.schema = schema.Migrate(prev_version.__mongometa__.schema,
-                                           my_schema,
-                                           mm.migrate.im_func)
-            else:
-                mm.schema = my_schema
-        cls._registry[cls.__name__] = cls
-        
+            result = my_schema
+        record_class = None
+        if mm.slots:
+            record_class = _record_class(cls, my_schema)
+        return dict(schema=result, record_class=record_class)
+
+def _declares_fields(declared):
+    if isinstance(declared, schema.Object):
+        return bool(declared.fields)
+    return bool(declared)
+
 class Document(Object):
     '''Base class for all mapped MongoDB objects (the Document class can be
     thought of as the "collection", where a Document instance is a "document".
@@ -302,34 +816,231 @@ class Document(Object):
                                polymorphic_on field to specify that the concrete
                                class is the current one (if unspecified, the
                                class's __name__ attribute is used)
+        cached - (optional) if True, the results of find() and get() are kept in
+                 the session's query cache, if it has one (see ming.cache)
+        trusted - (optional) if True, documents loaded from the database are
+                  not validated (only polymorphic dispatch and if_missing
+                  defaults are applied)
+        validate_sample - (optional) when loading trusted documents, still
+                          validate one in every validate_sample documents so
+                          that drift between the schema and the data is
+                          detected
+        lazy - (optional) if True, the fields of documents built by make() are
+               validated the first time they are accessed rather than all at
+               once (see LazyDocument; call resolve() before copying such a
+               document with dict())
+        slots - (optional) if True, documents built by make() are instances
+                of a compact __slots__-based class generated from the schema
+                (record_class, see Record) rather than of the Document class
+        schema_version - (optional) if set, every document is stamped with this
+                         value in its version_field (default '_version') when
+                         it is validated, and migrations from the class named
+                         in version_of dispatch on the stamp rather than
+                         trying each schema in turn
+        write_concern - (optional) the write concern of writes to the
+                        collection, overriding the session's: False to not
+                        wait for writes to be acknowledged, or a dict of
+                        getlasterror options such as dict(w=2)
+        track_changes - (optional) if True, documents remember the state in
+                        which they were loaded (or last saved), and save()
+                        sends only the fields that changed since then (see
+                        Session.save)
+        fetch_unloaded - (optional) if True, accessing a field that the query
+                         of a partial document did not load fetches the rest
+                         of the document rather than raising FieldNotLoaded
+                         (see make_partial)
         '''
         name=None
         session=None
         schema=None
         indexes=[]
+        trusted=False
+        validate_sample=None
+        lazy=False
+        slots=False
+        schema_version=None
+        version_field='_version'
+        write_concern=None
+        track_changes=False
+        fetch_unloaded=False
+        cached=False
+
+    def __getstate__(self):
+        # don't pickle the cached manager
+        state = dict(self.__dict__)
+        state.pop('_manager', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
     def __init__(self, data):
         session = self.__mongometa__.session
-        data = Object.from_bson(data)
-        dict.update(self, data)
+        dict.update(self, (
+                (k, Object.from_bson(v)) for k,v in data.iteritems()))
+
+    def __missing__(self, name):
+        return self._not_loaded(name)
+
+    def _not_loaded(self, name):
+        '''Called when field name is missing.  Raises KeyError unless this is
+        a partial document which did not load the field, in which case either
+        FieldNotLoaded is raised or the rest of the document is fetched.'''
+        loaded = self.__dict__.get('_loaded')
+        if loaded is None or name in loaded:
+            raise KeyError, name
+        if name not in self.__mongometa__.schema.fields:
+            raise KeyError, name
+        if not self.__mongometa__.fetch_unloaded or '_id' not in loaded:
+            raise exc.FieldNotLoaded, '%s.%s was not loaded by the query' % (
+                self.__class__.__name__, name)
+        self._load_rest()
+        return self[name]
+
+    def _load_rest(self):
+        '''Fetch and validate the fields of a partial document which its query
+        did not load, making it a complete document'''
+        loaded = self.__dict__['_loaded']
+        partial = self.__dict__['_partial']
+        mm = self.__mongometa__
+        bson = mm.session._impl(self).find_one(dict(_id=self['_id']))
+        if bson is None:
+            raise exc.FieldNotLoaded, '%s %r no longer exists' % (
+                self.__class__.__name__, self['_id'])
+        full = self.make(bson)
+        for name, value in full.iteritems():
+            # keep the fields which have been set since the query
+            if name in partial or not (name in loaded or name in self):
+                dict.__setitem__(self, name, value)
+        del self.__dict__['_loaded']
+        del self.__dict__['_partial']
+        if mm.track_changes:
+            _set_snapshot(self, BSON.from_dict(bson))
 
     @classmethod
-    def make(cls, data, allow_extra=False, strip_extra=True):
-        'Kind of a virtual constructor'
-        if cls.__mongometa__.schema:
-            return cls.__mongometa__.schema.validate(
-                data, allow_extra=allow_extra, strip_extra=strip_extra)
+    def make_partial(cls, data, loaded):
+        '''Make a partial document from data, as returned by a query which only
+        loaded the top-level fields named in loaded.  Only those fields are
+        validated (and given their if_missing defaults); accessing any other
+        field raises FieldNotLoaded (or, if the class's __mongometa__ has
+        fetch_unloaded, fetches the rest of the document), and saving the
+        document only writes the loaded fields (and any set since).  Fields of
+        which only some subfields were loaded are kept as they are, and are
+        never saved.'''
+        mm = cls.__mongometa__
+        my_schema = mm.schema
+        if getattr(my_schema, 'polymorphic_registry', None):
+            disc = data.get(my_schema.polymorphic_on, schema.Missing)
+            if disc is not schema.Missing:
+                cls = my_schema.polymorphic_registry[disc]
+                mm = cls.__mongometa__
+        fields = mm.schema.fields
+        loaded = frozenset(loaded)
+        result = cls.__new__(cls)
+        error_dict = {}
+        partial = []
+        for name, value in data.iteritems():
+            if name not in loaded:
+                partial.append(name)
+                dict.__setitem__(result, name, Object.from_bson(value))
+        for name in loaded:
+            field = fields.get(name)
+            if field is None: continue
+            try:
+                value = field.validate(data.get(name, schema.Missing))
+            except schema.Invalid, inv:
+                error_dict[name] = inv
+                continue
+            if value is not schema.Missing:
+                dict.__setitem__(result, name, value)
+        if error_dict:
+            msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+            raise schema.Invalid(msg, data, None, error_dict=error_dict)
+        result.__dict__['_loaded'] = loaded
+        result.__dict__['_partial'] = frozenset(partial)
+        return result
+
+    @classmethod
+    def make(cls, data, allow_extra=False, strip_extra=True, trusted=None,
+             stored=False):
+        '''Kind of a virtual constructor.  If trusted is True (or unspecified
+        and the class's __mongometa__ is trusted), data is assumed to be valid
+        and is not validated.  stored is True when data was loaded from the
+        database (documents of track_changes classes then remember it).'''
+        mm = cls.__mongometa__
+        data = _from_record(data)
+        stored = stored and mm.track_changes
+        if stored:
+            # taken first: trusted documents may share data's values
+            snapshot = BSON.from_dict(data)
+        if mm.schema:
+            if trusted is None:
+                trusted = mm.trusted
+            if trusted and not _sample(mm.validate_sample):
+                result = mm.schema.trusted(
+                    data, allow_extra=allow_extra, strip_extra=strip_extra)
+            elif mm.lazy and hasattr(mm.schema, 'validate_lazy'):
+                result, pending = mm.schema.validate_lazy(
+                    data, allow_extra=allow_extra, strip_extra=strip_extra)
+                if pending:
+                    result.__dict__['_lazy'] = pending
+            else:
+                result = mm.schema.validate(
+                    data, allow_extra=allow_extra, strip_extra=strip_extra)
+            if mm.record_class is not None:
+                result = _to_record(result)
         else:
-            return cls(data)
+            result = cls(data)
+        if stored:
+            _set_snapshot(result, snapshot)
+        return result
+
+    @classmethod
+    def make_many(cls, data, allow_extra=False, strip_extra=True, trusted=None,
+                  stored=False):
+        '''Make a list of documents, validating them all in one pass.  If any
+        are invalid, a single Invalid is raised whose error_list holds the
+        error (or None) for each document.'''
+        mm = cls.__mongometa__
+        data = map(_from_record, data)
+        if trusted is None:
+            trusted = mm.trusted
+        if mm.schema and not trusted and not mm.lazy:
+            stored = stored and mm.track_changes
+            if stored:
+                snapshots = [ BSON.from_dict(d) for d in data ]
+            result = mm.schema.validate_many(
+                data, allow_extra=allow_extra, strip_extra=strip_extra)
+            if mm.record_class is not None:
+                result = map(_to_record, result)
+            if stored:
+                for doc, snapshot in zip(result, snapshots):
+                    _set_snapshot(doc, snapshot)
+            return result
+        return [ cls.make(d, allow_extra=allow_extra, strip_extra=strip_extra,
+                          trusted=trusted, stored=stored)
+                 for d in data ]
 
 class Cursor(object):
     '''Python class proxying a MongoDB cursor, constructing and validating
     objects that it tracks
     '''
 
-    def __init__(self, cls, cursor):
+    def __init__(self, cls, cursor, trusted=None, view=False, raw=False,
+                 cached_query=None, loaded=None, counter=None):
         self.cls = cls
         self.cursor = cursor
+        self.trusted = trusted
+        self.view = view
+        self._raw = raw
+        # names of the fields loaded by a projection (see Document.make_partial)
+        self._loaded = loaded
+        # function returning the count of the query (by default, the driver
+        # cursor's count), called once
+        self._counter = counter
+        self._count = None
+        # cache.CachedQuery, until the results are fetched
+        self._cached_query = cached_query
 
     def __iter__(self):
         return self
@@ -338,19 +1049,33 @@ class Cursor(object):
         return self.count()
 
     def next(self):
+        if self._cached_query is not None: self._use_cache()
         bson = self.cursor.next()
         if bson is None: return None
-        return self.cls.make(bson)
+        if self._raw: return bson
+        if self.view: return ObjectView(bson)
+        if self._loaded is not None:
+            return self.cls.make_partial(bson, self._loaded)
+        return self.cls.make(bson, trusted=self.trusted, stored=True)
 
     def count(self):
-        return self.cursor.count()
+        '''The number of documents matching the query, regardless of any limit
+        or skip.  Only the first call sends a query.'''
+        if self._count is None:
+            if self._counter is not None:
+                self._count = self._counter()
+            else:
+                self._count = self.cursor.count()
+        return self._count
 
     def limit(self, limit):
         self.cursor = self.cursor.limit(limit)
+        self._refine('limit', limit)
         return self
 
     def skip(self, skip):
         self.cursor = self.cursor.skip(skip)
+        self._refine('skip', skip)
         return self
 
     def hint(self, index_or_name):
@@ -359,6 +1084,22 @@ class Cursor(object):
 
     def sort(self, *args, **kwargs):
         self.cursor = self.cursor.sort(*args, **kwargs)
+        self._refine('sort', args, kwargs)
+        return self
+
+    def _refine(self, *option):
+        if self._cached_query is not None:
+            self._cached_query = self._cached_query.refine(*option)
+
+    def _use_cache(self):
+        '''Replace the driver cursor by the (possibly cached) results'''
+        query, self._cached_query = self._cached_query, None
+        self.cursor = query.results(self.cursor)
+
+    def raw(self):
+        '''Return the documents as decoded by the driver, without validating
+        them or building Objects (e.g. to pass them to utils.iter_json)'''
+        self._raw = True
         return self
 
     def one(self):
@@ -379,9 +1120,87 @@ class Cursor(object):
             return None
 
     def all(self):
-        return list(self)
+        return self._make_many(self._fetch())
+
+    def batches(self, batch_size=100):
+        '''Iterate over the results in lists of at most batch_size documents,
+        each of which is validated in a single pass'''
+        while True:
+            bsons = self._fetch(batch_size)
+            if not bsons: break
+            yield self._make_many(bsons)
+
+    def _make_many(self, bsons):
+        if self._raw:
+            return bsons
+        if self.view:
+            return [ ObjectView(bson) for bson in bsons ]
+        if self._loaded is not None:
+            return [ self.cls.make_partial(bson, self._loaded)
+                     for bson in bsons ]
+        return self.cls.make_many(bsons, trusted=self.trusted, stored=True)
+
+    def _fetch(self, limit=None):
+        'Fetch up to limit (default: all) raw documents from the cursor'
+        if self._cached_query is not None: self._use_cache()
+        result = []
+        while limit is None or len(result) < limit:
+            try:
+                bson = self.cursor.next()
+            except StopIteration:
+                break
+            if bson is not None:
+                result.append(bson)
+        return result
+
+def _sample(rate):
+    'Return True once in every rate calls (on average)'
+    return bool(rate) and random.randrange(rate) == 0
 
 NoneType = type(None)
+def _record_class(cls, my_schema):
+    '''Generate the Record class for Document class cls'''
+    names = sorted(my_schema.fields)
+    for name in names:
+        if (not isinstance(name, basestring)
+            or not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name)
+            or name.startswith('__')
+            or hasattr(Record, name) or name in ('m', '__mongometa__')):
+            raise ValueError, '%s: cannot store field %r in a slot' % (
+                cls, name)
+    for klass in cls.__mro__:
+        if 'm' in klass.__dict__:
+            manager = klass.__dict__['m']
+            break
+    return type(cls.__name__ + 'Record', (Record,), dict(
+            __slots__=tuple(names),
+            __module__=cls.__module__,
+            __mongometa__=cls.__mongometa__,
+            _fields=tuple(names),
+            _field_set=frozenset(names),
+            _document_class=cls,
+            m=property(lambda self: manager.__get__(self, cls))))
+
+def _set_snapshot(doc, snapshot):
+    '''Remember snapshot (the BSON of doc as stored in the database) so that
+    Session.save can send only what changed.  Records (which have no __dict__)
+    are not tracked.'''
+    d = getattr(doc, '__dict__', None)
+    if d is not None:
+        d['_snapshot'] = snapshot
+
+def _to_record(obj):
+    return obj.__mongometa__.record_class.from_dict(obj)
+
+def _from_record(obj):
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    return obj
+
+def _unpickle_record(cls):
+    record_class = cls.__mongometa__.record_class
+    return record_class.__new__(record_class)
+
 def _safe_bson(obj):
     '''Verify that the obj is safe for bsonification (in particular, no tuples or
     Decimal objects
@@ -396,6 +1215,8 @@ def _safe_bson(obj):
         return obj
     elif isinstance(obj, decimal.Decimal):
         return float(obj)
+    elif isinstance(obj, Record):
+        return _safe_bson(obj.to_dict())
     else:
         assert False, '%s is not safe for bsonification: %r' % (
             type(obj), obj)
@@ -0,0 +1,160 @@
+'''Query result caching.
+
+A Session given a QueryCache keeps the results of find() and get() queries on
+the classes whose __mongometa__ has cached = True.  Cached results are stored
+as BSON, so every hit builds fresh documents.  Each collection has a
+process-wide generation number which every write made through a Session
+bumps; results cached under an older generation are never returned.  Writes
+made by other processes, or directly through pymongo, are not seen, so use a
+ttl for data that may be changed elsewhere.
+'''
+from __future__ import with_statement
+import time
+import threading
+from collections import defaultdict
+
+from pymongo.bson import BSON
+from pymongo.son import SON
+
+# collection name => generation
+_generations = defaultdict(int)
+
+def generation(collection):
+    '''The current generation of the named collection'''
+    return _generations[collection]
+
+def invalidate(collection):
+    '''Invalidate every cached result from the named collection'''
+    _generations[collection] += 1
+
+class QueryCache(object):
+    '''A LRU cache of up to max_size query results, each of which expires
+    after ttl seconds (if ttl is not None).  hits and misses count the
+    lookups.'''
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key => [prev, next, key, (generation, expiry time, value)], the
+        # links of a circular list whose root's next is the least recently used
+        self._entries = {}
+        self._root = []
+        self._root[:] = [ self._root, self._root, None, None ]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation):
+        '''The value stored under key at generation, or None'''
+        with self._lock:
+            link = self._entries.get(key)
+            if link is not None:
+                self._unlink(link)
+                gen, expires, value = link[3]
+                if gen == generation and (
+                    expires is None or expires > time.time()):
+                    self._append(link)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            link = self._entries.get(key)
+            if link is not None:
+                self._unlink(link)
+            link = self._entries[key] = [
+                None, None, key, (generation, expires, value) ]
+            self._append(link)
+            while len(self._entries) > self.max_size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._entries[oldest[2]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._root[:] = [ self._root, self._root, None, None ]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        '''Make link the most recently used'''
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+class CachedQuery(object):
+    '''The cache entry for a query, refined as Cursor options are applied'''
+
+    def __init__(self, cache, key, generation):
+        self.cache = cache
+        self.key = key
+        self.generation = generation
+
+    def refine(self, *option):
+        return CachedQuery(
+            self.cache, self.key + (freeze(option),), self.generation)
+
+    def fetch(self, load):
+        '''The list of documents of the query, from the cache or else from
+        load() (in which case they are cached)'''
+        bsons = self.cache.get(self.key, self.generation)
+        if bsons is not None:
+            return [ b.to_dict() for b in bsons ]
+        docs = list(load())
+        self.cache.put(self.key, self.generation,
+                       [ BSON.from_dict(d) for d in docs ])
+        return docs
+
+    def count(self, load):
+        '''The count of the query, from the cache or else from load() (in
+        which case it is cached)'''
+        result = self.cache.get(self.key, self.generation)
+        if result is None:
+            result = load()
+            self.cache.put(self.key, self.generation, result)
+        return result
+
+    def results(self, cursor):
+        '''A stand-in for the driver cursor with the documents of the query,
+        from the cache or else from cursor'''
+        return CachedResults(self.fetch(lambda: cursor), cursor)
+
+class CachedResults(object):
+    '''Stands in for a driver cursor whose documents have been fetched'''
+
+    def __init__(self, docs, cursor):
+        self._docs = iter(docs)
+        self._cursor = cursor
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._docs.next()
+
+    def count(self):
+        return self._cursor.count()
+
+def freeze(obj):
+    '''A hashable equivalent of a query (or query option)'''
+    if isinstance(obj, SON):
+        return tuple((k, freeze(v)) for k, v in obj.iteritems())
+    if isinstance(obj, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
@@ -16,9 +16,11 @@ class DataStore(object):
     """Manages a connections to Mongo, with seprate connections per thread."""
 
     def __init__(self, master='mongo://localhost:27017/gutenberg', slave=None,
-                 connect_retry=3):
+                 connect_retry=3, write_concern=None):
         # self._tl_value = ThreadLocal()
         self._conn = None
+        # default write concern of sessions bound to this datastore
+        self.write_concern = write_concern
         self._lock = Lock()
         self._connect_retry = connect_retry
         self.configure(master, slave)
@@ -123,9 +125,11 @@ class DataStore(object):
 
 class ReplicaSetDataStore(DataStore):
 
-    def __init__(self, members=['mongo://localhost:27017/gutenberg'], connect_retry=3):
+    def __init__(self, members=['mongo://localhost:27017/gutenberg'], connect_retry=3,
+                 write_concern=None):
         # self._tl_value = ThreadLocal()
         self._conn = None
+        self.write_concern = write_concern
         self._lock = Lock()
         self._connect_retry = connect_retry
         self.configure(members)
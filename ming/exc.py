@@ -1,2 +1,3 @@
 class MingException(Exception): pass
 class MongoGone(MingException): pass
+class FieldNotLoaded(MingException): pass
@@ -0,0 +1,218 @@
+'''Bulk migration of whole collections.
+
+MigrationRunner loads every document in a Document class's collection through
+the class's schema (running any migrations) and writes back only the fields
+that changed.  The collection is streamed in _id order, one batch at a time, so
+that a checkpoint of the last _id written can be kept in the database and an
+interrupted migration resumed where it left off.
+'''
+import time
+import logging
+from itertools import chain
+from multiprocessing import Pool
+
+import pymongo
+import pymongo.errors
+
+from . import cache
+from .utils import bson_update
+
+log = logging.getLogger(__name__)
+
+class MigrationRunner(object):
+    '''Migrate every document of cls's collection.
+
+    batch_size - number of documents read (and written) per round trip
+    processes - if set, the size of the process pool in which documents are
+                migrated; otherwise documents are migrated in this process
+    name - the name under which the checkpoint is stored (defaults to the
+           collection name)
+    checkpoint_collection - collection holding the checkpoints
+    log_interval - minimum number of seconds between progress messages
+    session - the session through which the collection and checkpoints are
+              read and written (defaults to the session of cls)
+    '''
+
+    def __init__(self, cls, batch_size=500, processes=None, name=None,
+                 checkpoint_collection='ming.migrations', log_interval=10,
+                 session=None):
+        self.cls = cls
+        self._session = session
+        self.batch_size = batch_size
+        self.processes = processes
+        self.name = name or cls.__mongometa__.name
+        self.checkpoint_collection = checkpoint_collection
+        self.log_interval = log_interval
+        self.stats = dict(scanned=0, updated=0, failed=0, elapsed=0.0, rate=0.0)
+
+    @property
+    def session(self):
+        if self._session is not None:
+            return self._session
+        return self.cls.__mongometa__.session
+
+    @property
+    def collection(self):
+        return self.session._impl(self.cls)
+
+    @property
+    def checkpoints(self):
+        return self.session.db[self.checkpoint_collection]
+
+    def checkpoint(self):
+        '''The stored checkpoint, or None'''
+        return self.checkpoints.find_one(dict(_id=self.name))
+
+    def run(self, restart=False):
+        '''Run (or resume) the migration, returning the stats dict.  If restart
+        is True, any unfinished checkpoint is ignored.'''
+        self._last_id = None
+        for k in ('scanned', 'updated', 'failed'):
+            self.stats[k] = 0
+        cp = self.checkpoint()
+        if cp is not None and not cp.get('done') and not restart:
+            self._last_id = cp.get('last_id')
+            for k in ('scanned', 'updated', 'failed'):
+                self.stats[k] = cp.get(k, 0)
+            log.info('%s: resuming migration after _id %r',
+                     self.name, self._last_id)
+        self._start = self._last_log = time.time()
+        self._start_count = self.stats['scanned']
+        pool = None
+        if self.processes:
+            pool = Pool(self.processes, _init_worker, (self.cls,))
+        try:
+            pending = None
+            # Migrate each batch while the next one is being read
+            for batch in self._batches(self._last_id):
+                job = self._submit(pool, batch)
+                if pending is not None:
+                    self._write(*pending)
+                pending = batch, job
+            if pending is not None:
+                self._write(*pending)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self._save_checkpoint(True)
+        self._update_rate()
+        log.info('%s: migrated %d documents (%d updated, %d failed) '
+                 'in %.1fs, %.0f docs/s', self.name,
+                 self.stats['scanned'], self.stats['updated'],
+                 self.stats['failed'], self.stats['elapsed'],
+                 self.stats['rate'])
+        return self.stats
+
+    def _batches(self, last_id):
+        coll = self.collection
+        while True:
+            if last_id is None:
+                spec = {}
+            else:
+                spec = {'_id': {'$gt': last_id}}
+            cursor = coll.find(spec).sort('_id', pymongo.ASCENDING)
+            batch = list(cursor.limit(self.batch_size))
+            if not batch: break
+            yield batch
+            last_id = batch[-1]['_id']
+
+    def _submit(self, pool, batch):
+        if pool is None:
+            return _Done(_migrate_batch(self.cls, batch))
+        size = max(1, len(batch) // self.processes)
+        chunks = [ batch[i:i+size] for i in xrange(0, len(batch), size) ]
+        return pool.map_async(_migrate_chunk, chunks)
+
+    def _write(self, batch, job):
+        updates = []
+        for _id, update, error in chain(*job.get()):
+            if error is not None:
+                self.stats['failed'] += 1
+                log.warning('%s: could not migrate %r: %s',
+                            self.name, _id, error)
+            elif update:
+                updates.append((_id, update))
+        coll = self.collection
+        # Every write is acknowledged (getlasterror only reports the last
+        # one), so that the checkpoint never moves past a lost update
+        updated = 0
+        for _id, update in updates:
+            try:
+                coll.update({'_id':_id}, update, safe=True)
+            except pymongo.errors.OperationFailure, error:
+                self.stats['failed'] += 1
+                log.warning('%s: could not write %r: %s',
+                            self.name, _id, error)
+            else:
+                updated += 1
+        if updates:
+            cache.invalidate(self.cls.__mongometa__.name)
+        self.stats['scanned'] += len(batch)
+        self.stats['updated'] += updated
+        self._last_id = batch[-1]['_id']
+        self._save_checkpoint(False)
+        now = time.time()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            self._update_rate()
+            log.info('%s: %d documents (%d updated, %d failed), %.0f docs/s',
+                     self.name, self.stats['scanned'], self.stats['updated'],
+                     self.stats['failed'], self.stats['rate'])
+
+    def _save_checkpoint(self, done):
+        cp = dict(_id=self.name, last_id=self._last_id, done=done)
+        for k in ('scanned', 'updated', 'failed'):
+            cp[k] = self.stats[k]
+        self.checkpoints.save(cp, safe=True)
+
+    def _update_rate(self):
+        elapsed = time.time() - self._start
+        self.stats['elapsed'] = elapsed
+        if elapsed:
+            self.stats['rate'] = (
+                self.stats['scanned'] - self._start_count) / elapsed
+
+class _Done(object):
+    '''Stands in for an AsyncResult when migrating in-process'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return [ self.value ]
+
+_worker_cls = None
+
+def _init_worker(cls):
+    global _worker_cls
+    _worker_cls = cls
+
+def _migrate_chunk(batch):
+    return _migrate_batch(_worker_cls, batch)
+
+def _migrate_batch(cls, batch):
+    '''Returns a list of (_id, update, error) for the documents in batch'''
+    return [ _migrate_one(cls, raw) for raw in batch ]
+
+def _migrate_one(cls, raw):
+    try:
+        doc = cls.make(raw, trusted=False)
+        mm = doc.__mongometa__
+        if not isinstance(doc, dict):
+            # slotted record
+            doc = doc.to_dict()
+        hook = getattr(mm, 'before_save', None)
+        if hook:
+            hook.im_func(doc)
+            doc = mm.schema.validate_safe(doc)
+        else:
+            doc.make_safe()
+        return raw['_id'], diff(raw, doc), None
+    except Exception, ex:
+        return raw['_id'], None, '%s: %s' % (ex.__class__.__name__, ex)
+
+def diff(old, new):
+    '''Return the update document ($set / $unset) that turns the top-level
+    fields of old into those of new'''
+    return bson_update(old, new)
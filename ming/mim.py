@@ -43,7 +43,7 @@ class Connection(object):
         return self._databases.keys()
 
     def drop_database(self, name):
-        del self._databases[name]
+        self._databases.pop(name, None)
 
     def __repr__(self):
         return 'mim.Connection()'
@@ -62,8 +62,14 @@ class Database(database.Database):
     def _make_collection(self):
         return Collection(self)
 
-    def command(self, command):
-        if 'filemd5' in command:
+    def command(self, command, value=1, **kwargs):
+        if isinstance(command, basestring):
+            command = dict({command:value}, **kwargs)
+        if 'collstats' in command:
+            coll = self._get(command['collstats'])
+            return dict(ns='%s.%s' % (self.name, coll.name),
+                        count=len(coll._data), ok=1.0)
+        elif 'filemd5' in command:
             return dict(md5='42') # completely bogus value; will it work?
         elif 'findandmodify' in command:
             coll = self._collections[command['findandmodify']]
@@ -95,7 +101,7 @@ class Database(database.Database):
         return self._collections.keys()
 
     def drop_collection(self, name):
-        del self._collections[name]
+        self._collections.pop(name, None)
 
 class Collection(object):
 
@@ -121,16 +127,19 @@ class Collection(object):
         for doc in self._data.itervalues():
             if match(spec, doc): yield doc
 
-    def find(self, spec=None):
+    def find(self, spec=None, fields=None):
         if spec is None:
             spec = {}
-        return Cursor(lambda:self._find(spec))
+        return Cursor(lambda:self._find(spec), fields=fields)
 
-    def find_one(self, spec):
-        for x in self.find(spec):
+    def find_one(self, spec, fields=None):
+        for x in self.find(spec, fields):
             return x
 
-    def insert(self, doc_or_docs, safe=False):
+    def count(self):
+        return len(self._data)
+
+    def insert(self, doc_or_docs, safe=False, **kwargs):
         if not isinstance(doc_or_docs, list):
             doc_or_docs = [ doc_or_docs ]
         for doc in doc_or_docs:
@@ -144,7 +153,7 @@ class Collection(object):
             self._data[_id] = deepcopy(doc)
         return _id
 
-    def save(self, doc, safe=False):
+    def save(self, doc, safe=False, **kwargs):
         _id = doc.get('_id', ())
         if _id == ():
             return self.insert(doc, safe=safe)
@@ -152,7 +161,7 @@ class Collection(object):
             self.update({'_id':_id}, doc, upsert=True, safe=safe)
             return _id
 
-    def update(self, spec, document, upsert=False, safe=False):
+    def update(self, spec, document, upsert=False, safe=False, **kwargs):
         updated = False
         for doc in self._find(spec):
             self._deindex(doc) 
@@ -223,11 +232,13 @@ class Collection(object):
 
 class Cursor(object):
 
-    def __init__(self, iterator_gen, sort=None, skip=None, limit=None):
+    def __init__(self, iterator_gen, sort=None, skip=None, limit=None,
+                 fields=None):
         self._iterator_gen = iterator_gen
         self._sort = sort
         self._skip = skip
         self._limit = limit
+        self._fields = fields
 
     @LazyProperty
     def iterator(self):
@@ -248,6 +259,8 @@ class Cursor(object):
 
     def next(self):
         value = self.iterator.next()
+        if self._fields is not None:
+            return project(value, self._fields)
         return deepcopy(value)
 
     def sort(self, key_or_list, direction=ASCENDING):
@@ -263,7 +276,8 @@ class Cursor(object):
             self._iterator_gen,
             sort=keys,
             skip=self._skip,
-            limit=self._limit)
+            limit=self._limit,
+            fields=self._fields)
 
     def all(self):
         return list(self._iterator_gen())
@@ -273,14 +287,16 @@ class Cursor(object):
             self._iterator_gen,
             sort=self._sort,
             skip=skip,
-            limit=self._limit)
+            limit=self._limit,
+            fields=self._fields)
 
     def limit(self, limit):
         return Cursor(
             self._iterator_gen,
             sort=self._sort,
             skip=self._skip,
-            limit=limit)
+            limit=limit,
+            fields=self._fields)
 
 def cursor_comparator(keys):
     def comparator(a, b):
@@ -290,6 +306,42 @@ def cursor_comparator(keys):
         return 0
     return comparator
 
+def project(doc, fields):
+    '''Return a copy of doc with only the (possibly dotted) fields selected by
+    fields, a list of names or a dict of names to include (true) or exclude
+    (false)'''
+    if not fields:
+        # like the driver
+        fields = {'_id':1}
+    elif not isinstance(fields, dict):
+        fields = dict((k, 1) for k in fields)
+    included = [ k for k, v in fields.iteritems() if v ]
+    if not included:
+        result = deepcopy(doc)
+        for k in fields:
+            parent, name = _find_parent(result, k)
+            if isinstance(parent, dict): parent.pop(name, None)
+        return result
+    if fields.get('_id', 1): included.append('_id')
+    result = {}
+    for k in included:
+        parent, name = _find_parent(doc, k)
+        if not isinstance(parent, dict) or name not in parent: continue
+        target = result
+        for part in k.split('.')[:-1]:
+            target = target.setdefault(part, {})
+        target[name] = deepcopy(parent[name])
+    return result
+
+def _find_parent(doc, key):
+    '''Return the (parent subdocument, field name) of dotted key in doc, or
+    (None, name) if a parent is missing'''
+    parts = key.split('.')
+    for part in parts[:-1]:
+        if not isinstance(doc, dict): return None, parts[-1]
+        doc = doc.get(part)
+    return doc, parts[-1]
+
 def match(spec, doc):
     '''TODO:
     currently this should match, but it doesn't:
@@ -297,6 +349,9 @@ def match(spec, doc):
     '''
     try:
         for k,v in spec.iteritems():
+            if k == '$or':
+                if not [ s for s in v if match(s, doc) ]: return False
+                continue
             op, value = _parse_query(v)
             if not _part_match(op, value, k.split('.'), doc): return False
         return True
@@ -318,6 +373,10 @@ def _part_match(op, value, key_parts, doc, allow_list_compare=True):
                 return True
         else:
             return False
+    elif (op == '$eq' and value is None and isinstance(doc, dict)
+          and key_parts[0] not in doc):
+        # null matches missing fields
+        return True
     else:
         return _part_match(op, value, key_parts[1:], doc[key_parts[0]])
 
@@ -350,17 +409,45 @@ def update(doc, updates):
         doc.clear()
         doc.update(newdoc)
     for k, v in updates.iteritems():
-        if k == '$inc':
-            for kk, vv in v.iteritems():
-                doc[kk] += vv
-        elif k == '$push':
-            for kk, vv in v.iteritems():
-                doc[kk].append(vv)
-        elif k == '$set':
-            doc.update(v)
-        elif k.startswith('$'):
-            raise NotImplementedError, k
+        if not k.startswith('$'): continue
+        for kk, vv in v.iteritems():
+            parent, key = _traverse(doc, kk)
+            if k == '$inc':
+                parent[key] = parent.get(key, 0) + vv
+            elif k == '$push':
+                parent.setdefault(key, []).append(deepcopy(vv))
+            elif k == '$addToSet':
+                values = parent.setdefault(key, [])
+                if vv not in values:
+                    values.append(deepcopy(vv))
+            elif k == '$pull':
+                if key in parent:
+                    parent[key] = [ x for x in parent[key]
+                                    if not pull_match(vv, x) ]
+            elif k == '$set':
+                parent[key] = deepcopy(vv)
+            elif k == '$unset':
+                parent.pop(key, None)
+            else:
+                raise NotImplementedError, k
     validate(doc)
+
+def _traverse(doc, key):
+    '''Return the (parent subdocument, field name) of dotted key in doc,
+    creating missing subdocuments'''
+    parts = key.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    return doc, parts[-1]
+
+def pull_match(cond, value):
+    '''Whether the $pull condition cond removes the array element value'''
+    if isinstance(cond, dict):
+        if cond and cond.keys()[0].startswith('$'):
+            # a condition on the element itself
+            return match({'v':cond}, {'v':value})
+        return isinstance(value, dict) and match(cond, value)
+    return cond == value
                 
 def validate(doc):
     for k,v in doc.iteritems():
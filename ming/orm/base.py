@@ -14,6 +14,9 @@ def mapper(v):
 def session(v):
     '''The ORMSession object managing either a class or an instance'''
     if isinstance(v, type):
+        if hasattr(v, '__ming__'):
+            # compiling the mapper installs the full __mongometa__
+            mapper(v).compile()
         return v.__mongometa__.session
     else:
         return session(type(v))
@@ -28,8 +31,14 @@ class Decoration(object):
         self.obj = obj
         doc_cls = mapper(obj).doc_cls
         self.state = ObjectState()
-        doc = instrument(doc_cls.make(bson),
-                         DocumentTracker(self.state))
+        loaded = getattr(bson, '__dict__', {}).get('_loaded')
+        if loaded is None:
+            bson = doc_cls.make(bson)
+        else:
+            # a partial document (see Document.make_partial) stays partial
+            self.state.loaded = loaded
+            self.state.partial = bson.__dict__['_partial']
+        doc = instrument(bson, DocumentTracker(self.state))
         self.state.document = doc
         self.state.original_document = bson
 
@@ -40,6 +49,7 @@ class ObjectState(object):
         self._status = self.new
         self.original_document = None
         self.document = None
+        self.loaded = self.partial = None
         self.extra_state = {}
 
     def soil(self):
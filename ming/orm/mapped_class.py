@@ -26,19 +26,30 @@ class Mapper(object):
     def properties(self):
         return self.property_index.itervalues()
 
+    @property
+    def doc_cls(self):
+        '''The Document class for the mapped class (compiling the mapper the
+        first time it is needed)'''
+        return self.compile()._doc_cls
+
     def compile(self):
         if self._compiled: return self
         for p in self.properties:
             p.compile()
-        self.doc_cls = make_document_class(self._mapped_class, self._dct)
+        self._doc_cls = make_document_class(self._mapped_class, self._dct)
         self._compiled = True
-        mm = self._mapped_class.__mongometa__ = self.doc_cls.__mongometa__
+        mm = self._mapped_class.__mongometa__ = self._doc_cls.__mongometa__
         if mm.polymorphic_registry is not None:
             if not hasattr(mm, 'orm_polymorphic_registry'):
                 mm.orm_polymorphic_registry = {}
             for name, value in mm.polymorphic_registry.iteritems():
-                if value is self.doc_cls:
+                if value is self._doc_cls:
                     mm.orm_polymorphic_registry[name] = self._mapped_class
+            if mm.polymorphic_on:
+                # objects of any mapped subclass may be loaded through this one
+                for mc in MappedClass._registry.values():
+                    if issubclass(mc, self._mapped_class):
+                        mapper(mc).compile()
         return self
 
     def insert(self, session, obj, state):
@@ -47,7 +58,7 @@ class Mapper(object):
             prop.insert(self, session, obj, state)
         # Actually insert the document
         doc = self.doc_cls(state.document)
-        session.impl.insert(doc)
+        session.impl.insert(doc, write_concern=session.write_concern)
         if '_id' in doc:
             state.document['_id'] = doc._id
         session.save(obj)
@@ -59,7 +70,11 @@ class Mapper(object):
             prop.update(self, session, obj, state)
         # Actually insert the document
         doc = self.doc_cls(state.document)
-        session.impl.save(doc)
+        if state.loaded is not None:
+            # only save the fields the query loaded (see Session.save)
+            doc.__dict__['_loaded'] = state.loaded
+            doc.__dict__['_partial'] = state.partial
+        session.impl.save(doc, write_concern=session.write_concern)
         if '_id' in doc:
             state.document['_id'] = doc._id
         state.status = state.clean
@@ -70,7 +85,7 @@ class Mapper(object):
             prop.delete(self, session, obj, state)
         # Actually insert the document
         doc = self.doc_cls(state.document)
-        session.impl.delete(doc)
+        session.impl.delete(doc, write_concern=session.write_concern)
         session.expunge(obj)
 
     def remove(self, *args, **kwargs):
@@ -79,11 +94,17 @@ class Mapper(object):
     def create(self, doc):
         mm = self._mapped_class.__mongometa__
         opr = getattr(mm, 'orm_polymorphic_registry', None)
-        if opr:
+        if opr and mm.polymorphic_on:
             discriminator = doc[mm.polymorphic_on]
             cls = opr[discriminator]
         else:
             cls = self._mapped_class
+        if '_loaded' in getattr(doc, '__dict__', {}):
+            # keep the partial document's loaded fields with its state
+            obj = cls.__new__(cls)
+            obj.__ming__ = Decoration(obj, doc)
+            session(obj).save(obj)
+            return obj
         return cls(**encode_keys(doc))
 
 class MappedClassMeta(type):
@@ -98,6 +119,7 @@ class QueryDescriptor(object):
     def __get__(self, instance, cls):
         if instance is not None:
             cls = instance.__class__
+        mapper(cls).compile()
         return Query(cls, instance)
 
 class MappedClass(object):
@@ -135,7 +157,9 @@ class MappedClass(object):
 
     @classmethod
     def compile_all(cls):
-        for mc in cls._registry.itervalues():
+        '''Compile all mappers now.  This is optional: each mapper is compiled
+        the first time its class is used.'''
+        for mc in cls._registry.values():
             mapper(mc).compile()
 
     def delete(self):
@@ -32,11 +32,15 @@ class ORMSession(object):
 
     _registry = {}
 
-    def __init__(self, doc_session=None, bind=None, extensions=None):
+    def __init__(self, doc_session=None, bind=None, extensions=None,
+                 write_concern=None):
         if doc_session is None:
             doc_session = Session(bind)
         if extensions is None: extensions = []
         self.impl = doc_session
+        # write concern of flushed writes; if None, the document session's
+        # (or the mapped class's) is used
+        self.write_concern = write_concern
         self.uow = UnitOfWork(self)
         self.imap = IdentityMap()
         self.extensions = [ e(self) for e in extensions ]
@@ -60,8 +64,19 @@ class ORMSession(object):
         self.uow.expunge(obj)
         self.imap.expunge(obj)
 
+    def flush(self, obj=None, write_concern=None):
+        '''Flush obj (or all pending changes), with the given write concern
+        if any'''
+        if write_concern is None:
+            return self._flush(obj)
+        saved, self.write_concern = self.write_concern, write_concern
+        try:
+            return self._flush(obj)
+        finally:
+            self.write_concern = saved
+
     @with_hooks('flush')
-    def flush(self, obj=None):
+    def _flush(self, obj=None):
         if self.impl.db is None: return
         if obj is None:
             self.uow.flush()
@@ -118,11 +133,15 @@ class ORMSession(object):
     @with_hooks('remove')
     def remove(self, cls, *args, **kwargs):
         m = mapper(cls)
+        kwargs.setdefault('write_concern', self.write_concern)
         self.impl.remove(m.doc_cls, *args, **kwargs)
 
-    def update(self, cls, spec, fields, upsert=False):
+    def update(self, cls, spec, fields, upsert=False, write_concern=None):
         m = mapper(cls)
-        self.impl.update_partial(m.doc_cls, spec, fields, upsert)
+        if write_concern is None:
+            write_concern = self.write_concern
+        self.impl.update_partial(m.doc_cls, spec, fields, upsert,
+                                 write_concern=write_concern)
 
     def update_if_not_modified(self, obj, fields, upsert=False):
         self.update(obj.__class__, state(obj).original_document, fields, upsert)
@@ -142,6 +161,9 @@ class ORMSession(object):
     def ensure_indexes(self, cls):
         return self.impl.ensure_indexes(cls)
 
+    def sync_indexes(self, cls):
+        return self.impl.sync_indexes(cls)
+
     def drop_indexes(self, cls):
         return self.impl.drop_indexes(cls)
 
@@ -1,7 +1,9 @@
 import types
+import weakref
 import logging
 
 from copy import deepcopy
+from functools import partial
 from datetime import datetime
 from formencode.validators import Invalid
 
@@ -30,11 +32,118 @@ class SchemaItem(object):
     is loaded from the DB or saved to it.  It should return a "validated" object,
     raising an Invalid exception if the object is invalid.  If it returns
     Missing, the field will be stripped from its parent object.'''
+    _compiled = _compiled_safe = _missing_factory = None
 
     def validate(self, d):
         'convert/validate an object or raise an Invalid exception'
         raise NotImplementedError, 'validate'
 
+    @property
+    def compiled(self):
+        '''The specialized validation function for this item, built by compile()
+        the first time it is needed'''
+        result = self._compiled
+        if result is None:
+            result = self._compiled = self.compile()
+        return result
+
+    def compile(self):
+        '''Return a function with the same signature and behavior as validate(),
+        specialized for this particular item.  The default is simply the bound
+        validate method.'''
+        return self.validate
+
+    def validate_safe(self, value, **kw):
+        '''Validate value and make the result safe for bsonification (see
+        base.Object.make_safe) in the same pass.  Used when saving.'''
+        return self.compiled_safe(value, **kw)
+
+    @property
+    def compiled_safe(self):
+        '''The specialized function behind validate_safe(), built by
+        compile_safe() the first time it is needed'''
+        result = self._compiled_safe
+        if result is None:
+            result = self._compiled_safe = self.compile_safe()
+        return result
+
+    def compile_safe(self):
+        '''Return a function with the same signature and behavior as
+        validate_safe().  The default makes the value safe before validating
+        it.'''
+        from . import base
+        safe_bson = base._safe_bson
+        validate = self.validate
+        def validate_safe(value, **kw):
+            if value is not Missing:
+                value = safe_bson(value)
+            return validate(value, **kw)
+        return validate_safe
+
+    @property
+    def missing_factory(self):
+        '''Function returning the value to use when this item is missing, built
+        by _make_missing_factory() the first time it is needed'''
+        result = self._missing_factory
+        if result is None:
+            result = self._missing_factory = self._make_missing_factory()
+        return result
+
+    def _make_missing_factory(self):
+        return partial(self.validate, Missing)
+
+    def reset(self):
+        '''Discard the compiled validator and missing factory (call after
+        modifying the item), and those of the items whose compiled validators
+        use them'''
+        self._compiled = self._compiled_safe = self._missing_factory = None
+        parents = self.__dict__.get('_parents')
+        if parents and not self.__dict__.get('_resetting'):
+            self._resetting = True
+            try:
+                for parent in parents.keys():
+                    parent.reset()
+            finally:
+                self._resetting = False
+
+    def _used_by(self, parent):
+        '''Record that parent's compiled validators use this item's, so that
+        resetting this item resets parent'''
+        parents = self.__dict__.get('_parents')
+        if parents is None:
+            parents = self._parents = weakref.WeakKeyDictionary()
+        parents[parent] = True
+
+    def validate_many(self, values, **kw):
+        '''Validate a list of values, returning the list of results.  Errors
+        for all the values are collected and raised as a single Invalid whose
+        error_list holds the error (or None) for each value.'''
+        values = list(values)
+        result, error_list = self.validate_each(values, **kw)
+        _raise_many(values, error_list)
+        return result
+
+    def validate_each(self, values, **kw):
+        '''Validate a list of values like validate_many(), but return the list
+        of results (None for the invalid values) and the list of errors (None
+        for the valid values) rather than raising.'''
+        result = []
+        error_list = []
+        for value in values:
+            try:
+                result.append(self.validate(value, **kw))
+                error_list.append(None)
+            except Invalid, inv:
+                result.append(None)
+                error_list.append(inv)
+        return result, error_list
+
+    def trusted(self, value, **kw):
+        '''Convert a value that is known to be valid (e.g. one that was written
+        through this schema) without validating it.  The default is to
+        validate anyway.'''
+        return self.validate(value, **kw)
+
     @classmethod
     def make(cls, field, *args, **kwargs):
         '''Build a SchemaItem from a "shorthand" schema (summarized below)
@@ -70,21 +179,50 @@ class SchemaItem(object):
         return field
 
 class Migrate(SchemaItem):
-    '''Use when migrating from one field type to another
+    '''Use when migrating from one field type to another.
+
+    If version_field is given, dict-like values carrying a version in that
+    field are dispatched by it: values at the current version are validated
+    against the new schema only, values at any other version are migrated
+    without first being tried against the new schema.  Values without a
+    version fall back to trying the new schema first.
     '''
-    def __init__(self, old, new, migration_function):
+    def __init__(self, old, new, migration_function,
+                 version_field=None, version=None):
         self.old, self.new, self.migration_function = (
             SchemaItem.make(old),
             SchemaItem.make(new),
             migration_function)
+        self.version_field = version_field
+        self.version = version
 
     def validate(self, value, **kw):
+        version = self._version(value)
+        if version == self.version:
+            return self.new.validate(value, **kw)
+        if version is not Missing:
+            return self._migrate(value, **kw)
         try:
             return self.new.validate(value, **kw)
         except Invalid:
-            value = self.old.validate(value, **kw)
-            value = self.migration_function(value)
-            return self.new.validate(value, **kw)
+            return self._migrate(value, **kw)
+
+    def trusted(self, value, **kw):
+        if self._version(value) == self.version:
+            return self.new.trusted(value, **kw)
+        return self.validate(value, **kw)
+
+    def _version(self, value):
+        if self.version_field is None or not isinstance(value, dict):
+            return Missing
+        return value.get(self.version_field, Missing)
+
+    def _migrate(self, value, **kw):
+        value = self.old.validate(value, **kw)
+        value = self.migration_function(value)
+        if self.version_field is not None and isinstance(value, dict):
+            value[self.version_field] = self.version
+        return self.new.validate(value, **kw)
 
     @classmethod
     def obj_to_list(cls, key_name, value_name=None):
@@ -131,19 +269,25 @@ class FancySchemaItem(SchemaItem):
             self.if_missing = if_missing
 
     def validate(self, value, **kw):
+        return self.compiled(value, **kw)
+
+    def compile(self):
+        if _overrides_validate(self):
+            return self.validate
+        return self._interpret
+
+    def _make_missing_factory(self):
+        if _overrides_validate(self):
+            return partial(self.validate, Missing)
+        if self.required:
+            return _missing_required
+        return _default_factory(self.if_missing)
+
+    def _interpret(self, value, **kw):
+        '''Generic (slow) validation path, used when no specialized validator
+        can be compiled or the value is not of the shape it expects'''
         if value is Missing:
-            if self.required:
-                raise Invalid('Missing field', value, None)
-            else:
-                if self.if_missing is Missing:
-                    return self.if_missing
-                elif isinstance(self.if_missing, (
-                        types.FunctionType,
-                        types.MethodType,
-                        types.BuiltinFunctionType)):
-                    return self.if_missing()
-                else:
-                    return deepcopy(self.if_missing) # handle mutable defaults
+            return self.missing_factory()
         try:
             if value == self.if_missing:
                 return value
@@ -151,12 +295,6 @@ class FancySchemaItem(SchemaItem):
             pass
         except:
             pass
-        if hasattr(self, '_fast_validate'):
-            try:
-                return self._fast_validate(value, **kw)
-            except Invalid:
-                # must use 'slow' validation path
-                pass
         return self._validate(value, **kw)
 
     def _validate(self, value, **kw): return value
@@ -169,6 +307,21 @@ class Anything(FancySchemaItem):
         if isinstance(value, dict) and not isinstance(value, base.Object):
             return base.Object(value)
         return value
+
+    def compile(self):
+        return self.validate
+
+    def compile_safe(self):
+        from . import base
+        safe_bson = base._safe_bson
+        Object = base.Object
+        def validate_safe(value, **kw):
+            if value is Missing: return value
+            value = safe_bson(value)
+            if isinstance(value, dict) and not isinstance(value, Object):
+                return Object(value)
+            return value
+        return validate_safe
     
 class Object(FancySchemaItem):
     '''Used for dict-like validation.  Also ensures that the incoming object does
@@ -195,16 +348,14 @@ class Object(FancySchemaItem):
         return self._if_missing
     def _set_if_missing(self, value):
         self._if_missing = value
+        self.reset()
     if_missing = property(_get_if_missing, _set_if_missing)
 
     def validate(self, value, **kw):
         try:
             return super(Object, self).validate(value, **kw)
         except Invalid, inv:
-            if self.managed_class:
-                inv.msg = '%s:\n    %s' % (
-                    self.managed_class,
-                    inv.msg.replace('\n', '\n    '))
+            self._annotate(inv)
             raise
 
     def _validate(self, d, allow_extra=False, strip_extra=False):
@@ -262,51 +413,378 @@ class Object(FancySchemaItem):
                 result[ek] = d[ek]
         return result
 
-    def _fast_validate(self, d, allow_extra=False, strip_extra=False):
-        '''Make the common case fast - valid, non-polymorphic.  Raise ValueError
-        when fast path cannot complete'''
+    def _make_missing_factory(self):
+        if (self.required or self._if_missing is not NoDefault
+            or _overrides_validate(self)):
+            return super(Object, self)._make_missing_factory()
+        from . import base
+        items = [ (name, field.missing_factory)
+                  for name, field in self.fields.iteritems()
+                  if isinstance(name, basestring) ]
+        def missing():
+            result = base.Object()
+            for name, field_missing in items:
+                value = field_missing()
+                if value is not Missing:
+                    result[name] = value
+            return result
+        return missing
+
+    def validate_safe(self, value, **kw):
+        try:
+            return self.compiled_safe(value, **kw)
+        except Invalid, inv:
+            self._annotate(inv)
+            raise
+
+    def compile(self):
+        body = self._compile_body()
+        if body is None:
+            return self._interpret
+        if self.polymorphic_registry:
+            return self._compile_polymorphic(body)
+        return body
+
+    def compile_safe(self):
+        body = self._compile_body(safe=True)
+        if body is None:
+            return super(Object, self).compile_safe()
+        if self.polymorphic_registry:
+            return self._compile_polymorphic(body, safe=True)
+        return body
+
+    def _compile_polymorphic(self, body, safe=False):
+        '''Wrap body (the validator for the managed class) with a dispatch
+        table mapping each discriminator in the polymorphic registry to the
+        validator of the corresponding class's own fields'''
+        registry = self.polymorphic_registry
+        field = self.polymorphic_on
+        own_cls = self.managed_class
+        identity = getattr(
+            own_cls.__mongometa__, 'polymorphic_identity', own_cls.__name__)
+        dispatch = {}
+        for disc, cls in registry.iteritems():
+            if cls is own_cls:
+                dispatch[disc] = (cls, body)
+                continue
+            schema = cls.__mongometa__.schema
+            validator = None
+            if isinstance(schema, SchemaItem):
+                schema._used_by(self)
+            if isinstance(schema, Object) and schema.managed_class is cls:
+                validator = schema._compile_body(safe)
+            if validator is None:
+                if safe:
+                    validator = schema.validate_safe
+                else:
+                    validator = schema.validate
+            dispatch[disc] = (cls, validator)
+        interpret = self._interpret
+        if safe:
+            interpret = super(Object, self).compile_safe()
+        def validate(d, allow_extra=False, strip_extra=False):
+            if not isinstance(d, dict):
+                return interpret(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra)
+            disc = d.get(field, Missing)
+            if disc is Missing:
+                result = body(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra)
+                result[field] = identity
+                return result
+            entry = dispatch.get(disc)
+            if entry is None or registry.get(disc) is not entry[0]:
+                # registry changed behind our back
+                return interpret(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra)
+            return entry[1](
+                d, allow_extra=allow_extra, strip_extra=strip_extra)
+        return validate
+
+    def _compile_body(self, safe=False):
+        '''Build a validator specialized for this object's field map, or return
+        None if the field map cannot be compiled (non-string field names).  If
+        safe is True, the validator also makes its result safe for
+        bsonification.'''
+        from . import base
+        for name in self.fields:
+            if not isinstance(name, basestring): return None
         cls = self.managed_class
-        if self.polymorphic_registry: raise Invalid('polymorphic', d, None)
         if cls is None:
-            from . import base
+            new = base.Object
+        else:
+            new = partial(cls.__new__, cls)
+        items = [ (name, _validator(self, field, safe), field.missing_factory)
+                  for name, field in self.fields.iteritems() ]
+        if safe:
+            interpret = super(Object, self).compile_safe()
+            extra = base._safe_bson
+        else:
+            interpret = self._interpret
+            extra = None
+        names = frozenset(self.fields)
+        def validate(d, allow_extra=False, strip_extra=False):
+            if not isinstance(d, dict):
+                return interpret(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra)
+            result = new()
+            get = d.get
+            found = 0
+            error_dict = None
+            for name, field_validate, field_missing in items:
+                value = get(name, Missing)
+                try:
+                    if value is Missing:
+                        value = field_missing()
+                    else:
+                        found += 1
+                        value = field_validate(value)
+                except Invalid, inv:
+                    if error_dict is None: error_dict = {}
+                    error_dict[name] = inv
+                    continue
+                if value is not Missing:
+                    result[name] = value
+            if error_dict:
+                msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+                raise Invalid(msg, d, None, error_dict=error_dict)
+            if found != len(d):
+                extra_keys = set(d.iterkeys()) - names
+                if not allow_extra:
+                    raise Invalid('Extra keys: %r' % extra_keys, d, None)
+                if not strip_extra:
+                    for ek in extra_keys:
+                        if extra is None:
+                            result[ek] = d[ek]
+                        else:
+                            result[ek] = extra(d[ek])
+            return result
+        return validate
+
+    def validate_many(self, docs, allow_extra=False, strip_extra=False):
+        '''Validate a list of documents one field at a time, sharing the
+        compiled field validators (and polymorphic lookups) across all of
+        them.'''
+        docs = list(docs)
+        result, error_list = self.validate_each(
+            docs, allow_extra=allow_extra, strip_extra=strip_extra)
+        _raise_many(docs, error_list)
+        return result
+
+    def validate_each(self, docs, allow_extra=False, strip_extra=False):
+        '''validate_many() without raising (see SchemaItem.validate_each)'''
+        kw = dict(allow_extra=allow_extra, strip_extra=strip_extra)
+        docs = list(docs)
+        if not self.polymorphic_registry:
+            return self._validate_many(docs, kw)
+        groups = {}
+        for i, d in enumerate(docs):
+            cls = self.managed_class
+            if isinstance(d, dict):
+                disc = d.get(self.polymorphic_on, Missing)
+                if disc is not Missing:
+                    cls = self.polymorphic_registry[disc]
+            groups.setdefault(cls, []).append(i)
+        result = [ None ] * len(docs)
+        error_list = [ None ] * len(docs)
+        for cls, indices in groups.iteritems():
+            schema = cls.__mongometa__.schema
+            group = [ docs[i] for i in indices ]
+            if isinstance(schema, Object):
+                group_result, group_errors = schema._validate_many(group, kw)
+            else:
+                group_result, group_errors = schema.validate_each(group, **kw)
+            identity = getattr(
+                cls.__mongometa__, 'polymorphic_identity', cls.__name__)
+            for i, obj, inv in zip(indices, group_result, group_errors):
+                if obj is not None and self.polymorphic_on not in docs[i]:
+                    obj[self.polymorphic_on] = identity
+                result[i], error_list[i] = obj, inv
+        return result, error_list
+
+    def _validate_many(self, docs, kw):
+        '''Validate docs (ignoring polymorphism), returning the list of results
+        and the list of errors'''
+        for name in self.fields:
+            if not isinstance(name, basestring):
+                return SchemaItem.validate_each(self, docs, **kw)
+        from . import base
+        cls = self.managed_class
+        if cls is None:
+            new = base.Object
+        else:
+            new = partial(cls.__new__, cls)
+        result = [ None ] * len(docs)
+        error_list = [ None ] * len(docs)
+        field_errors = {}
+        rows = []
+        for i, d in enumerate(docs):
+            if isinstance(d, dict):
+                result[i] = new()
+                rows.append((i, d.get, result[i]))
+            else:
+                try:
+                    result[i] = self.validate(d, **kw)
+                except Invalid, inv:
+                    error_list[i] = inv
+        for name, field in self.fields.iteritems():
+            field_validate = _validator(self, field)
+            field_missing = field.missing_factory
+            for i, get, obj in rows:
+                try:
+                    value = get(name, Missing)
+                    if value is Missing:
+                        value = field_missing()
+                    else:
+                        value = field_validate(value)
+                except Invalid, inv:
+                    field_errors.setdefault(i, {})[name] = inv
+                    continue
+                if value is not Missing:
+                    obj[name] = value
+        names = frozenset(self.fields)
+        for i, get, obj in rows:
+            d = docs[i]
+            error_dict = field_errors.get(i)
+            if error_dict:
+                msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+                error_list[i] = self._annotate(
+                    Invalid(msg, d, None, error_dict=error_dict))
+                result[i] = None
+            elif not names.issuperset(d):
+                extra_keys = set(d.iterkeys()) - names
+                if not kw['allow_extra']:
+                    error_list[i] = self._annotate(
+                        Invalid('Extra keys: %r' % extra_keys, d, None))
+                    result[i] = None
+                elif not kw['strip_extra']:
+                    for ek in extra_keys:
+                        obj[ek] = d[ek]
+        return result, error_list
+
+    def _annotate(self, inv):
+        if self.managed_class:
+            inv.msg = '%s:\n    %s' % (
+                self.managed_class,
+                inv.msg.replace('\n', '\n    '))
+        return inv
+
+    def validate_lazy(self, d, allow_extra=False, strip_extra=False):
+        '''Validate the structure of d (polymorphic dispatch, missing and extra
+        fields), deferring validation of the fields that are present.  Returns
+        (result, pending) where pending maps the names of the deferred fields
+        to their unvalidated values.'''
+        from . import base
+        if not isinstance(d, dict):
+            return self.validate(
+                d, allow_extra=allow_extra, strip_extra=strip_extra), {}
+        for name in self.fields:
+            if not isinstance(name, basestring):
+                return self.validate(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra), {}
+        cls = self.managed_class
+        disc = Missing
+        if self.polymorphic_registry:
+            disc = d.get(self.polymorphic_on, Missing)
+            if disc is not Missing:
+                cls = self.polymorphic_registry[disc]
+                if cls is not self.managed_class:
+                    mm = cls.__mongometa__
+                    if getattr(mm, 'lazy', False):
+                        return mm.schema.validate_lazy(
+                            d, allow_extra=allow_extra, strip_extra=strip_extra)
+                    return mm.schema.validate(
+                        d, allow_extra=allow_extra, strip_extra=strip_extra), {}
+        if cls is None:
             result = base.Object()
         else:
             result = cls.__new__(cls)
-        if not isinstance(d, dict): raise Invalid('notdict', d, None)
-        to_set = []
+        pending = {}
+        error_dict = {}
         for name, field in self.fields.iteritems():
-            if isinstance(name, basestring):
-                to_set.append((
-                        name,
-                        field.validate(d.get(name, Missing))))
+            value = d.get(name, Missing)
+            if value is not Missing:
+                pending[name] = value
+                continue
+            try:
+                value = field.missing_factory()
+                if value is not Missing:
+                    dict.__setitem__(result, name, value)
+            except Invalid, inv:
+                error_dict[name] = inv
+        if error_dict:
+            msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+            raise Invalid(msg, d, None, error_dict=error_dict)
+        if self.polymorphic_registry and disc is Missing:
+            pending.pop(self.polymorphic_on, None)
+            dict.__setitem__(result, self.polymorphic_on, getattr(
+                    cls.__mongometa__, 'polymorphic_identity', cls.__name__))
+        if len(pending) != len(d):
+            extra_keys = set(d.iterkeys()) - set(self.fields.iterkeys())
+            if not allow_extra:
+                raise Invalid('Extra keys: %r' % extra_keys, d, None)
+            if not strip_extra:
+                for ek in extra_keys:
+                    dict.__setitem__(result, ek, d[ek])
+        return result, pending
+
+    def trusted(self, d, allow_extra=False, strip_extra=False):
+        '''Build the object from d without validating any of its fields.  Only
+        polymorphic dispatch and if_missing defaults are applied.'''
+        from . import base
+        if not isinstance(d, dict):
+            return self.validate(
+                d, allow_extra=allow_extra, strip_extra=strip_extra)
+        cls = self.managed_class
+        disc = Missing
+        if self.polymorphic_registry:
+            disc = d.get(self.polymorphic_on, Missing)
+            if disc is not Missing:
+                cls = self.polymorphic_registry[disc]
+                if cls is not self.managed_class:
+                    return cls.__mongometa__.schema.trusted(
+                        d, allow_extra=allow_extra, strip_extra=strip_extra)
+        if cls is None:
+            result = base.Object()
+        else:
+            result = cls.__new__(cls)
+        for name, field in self.fields.iteritems():
+            if not isinstance(name, basestring):
+                return self.validate(
+                    d, allow_extra=allow_extra, strip_extra=strip_extra)
+            value = d.get(name, Missing)
+            if value is Missing:
+                value = field.missing_factory()
             else:
-                # Validate all items in d against this field
-                allow_extra=True
-                name_validator = SchemaItem.make(name)
-                to_set.extend([
-                    (name_validator.validate(name),
-                     field.validate(value))
-                    for name, value in d.iteritems() ])
-        for name, value in to_set:
-            if value is Missing: continue
-            result[name] = value
-        extra_keys = set(d.iterkeys()) - set(self.fields.iterkeys())
-        if extra_keys and not allow_extra:
-            raise Invalid('extrakeys', d, None)
-        if extra_keys and not strip_extra:
-            for ek in extra_keys:
-                result[ek] = d[ek]
+                value = field.trusted(value)
+            if value is not Missing:
+                result[name] = value
+        if self.polymorphic_registry and disc is Missing:
+            result[self.polymorphic_on] = getattr(
+                cls.__mongometa__, 'polymorphic_identity', cls.__name__)
+        if not strip_extra:
+            for k, v in d.iteritems():
+                if k not in self.fields:
+                    result[k] = v
         return result
 
     def extend(self, other):
         if other is None: return
         self.fields.update(other.fields)
+        self.reset()
 
     def set_polymorphic(self, field, registry, identity):
+        self.reset()
         self.polymorphic_on = field
         self.polymorphic_registry = registry
         if self.polymorphic_on:
             registry[identity] = self.managed_class
+            # rebuild the dispatch tables of the other classes in the registry
+            # (only those already built)
+            for cls in registry.itervalues():
+                schema = cls.__mongometa__.__dict__.get('schema')
+                if isinstance(schema, SchemaItem):
+                    schema.reset()
 
 class Array(FancySchemaItem):
     '''Array/list validator.  All elements of the array must pass validation by a
@@ -323,6 +801,55 @@ class Array(FancySchemaItem):
     def field_type(self):
         return SchemaItem.make(self._field_type)
 
+    def compile(self):
+        if _overrides_validate(self):
+            return self.validate
+        return self._compile(
+            _validator(self, self.field_type), self._interpret)
+
+    def compile_safe(self):
+        if _overrides_validate(self):
+            return super(Array, self).compile_safe()
+        return self._compile(
+            _validator(self, self.field_type, True),
+            super(Array, self).compile_safe(),
+            safe=True)
+
+    def _compile(self, field_validate, interpret, safe=False):
+        exact_types = _SCALAR_TYPES.get(type(self.field_type))
+        def validate(d, **kw):
+            if safe and d.__class__ is tuple:
+                d = list(d)
+            if d.__class__ is not list:
+                return interpret(d, **kw)
+            if exact_types is not None and exact_types.issuperset(map(type, d)):
+                # homogeneous array of simple scalars: nothing to convert
+                return d[:]
+            result = []
+            append = result.append
+            error_list = None
+            for i, value in enumerate(d):
+                try:
+                    append(field_validate(value))
+                except Invalid, inv:
+                    if error_list is None: error_list = [ None ] * len(d)
+                    error_list[i] = inv
+            if error_list:
+                msg = '\n'.join(('[%s]:%s' % (i,v))
+                                for i,v in enumerate(error_list)
+                                if v)
+                raise Invalid(msg, d, None, error_list=error_list)
+            return result
+        return validate
+
+    def trusted(self, d, **kw):
+        if d.__class__ is not list:
+            return self.validate(d, **kw)
+        field_type = self.field_type
+        if isinstance(field_type, Scalar):
+            return d[:]
+        return [ field_type.trusted(value) for value in d ]
+
     def _validate(self, d):
         result = []
         error_list = []
@@ -353,6 +880,36 @@ class Array(FancySchemaItem):
 class Scalar(FancySchemaItem):
     '''Validate that a value is NOT an array or dict'''
     if_missing=None
+
+    def compile(self):
+        exact_types = _SCALAR_TYPES.get(type(self))
+        if _overrides_validate(self):
+            return self.validate
+        if exact_types is None:
+            return self._interpret
+        interpret = self._interpret
+        def validate(value, **kw):
+            if value.__class__ in exact_types:
+                return value
+            return interpret(value, **kw)
+        return validate
+
+    def compile_safe(self):
+        exact_types = _SCALAR_TYPES.get(type(self))
+        generic = super(Scalar, self).compile_safe()
+        if exact_types is None:
+            return generic
+        def validate_safe(value, **kw):
+            if value.__class__ in exact_types:
+                return value
+            return generic(value, **kw)
+        return validate_safe
+
+    def trusted(self, value, **kw):
+        if value is Missing:
+            return self.missing_factory()
+        return value
+
     def _validate(self, value):
         if isinstance(value, (tuple, list, dict)):
             raise Invalid('%r is not a scalar' % value, value, None)
@@ -428,6 +985,69 @@ class ObjectId(Scalar):
         except Exception, ex:
             raise Invalid(str(ex), value, None)
 
+_STOCK_VALIDATE = frozenset([
+        FancySchemaItem.validate.im_func, Object.validate.im_func ])
+
+def _overrides_validate(item):
+    '''True if item's class overrides validate(), which compiled validators
+    must then call rather than bypass'''
+    validate = getattr(type(item).validate, 'im_func', None)
+    return (isinstance(item, FancySchemaItem)
+            and validate not in _STOCK_VALIDATE)
+
+def _validator(parent, item, safe=False):
+    '''The validator of item for use in the compiled validators of parent:
+    its compiled (or compiled_safe) validator, unless its class overrides
+    validate()'''
+    item._used_by(parent)
+    if _overrides_validate(item):
+        if safe:
+            return SchemaItem.compile_safe(item)
+        return item.validate
+    if safe:
+        return item.compiled_safe
+    return item.compiled
+
+def _missing_required():
+    raise Invalid('Missing field', Missing, None)
+
+_IMMUTABLE_TYPES = frozenset([
+        type(None), bool, int, long, float, str, unicode, datetime,
+        pymongo.bson.ObjectId, pymongo.bson.Binary ])
+
+def _immutable(value):
+    if value.__class__ in _IMMUTABLE_TYPES:
+        return True
+    if value.__class__ in (tuple, frozenset):
+        for v in value:
+            if not _immutable(v): return False
+        return True
+    return False
+
+def _default_factory(value):
+    '''Return a function producing the default value "value" as cheaply as
+    possible: functions are used as-is, immutable values are shared, empty
+    lists and dicts are built fresh and anything else is deep-copied (to handle
+    mutable defaults)'''
+    if isinstance(value, (
+            types.FunctionType,
+            types.MethodType,
+            types.BuiltinFunctionType)):
+        return value
+    if value is Missing or _immutable(value):
+        return lambda: value
+    if value.__class__ in (list, dict) and not value:
+        return value.__class__
+    return partial(deepcopy, value)
+
+def _raise_many(values, error_list):
+    'Raise a single Invalid for the errors (if any) in error_list'
+    if not any(error_list): return
+    msg = '\n'.join(('[%s]:%s' % (i,v))
+                    for i,v in enumerate(error_list)
+                    if v)
+    raise Invalid(msg, values, None, error_list=error_list)
+
 # Shorthand for various SchemaItems
 SHORTHAND={
     int:Int,
@@ -437,3 +1057,16 @@ SHORTHAND={
     datetime:DateTime}
     
 
+
+# Types accepted unchanged by each simple scalar SchemaItem, used to build their
+# specialized validators.  Subclasses are not listed since they may override
+# _validate.
+NoneType = type(None)
+_SCALAR_TYPES = {
+    String:frozenset([str, unicode, NoneType]),
+    Int:frozenset([int, long, bool, NoneType]),
+    Float:frozenset([float, int, long, bool, NoneType]),
+    DateTime:frozenset([datetime, NoneType]),
+    Bool:frozenset([bool, NoneType]),
+    Binary:frozenset([pymongo.bson.Binary, NoneType]),
+    ObjectId:frozenset([pymongo.bson.ObjectId, NoneType])}
@@ -1,14 +1,23 @@
 from __future__ import absolute_import
+import time
 import logging
+from copy import deepcopy
 from functools import update_wrapper
 
 import pymongo
 import pymongo.errors
 from pymongo.son import SON
+from pymongo.objectid import ObjectId
+from pymongo.bson import BSON
 from threading import local
 
-from .base import Cursor, Object
+from .base import Cursor, Object, Record, _safe_bson, _set_snapshot
+from .schema import Invalid
+from . import schema as S
 from . import exc
+from . import cache
+from . import mim
+from .utils import bson_update
 
 log = logging.getLogger(__name__)
 
@@ -20,12 +29,188 @@ def annotate_doc_failure(func):
             opf.args = opf.args + (('doc:  ' + str(doc)),)
     return update_wrapper(wrapper, func)
 
+def invalidates(func):
+    '''Decorator for the Session methods that write to the collection of
+    their first argument (a class or document): the collection's cached
+    query results are invalidated once the write has been made'''
+    def wrapper(self, cls_or_doc, *args, **kwargs):
+        try:
+            return func(self, cls_or_doc, *args, **kwargs)
+        finally:
+            cache.invalidate(cls_or_doc.__mongometa__.name)
+    return update_wrapper(wrapper, func)
+
+def _patch_snapshot(doc, paths, drop=False):
+    '''Bring the track_changes snapshot of doc (if it has one) up to date after
+    a write of the given dotted paths: copy their values in doc into it, or
+    (if drop is True, when the stored values are unknown) remove them from it
+    so that the next save sends doc's values'''
+    snapshot = getattr(doc, '__dict__', {}).get('_snapshot')
+    if snapshot is None: return
+    stored = snapshot.to_dict()
+    for path in paths:
+        parts = path.split('.')
+        value = S.Missing
+        if not drop:
+            value = _lookup_path(doc, parts)
+        try:
+            _store_path(stored, parts, value)
+        except (LookupError, ValueError, TypeError, AttributeError):
+            # the snapshot no longer has the path's shape: forget the whole
+            # field, so that save() sends it
+            stored.pop(parts[0], None)
+    _set_snapshot(doc, BSON.from_dict(stored))
+
+def _lookup_path(obj, parts):
+    for part in parts:
+        try:
+            if isinstance(obj, list):
+                obj = obj[int(part)]
+            else:
+                obj = obj[part]
+        except (LookupError, ValueError, TypeError):
+            return S.Missing
+    return obj
+
+def _store_path(obj, parts, value):
+    for part in parts[:-1]:
+        if isinstance(obj, list):
+            obj = obj[int(part)]
+        else:
+            obj = obj.setdefault(part, {})
+    key = parts[-1]
+    if isinstance(obj, list):
+        obj[int(key)] = value
+    elif value is S.Missing:
+        obj.pop(key, None)
+    else:
+        obj[key] = value
+
+def _field_schema(doc_schema, path):
+    '''The SchemaItem for dotted path in doc_schema, or None if unknown'''
+    item = doc_schema
+    for part in path.split('.'):
+        if isinstance(item, S.Array) and part.isdigit():
+            item = item.field_type
+        elif isinstance(item, S.Object):
+            item = item.fields.get(part)
+        else:
+            return None
+    return item
+
+def _operand(doc_schema, operator, path, value):
+    '''Validate (and make BSON-safe) the operand of an atomic update'''
+    item = None
+    if doc_schema is not None:
+        item = _field_schema(doc_schema, path)
+    if operator in ('$push', '$addToSet'):
+        if isinstance(item, S.Array):
+            item = item.field_type
+        else:
+            item = None
+    if operator == '$pull':
+        # $pull takes a value or a query, which the schema cannot check
+        _check_pull(value)
+        return _safe_bson(value)
+    if item is None:
+        return _safe_bson(value)
+    return item.validate_safe(value)
+
+# the query operators with which $pull conditions are matched locally
+_PULL_OPERATORS = frozenset([
+        '$gt', '$gte', '$lt', '$lte', '$ne', '$in', '$nin' ])
+
+def _check_pull(cond):
+    '''Raise ValueError if the $pull condition cond uses query operators
+    which cannot be matched locally in the same way as by the server'''
+    if not isinstance(cond, dict): return
+    for k, v in cond.iteritems():
+        if k.startswith('$'):
+            if k not in _PULL_OPERATORS or len(cond) != 1:
+                raise ValueError, 'unsupported $pull condition %r' % cond
+        else:
+            _check_pull(v)
+
+def _apply(doc, operator, key_parts, value):
+    '''Make the change of an atomic update to the local copy of doc'''
+    for part in key_parts[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+        else:
+            if doc.get(part) is None:
+                doc[part] = Object()
+            doc = doc[part]
+    key = key_parts[-1]
+    if isinstance(doc, list):
+        key = int(key)
+        current = doc[key]
+    else:
+        current = doc.get(key)
+    if operator == '$inc':
+        value = (current or 0) + value
+    elif operator == '$max':
+        if current is not None and current >= value: return
+    elif operator == '$min':
+        if current is not None and current <= value: return
+    elif operator in ('$push', '$addToSet'):
+        if current is not None:
+            if operator == '$push' or value not in current:
+                current.append(value)
+            return
+        value = [ value ]
+    elif operator == '$pull':
+        if current is not None:
+            current[:] = [ x for x in current
+                           if not mim.pull_match(value, x) ]
+        return
+    doc[key] = value
+
+def _loaded_fields(cls, fields):
+    '''The names of the top-level fields of cls loaded in full by a query with
+    the projection fields (a list of names, or a dict of names to include or
+    exclude), or None if it loads them all'''
+    my_schema = getattr(cls.__mongometa__, 'schema', None)
+    if fields is None or not isinstance(my_schema, S.Object): return None
+    # like the driver, an empty projection loads only the _id
+    if not fields: fields = ['_id']
+    names = set(my_schema.fields)
+    if isinstance(fields, dict):
+        included = [ k for k, v in fields.iteritems() if v ]
+        excluded = [ k for k, v in fields.iteritems() if not v ]
+    else:
+        included, excluded = list(fields), []
+    if included:
+        loaded = set(k for k in included if '.' not in k)
+        loaded.add('_id')
+    else:
+        loaded = set(names)
+    for k in excluded:
+        # a field is not loaded in full if any of its subfields is excluded
+        loaded.discard(k.split('.')[0])
+    if loaded >= names: return None
+    return frozenset(loaded)
+
+def _index_key(idx, unique):
+    if not isinstance(idx, (list, tuple)):
+        idx = [ idx ]
+    return tuple(idx), unique
+
 class Session(object):
     _registry = {}
     _datastores = {}
 
-    def __init__(self, bind=None):
+    def __init__(self, bind=None, write_concern=None, cache=None,
+                 count_cache=None):
         self.bind = bind
+        self.write_concern = write_concern
+        # cache.QueryCache for the classes whose __mongometa__ is cached
+        self.cache = cache
+        # cache.QueryCache for the results of count(), for every class
+        self.count_cache = count_cache
+        # (bind, collection name) => set of ensured index keys
+        self._indexed = {}
+        # (bind, class) pairs whose indexes have all been ensured
+        self._indexed_classes = set()
 
     @classmethod
     def by_name(cls, name):
@@ -45,24 +230,99 @@ class Session(object):
     def db(self):
         return self.bind.db
 
+    def _write_options(self, cls, write_concern=None):
+        '''The keyword arguments for a write to the collection of cls (a class
+        or document).  The write concern is taken from the call, then from
+        cls.__mongometa__, the session and the datastore; it is either a bool
+        (whether to wait for the write to be acknowledged) or a dict of the
+        driver's getlasterror options (e.g. dict(w=2, wtimeout=1000)).
+        Writes are acknowledged (safe=True) by default.'''
+        if write_concern is None:
+            write_concern = getattr(cls.__mongometa__, 'write_concern', None)
+        if write_concern is None:
+            write_concern = self.write_concern
+        if write_concern is None:
+            write_concern = getattr(self.bind, 'write_concern', None)
+        if write_concern is None or write_concern is True:
+            return dict(safe=True)
+        if write_concern is False:
+            return dict(safe=False)
+        result = dict(write_concern)
+        result.setdefault('safe', True)
+        return result
+
+    def _cached_query(self, cls, *key):
+        '''The cache.CachedQuery for a query on cls, if cls is cached'''
+        if self.cache is None or not cls.__mongometa__.cached:
+            return None
+        name = cls.__mongometa__.name
+        return cache.CachedQuery(
+            self.cache, (self.bind, name) + cache.freeze(key),
+            cache.generation(name))
+
     def get(self, cls, **kwargs):
-        bson = self._impl(cls).find_one(kwargs)
+        query = self._cached_query(cls, 'get', kwargs)
+        if query is None:
+            bson = self._impl(cls).find_one(kwargs)
+        else:
+            def load():
+                bson = self._impl(cls).find_one(kwargs)
+                if bson is None: return []
+                return [ bson ]
+            docs = query.fetch(load)
+            bson = docs and docs[0] or None
         if bson is None: return None
-        return cls.make(bson)
+        return cls.make(bson, stored=True)
 
     def find(self, cls, *args, **kwargs):
+        trusted = kwargs.pop('trusted', None)
+        view = kwargs.pop('view', False)
+        raw = kwargs.pop('raw', False)
+        counter = None
+        if self.count_cache is not None:
+            spec = args and args[0] or kwargs.get('spec')
+            counter = lambda: self.count(cls, spec)
+        if len(args) > 1:
+            loaded = _loaded_fields(cls, args[1])
+        else:
+            loaded = _loaded_fields(cls, kwargs.get('fields'))
         cursor = self._impl(cls).find(*args, **kwargs)
-        return Cursor(cls, cursor)
+        return Cursor(cls, cursor, trusted=trusted, view=view, raw=raw,
+                      cached_query=self._cached_query(cls, 'find', args, kwargs),
+                      loaded=loaded, counter=counter)
 
+    @invalidates
     def remove(self, cls, *args, **kwargs):
-        if 'safe' not in kwargs:
-            kwargs['safe'] = True
-        self._impl(cls).remove(*args, **kwargs)
+        options = self._write_options(cls, kwargs.pop('write_concern', None))
+        options.update(kwargs)
+        self._impl(cls).remove(*args, **options)
 
     def find_by(self, cls, **kwargs):
         return self.find(cls, kwargs)
 
-    def count(self, cls):
+    def count(self, cls, spec=None, approximate=False):
+        '''The number of documents of cls matching spec.  If approximate is
+        True and there is no spec, the number of documents in the whole
+        collection is read from its stats rather than counted (on a sharded
+        collection it may then include documents being migrated between
+        shards).  Counts are kept in the count_cache, if the session has one,
+        until a write to the collection or the cache's ttl expires them.'''
+        if self.count_cache is None:
+            return self._count(cls, spec, approximate)
+        name = cls.__mongometa__.name
+        query = cache.CachedQuery(
+            self.count_cache,
+            (self.bind, name, 'count', cache.freeze(spec or {}),
+             bool(approximate and not spec)),
+            cache.generation(name))
+        return query.count(lambda: self._count(cls, spec, approximate))
+
+    def _count(self, cls, spec, approximate):
+        if spec:
+            return self._impl(cls).find(spec).count()
+        if approximate:
+            stats = self.db.command('collstats', cls.__mongometa__.name)
+            return int(stats['count'])
         return self._impl(cls).count()
 
     def ensure_index(self, cls, fields, **kwargs):
@@ -72,17 +332,45 @@ class Session(object):
         return self._impl(cls).ensure_index(index_fields, **kwargs), fields
 
     def ensure_indexes(self, cls):
-        for idx in getattr(cls.__mongometa__, 'indexes', []):
-            self.ensure_index(cls, idx)
-        for idx in getattr(cls.__mongometa__, 'unique_indexes', []):
-            self.ensure_index(cls, idx, unique=True)
+        '''Ensure the indexes declared by cls.  Each index is only sent to the
+        server once per (bind, collection) for this session; use sync_indexes
+        to send them again.'''
+        if (self.bind, cls) in self._indexed_classes: return
+        mm = cls.__mongometa__
+        ensured = self._indexed.setdefault((self.bind, mm.name), set())
+        for unique, attr in ((False, 'indexes'), (True, 'unique_indexes')):
+            for idx in getattr(mm, attr, []):
+                key = _index_key(idx, unique)
+                if key in ensured: continue
+                if unique:
+                    self.ensure_index(cls, idx, unique=True)
+                else:
+                    self.ensure_index(cls, idx)
+                ensured.add(key)
+        self._indexed_classes.add((self.bind, cls))
+
+    def sync_indexes(self, cls):
+        '''Ensure the indexes declared by cls even if they have already been
+        ensured by this session'''
+        self._forget_indexes(cls)
+        self.ensure_indexes(cls)
+
+    def _forget_indexes(self, cls):
+        name = cls.__mongometa__.name
+        self._indexed.pop((self.bind, name), None)
+        self._indexed_classes = set(
+            (bind, c) for bind, c in self._indexed_classes
+            if bind is not self.bind or c.__mongometa__.name != name)
 
     def group(self, cls, *args, **kwargs):
         return self._impl(cls).group(*args, **kwargs)
 
-    def update_partial(self, cls, spec, fields, upsert):
-        return self._impl(cls).update(spec, fields, upsert, safe=True)
+    @invalidates
+    def update_partial(self, cls, spec, fields, upsert, write_concern=None):
+        return self._impl(cls).update(
+            spec, fields, upsert, **self._write_options(cls, write_concern))
 
+    @invalidates
     def find_and_modify(self, cls, query=None, sort=None, new=False, **kw):
         if query is None: query = {}
         if sort is None: sort = {}
@@ -92,61 +380,212 @@ class Session(object):
                 [('findandmodify', cls.__mongometa__.name)]
                 + options.items())
         bson = db.command(cmd)
-        return cls.make(bson['value'])
+        return cls.make(bson['value'], stored=True)
 
-    @annotate_doc_failure
-    def save(self, doc, *args):
-        hook = getattr(doc.__mongometa__, 'before_save', None)
+    def _prepare(self, doc):
+        '''Run the before_save hook, then validate doc and make it safe for
+        bsonification in a single pass.  Updates doc with the result and
+        returns it.'''
+        mm = doc.__mongometa__
+        hook = getattr(mm, 'before_save', None)
         if hook: hook.im_func(doc)
-        doc.make_safe()
-        if doc.__mongometa__.schema is not None:
-            data = doc.__mongometa__.schema.validate(doc)
+        source = doc
+        if isinstance(doc, Record):
+            source = doc.to_dict()
+        if mm.schema is not None:
+            data = mm.schema.validate_safe(source)
         else:
-            data = dict(doc)
+            data = _safe_bson(source)
         doc.update(data)
+        return data
+
+    def _prepare_partial(self, doc):
+        '''_prepare for a partial document (see Document.make_partial): run
+        the before_save hook, then validate only the fields which were loaded
+        (or have since been set).  Returns the update that saves them, or None
+        if doc is not (or is no longer) partial.'''
+        mm = doc.__mongometa__
+        hook = getattr(mm, 'before_save', None)
+        if hook: hook.im_func(doc)
+        loaded = doc.__dict__.get('_loaded')
+        if loaded is None: return None
+        fields = mm.schema.fields
+        to_set, to_unset, error_dict = {}, {}, {}
+        for name, field in fields.iteritems():
+            if name == '_id': continue
+            if name in loaded:
+                value = dict.get(doc, name, S.Missing)
+            elif name in doc and name not in doc.__dict__['_partial']:
+                value = doc[name]
+            else:
+                continue
+            try:
+                value = field.validate_safe(value)
+            except Invalid, inv:
+                error_dict[name] = inv
+                continue
+            if value is S.Missing:
+                if name in loaded: to_unset[name] = 1
+                dict.pop(doc, name, None)
+            else:
+                to_set[name] = value
+                dict.__setitem__(doc, name, value)
+        if error_dict:
+            msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+            raise Invalid(msg, doc, None, error_dict=error_dict)
+        update = {}
+        if to_set: update['$set'] = to_set
+        if to_unset: update['$unset'] = to_unset
+        return update
+
+    @annotate_doc_failure
+    @invalidates
+    def save(self, doc, *args, **kwargs):
+        '''Save doc, or only the named fields of it.  Saving a partial
+        document (see Document.make_partial) only writes the fields which its
+        query loaded, or which have been set since.'''
+        options = self._write_options(doc, kwargs.pop('write_concern', None))
+        if not args and '_loaded' in getattr(doc, '__dict__', {}):
+            update = self._prepare_partial(doc)
+            if update is not None:
+                if update:
+                    self._impl(doc).update(
+                        dict(_id=doc._id), update, **options)
+                return
+        data = self._prepare(doc)
         if args:
             values = dict((arg, data[arg]) for arg in args)
             result = self._impl(doc).update(
-                dict(_id=doc._id), {'$set':values}, safe=True)
+                dict(_id=doc._id), {'$set':values}, **options)
+        elif self._save_changes(doc, data, options):
+            result = None
         else:
-            result = self._impl(doc).save(data, safe=True)
+            result = self._impl(doc).save(data, **options)
         if result and '_id' not in doc:
             doc._id = result
+        if args:
+            _patch_snapshot(doc, args)
+        elif doc.__mongometa__.track_changes:
+            _set_snapshot(doc, BSON.from_dict(data))
+
+    def _save_changes(self, doc, data, options):
+        '''If doc has a snapshot of its stored state (see track_changes in
+        Document.__mongometa__), send only the fields of data that differ from
+        it.  Returns False if the whole document must be saved instead: when
+        there is no snapshot, or when the update would be at least as large
+        as the document.'''
+        snapshot = getattr(doc, '__dict__', {}).get('_snapshot')
+        if snapshot is None or data.get('_id') is None: return False
+        old = snapshot.to_dict()
+        if old.get('_id') != data['_id']: return False
+        update = bson_update(old, data, deep=True)
+        if not update: return True
+        if len(BSON.from_dict(update)) >= len(snapshot): return False
+        self._impl(doc).update({'_id':data['_id']}, update, **options)
+        return True
 
     @annotate_doc_failure
-    def insert(self, doc):
-        hook = getattr(doc.__mongometa__, 'before_save', None)
-        if hook: hook.im_func(doc)
-        doc.make_safe()
-        if doc.__mongometa__.schema is not None:
-            data = doc.__mongometa__.schema.validate(doc)
-        else:
-            data = dict(doc)
-        doc.update(data)
-        bson = self._impl(doc).insert(data, safe=True)
+    @invalidates
+    def insert(self, doc, write_concern=None):
+        data = self._prepare(doc)
+        bson = self._impl(doc).insert(
+            data, **self._write_options(doc, write_concern))
         if bson and '_id' not in doc:
             doc._id = bson
 
-    @annotate_doc_failure
-    def upsert(self, doc, spec_fields):
-        hook = getattr(doc.__mongometa__, 'before_save', None)
-        if hook: hook.im_func(doc)
-        doc.make_safe()
-        if doc.__mongometa__.schema is not None:
-            data = doc.__mongometa__.schema.validate(doc)
+    @invalidates
+    def insert_many(self, cls, docs, batch_size=1000, write_concern=None):
+        '''Insert docs (documents, or dicts to be made into documents of cls)
+        into cls's collection, batch_size documents per round trip.  Each
+        document is run through its before_save hook and validated, and
+        is given an _id if it does not have one.  Returns a list of (doc,
+        error) pairs for the documents that could not be inserted (database
+        errors are only reported if the write concern waits for them).'''
+        options = self._write_options(cls, write_concern)
+        ready, failures = self._prepare_many(cls, docs)
+        for doc, data in ready:
+            if data.get('_id') is None:
+                # Assigned here rather than by the driver so that the
+                # documents of a failed batch can be told apart
+                data['_id'] = doc['_id'] = ObjectId()
+        impl = self._impl(cls)
+        for i in xrange(0, len(ready), batch_size):
+            batch = ready[i:i+batch_size]
+            try:
+                impl.insert([ data for doc, data in batch ], **options)
+            except pymongo.errors.OperationFailure:
+                failures += self._insert_each(impl, batch, options)
+        return failures
+
+    def _prepare_many(self, cls, docs):
+        '''_prepare for many documents of cls at once: run their before_save
+        hooks, then validate them together (see Object.validate_each).
+        Returns the list of (doc, data) pairs for the valid documents and
+        the list of (doc, error) pairs for the others.'''
+        hook = getattr(cls.__mongometa__, 'before_save', None)
+        failures = []
+        prepared = []
+        for doc in docs:
+            if getattr(doc, '__mongometa__', None) is None:
+                doc = cls(doc)
+            # An error in one document's hook or conversion only fails it
+            try:
+                if hook: hook.im_func(doc)
+                source = doc
+                if isinstance(doc, Record):
+                    source = doc.to_dict()
+                prepared.append((doc, _safe_bson(source)))
+            except Exception, e:
+                failures.append((doc, e))
+        schema = cls.__mongometa__.schema
+        if schema is None:
+            error_list = [ None ] * len(prepared)
         else:
-            data = dict(doc)
-        doc.update(data)
+            results, error_list = schema.validate_each(
+                [ data for doc, data in prepared ])
+            prepared = [ (doc, data) for (doc, _), data
+                         in zip(prepared, results) ]
+        ready = []
+        for (doc, data), error in zip(prepared, error_list):
+            if error is None:
+                doc.update(data)
+                ready.append((doc, data))
+            else:
+                failures.append((doc, error))
+        return ready, failures
+
+    def _insert_each(self, impl, batch, options):
+        '''Insert a batch that failed as a whole one document at a time,
+        returning the (doc, error) pairs that fail again.  A batch insert
+        stops at the first error, so documents already inserted (found
+        unchanged under their _id) are not failures.'''
+        failures = []
+        for doc, data in batch:
+            try:
+                impl.insert(data, **options)
+            except pymongo.errors.OperationFailure, e:
+                if impl.find_one({'_id':data['_id']}) != data:
+                    failures.append((doc, e))
+        return failures
+
+    @annotate_doc_failure
+    @invalidates
+    def upsert(self, doc, spec_fields, write_concern=None):
+        data = self._prepare(doc)
         if type(spec_fields) != list:
             spec_fields = [spec_fields]
         self._impl(doc).update(dict((k,doc[k]) for k in spec_fields),
-                               doc,
+                               data,
                                upsert=True,
-                               safe=True)
+                               **self._write_options(doc, write_concern))
+        if doc.__mongometa__.track_changes:
+            _set_snapshot(doc, BSON.from_dict(data))
 
     @annotate_doc_failure
-    def delete(self, doc):
-        self._impl(doc).remove({'_id':doc._id}, safe=True)
+    @invalidates
+    def delete(self, doc, write_concern=None):
+        self._impl(doc).remove(
+            {'_id':doc._id}, **self._write_options(doc, write_concern))
 
     def _set(self, doc, key_parts, value):
         if len(key_parts) == 0:
@@ -157,35 +596,85 @@ class Session(object):
             self._set(doc[key_parts[0]], key_parts[1:], value)
 
     @annotate_doc_failure
-    def set(self, doc, fields_values):
+    @invalidates
+    def set(self, doc, fields_values, write_concern=None):
         """
         sets a key/value pairs, and persists those changes to the datastore
         immediately 
         """
-        fields_values = Object.from_bson(fields_values)
-        fields_values.make_safe()
+        # _safe_bson also converts nested dicts to Objects
+        fields_values = _safe_bson(fields_values)
         for k,v in fields_values.iteritems():
             self._set(doc, k.split('.'), v)
         impl = self._impl(doc)
-        impl.update({'_id':doc._id}, {'$set':fields_values}, safe=True)
+        impl.update({'_id':doc._id}, {'$set':fields_values},
+                    **self._write_options(doc, write_concern))
+        _patch_snapshot(doc, fields_values)
         
     @annotate_doc_failure
+    @invalidates
+    def atomic(self, doc, operator, fields_values, write_concern=None):
+        """
+        Applies operator ('$set', '$inc', '$max', '$min', '$push', '$addToSet'
+        or '$pull') to the fields of doc given by the dotted paths in
+        fields_values, in a single update, and makes the same change to doc
+        locally.  Each operand is validated against the schema of its field
+        (of the array's elements for $push and $addToSet; $pull operands,
+        which may be queries, are only made BSON-safe, and may only use the
+        $gt, $gte, $lt, $lte, $ne, $in and $nin operators, one per
+        condition, which are matched locally as by the server).
+
+        $max and $min are sent as a $set guarded by the stored value, so they
+        take a single field; locally they compare with the value in doc.
+        """
+        if operator not in ('$set', '$inc', '$max', '$min', '$push',
+                            '$addToSet', '$pull'):
+            raise ValueError, 'unsupported operator %r' % operator
+        if operator in ('$max', '$min') and len(fields_values) != 1:
+            raise ValueError, '%s takes a single field' % operator
+        doc_schema = doc.__mongometa__.schema
+        operands = dict(
+            (path, _operand(doc_schema, operator, path, value))
+            for path, value in fields_values.iteritems())
+        spec = {'_id':doc._id}
+        if operator in ('$max', '$min'):
+            (path, value), = operands.items()
+            if value is None:
+                raise ValueError, "%s=%s" % (path, value)
+            if operator == '$max':
+                guard = {'$lt':value}
+            else:
+                guard = {'$gt':value}
+            spec['$or'] = [ {path:guard}, {path:None} ]
+            update = {'$set':operands}
+        else:
+            update = {operator:operands}
+        self._impl(doc).update(
+            spec, update, **self._write_options(doc, write_concern))
+        for path, value in operands.iteritems():
+            _apply(doc, operator, path.split('.'), value)
+        _patch_snapshot(doc, operands)
+
+    @annotate_doc_failure
+    @invalidates
     def increase_field(self, doc, **kwargs):
         """
         usage: increase_field(key=value)
         Sets a field to value, only if value is greater than the current value
-        Does not change it locally
+        Does not change it locally (see atomic('$max', ...), which does, in a
+        single round trip)
         """
         key = kwargs.keys()[0]
         value = kwargs[key]
         if value is None:
             raise ValueError, "%s=%s" % (key, value)
+        options = self._write_options(doc)
         
         if key not in doc:
             self._impl(doc).update(
                 {'_id': doc._id, key: None},
                 {'$set': {key: value}},
-                safe = True,
+                **options
             )
         self._impl(doc).update(
             {'_id': doc._id, key: {'$lt': value}},
@@ -193,13 +682,16 @@ class Session(object):
             #{'$where': "this._id == '%s' && (!(%s in this) || this.%s < '%s')"
             #    % (doc._id, key, key, value)},
             {'$set': {key: value}},
-            safe = True,
+            **options
         )
+        # the stored value is unknown: the next save sends doc's
+        _patch_snapshot(doc, [key], drop=True)
     
     def index_information(self, cls):
         return self._impl(cls).index_information()
     
     def drop_indexes(self, cls):
+        self._forget_indexes(cls)
         try:
             return self._impl(cls).drop_indexes()
         except:
@@ -219,3 +711,228 @@ class Session(object):
                 log.info('Dropping index %s', iname)
                 self._impl(cls).drop_index(iname)
 
+
+class BufferedSession(Session):
+    '''A Session that queues save, insert, set, delete and update_partial
+    calls and sends them to the database in groups, per collection, when
+    flush() is called, when max_size writes are queued, or on the first write
+    more than max_age seconds after the oldest queued one.
+
+    Writes to the same _id are coalesced (a save or delete replaces the
+    queued writes to that document, a set is merged into a queued insert, save
+    or set) and are sent in the order they were made.  Consecutive inserts
+    are sent as a single batch insert.  Each write is sent with its own write
+    concern (a batch insert with that of its last acknowledged insert, if
+    any).  If a write fails, its error is raised and the writes queued after
+    it stay queued.  Reads, and the writes that are not buffered, flush the
+    collection they use first.
+
+    Documents are validated when they are written, but their nested values
+    are sent as they are at flush time: modify queued documents through the
+    session only.'''
+
+    def __init__(self, bind=None, write_concern=None, cache=None,
+                 max_size=1000, max_age=1.0, count_cache=None):
+        super(BufferedSession, self).__init__(
+            bind, write_concern, cache, count_cache)
+        self.max_size = max_size
+        self.max_age = max_age
+        # collection name => list of [kind, _id, payload, options] writes
+        self._pending = {}
+        # collection name => { _id: latest queued write to that _id }
+        self._latest = {}
+        self._size = 0
+        self._since = None
+
+    def flush(self, cls=None):
+        '''Send the queued writes to the collection of cls (a class or
+        document), or to all collections'''
+        if cls is None:
+            names = self._pending.keys()
+        else:
+            names = [ cls.__mongometa__.name ]
+        for name in names:
+            writes = self._pending.pop(name, None)
+            self._latest.pop(name, None)
+            if not writes: continue
+            self._size -= len(writes)
+            self._send(name, [ w for w in writes if w[0] is not None ])
+        if not self._pending:
+            self._since = None
+
+    def _send(self, name, writes):
+        try:
+            impl = self.db[name]
+        except TypeError:
+            self._requeue(name, writes)
+            raise exc.MongoGone, 'MongoDB is not connected'
+        # [kind, args, options, writes] groups
+        groups = []
+        for write in writes:
+            kind, _id, payload, options = write
+            if kind == 'insert' and groups and groups[-1][0] == 'insert':
+                groups[-1][1].append(payload)
+                groups[-1][3].append(write)
+                if options.get('safe') or not groups[-1][2].get('safe'):
+                    groups[-1][2] = options
+            elif kind == 'insert':
+                groups.append([ kind, [ payload ], options, [ write ] ])
+            else:
+                groups.append([ kind, (_id, payload), options, [ write ] ])
+        try:
+            for i, (kind, args, options, group_writes) in enumerate(groups):
+                try:
+                    self._send_group(impl, kind, args, options)
+                except:
+                    # The failed write is dropped; those after it stay queued
+                    self._requeue(name, [ w for g in groups[i+1:]
+                                          for w in g[3] ])
+                    raise
+        finally:
+            cache.invalidate(name)
+
+    def _send_group(self, impl, kind, args, opts):
+        if kind == 'insert':
+            impl.insert(args, **opts)
+        elif kind == 'save':
+            impl.save(args[1], **opts)
+        elif kind == 'set':
+            impl.update({'_id':args[0]}, {'$set':args[1]}, **opts)
+        elif kind == 'remove':
+            impl.remove({'_id':args[0]}, **opts)
+        else:
+            spec, fields, upsert = args[1]
+            impl.update(spec, fields, upsert, **opts)
+
+    def _requeue(self, name, writes):
+        '''Put back writes (which were queued before any write now queued) at
+        the head of the queue of collection name'''
+        if not writes: return
+        pending = self._pending.setdefault(name, [])
+        pending[:0] = writes
+        latest = self._latest[name] = {}
+        for write in pending:
+            if write[1] is None:
+                latest.clear()
+            else:
+                latest[write[1]] = write
+        self._size += len(writes)
+        if self._since is None:
+            self._since = time.time()
+
+    def _queue(self, cls, kind, _id, payload, write_concern):
+        name = cls.__mongometa__.name
+        options = self._write_options(cls, write_concern)
+        latest = self._latest.setdefault(name, {})
+        write = latest.get(_id)
+        if write is not None and _id is not None:
+            if kind in ('save', 'remove'):
+                # Superseded; dropped from the queue at flush time
+                write[0] = None
+            elif kind == 'set' and self._merge(write, payload):
+                write[3] = options
+                return
+        write = [ kind, _id, payload, options ]
+        self._pending.setdefault(name, []).append(write)
+        if _id is None:
+            # A write to any document: nothing queued before it may be
+            # merged with anything queued after it
+            latest.clear()
+        else:
+            latest[_id] = write
+        self._size += 1
+        now = time.time()
+        if self._since is None:
+            self._since = now
+        if self._size >= self.max_size or now - self._since >= self.max_age:
+            self.flush()
+
+    def _merge(self, write, fields):
+        kind, _id, payload, options = write
+        if kind in ('insert', 'save'):
+            try:
+                for k, v in fields.iteritems():
+                    self._set(payload, k.split('.'), v)
+            except (KeyError, TypeError):
+                # Path not present in the document; the merged fields may
+                # have been partly applied, so queue the whole set
+                return False
+            return True
+        if kind == 'set':
+            for k in fields:
+                for j in payload:
+                    if k != j and (k.startswith(j + '.')
+                                   or j.startswith(k + '.')):
+                        return False
+            payload.update(fields)
+            return True
+        return False
+
+    @annotate_doc_failure
+    def save(self, doc, *args, **kwargs):
+        write_concern = kwargs.pop('write_concern', None)
+        if not args and '_loaded' in getattr(doc, '__dict__', {}):
+            update = self._prepare_partial(doc)
+            if update is not None:
+                if update:
+                    self.update_partial(doc.__class__, dict(_id=doc._id),
+                                        update, False, write_concern)
+                return
+        data = self._prepare(doc)
+        if data.get('_id') is None:
+            data['_id'] = doc['_id'] = ObjectId()
+        if args:
+            values = dict((arg, data[arg]) for arg in args)
+            self._queue(doc, 'set', doc._id, values, write_concern)
+            _patch_snapshot(doc, args)
+        else:
+            # saved whole; the snapshot would be out of date once it is sent
+            getattr(doc, '__dict__', {}).pop('_snapshot', None)
+            self._queue(doc, 'save', data['_id'], data, write_concern)
+
+    @annotate_doc_failure
+    def insert(self, doc, write_concern=None):
+        data = self._prepare(doc)
+        if data.get('_id') is None:
+            data['_id'] = doc['_id'] = ObjectId()
+        self._queue(doc, 'insert', data['_id'], data, write_concern)
+
+    @annotate_doc_failure
+    def delete(self, doc, write_concern=None):
+        self._queue(doc, 'remove', doc._id, None, write_concern)
+
+    @annotate_doc_failure
+    def set(self, doc, fields_values, write_concern=None):
+        fields_values = _safe_bson(fields_values)
+        for k,v in fields_values.iteritems():
+            self._set(doc, k.split('.'), v)
+        # Copied so that later sets of nested fields do not change it
+        self._queue(doc, 'set', doc._id, deepcopy(fields_values),
+                    write_concern)
+        _patch_snapshot(doc, fields_values)
+
+    def update_partial(self, cls, spec, fields, upsert, write_concern=None):
+        _id = None
+        if spec.keys() == ['_id'] and not isinstance(spec['_id'], dict):
+            _id = spec['_id']
+        self._queue(cls, 'update', _id, (spec, fields, upsert), write_concern)
+
+    def _flushing(name):
+        def method(self, cls_or_doc, *args, **kwargs):
+            self.flush(cls_or_doc)
+            return getattr(Session, name)(self, cls_or_doc, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(Session, name).__doc__
+        return method
+
+    get = _flushing('get')
+    find = _flushing('find')
+    count = _flushing('count')
+    group = _flushing('group')
+    find_and_modify = _flushing('find_and_modify')
+    remove = _flushing('remove')
+    insert_many = _flushing('insert_many')
+    upsert = _flushing('upsert')
+    increase_field = _flushing('increase_field')
+    atomic = _flushing('atomic')
+    del _flushing
@@ -3,10 +3,11 @@ from decimal import Decimal
 from unittest import TestCase, main
 from collections import defaultdict
 import copy
+import pickle
 
 import mock
 
-from ming.base import Object, Document, Field, Cursor
+from ming.base import Object, ObjectView, Document, Field, Cursor, _safe_bson
 from ming import schema as S
 from ming.session import Session
 from pymongo.bson import ObjectId
@@ -14,6 +15,7 @@ from pymongo.bson import ObjectId
 def mock_datastore():
     ds = mock.Mock()
     ds.db = defaultdict(mock_collection)
+    ds.write_concern = None
     return ds
 
 def mock_collection():
@@ -51,6 +53,50 @@ class TestObject(TestCase):
         obj = Object.from_bson(bson)
         self.assertEqual(obj, dict(a=[1,2,3], b=dict(c=5)))
 
+    def test_view(self):
+        bson = dict(a=1, b=dict(c=dict(d=2)), e=[dict(f=3)])
+        view = ObjectView(bson)
+        self.assertEqual(view.a, 1)
+        self.assertEqual(view.b.c.d, 2)
+        self.assert_(view.b is view.b)
+        self.assertEqual(view.e[0].f, 3)
+        self.assertEqual(view, bson)
+        self.assertRaises(AttributeError, getattr, view, 'x')
+        self.assertEqual(sorted(view.keys()), ['a', 'b', 'e'])
+        self.assertEqual(view.to_object(), bson)
+        self.assertEqual(type(view.to_object().b), Object)
+
+    def test_view_copy_on_write(self):
+        bson = dict(a=1, b=dict(c=dict(d=2)), e=dict(f=3))
+        orig_b, orig_e = bson['b'], bson['e']
+        view = ObjectView(bson)
+        c = view.b.c
+        c.d = 5
+        c.x = 6
+        view.a = 4
+        del view.e.f
+        self.assertEqual(bson, dict(a=1, b=dict(c=dict(d=2)), e=dict(f=3)))
+        self.assert_(bson['b'] is orig_b and bson['e'] is orig_e)
+        self.assertEqual(view, dict(a=4, b=dict(c=dict(d=5, x=6)), e={}))
+        self.assertEqual(view.to_object(), view)
+
+    def test_view_lists(self):
+        bson = dict(a=dict(b=[dict(c=1), [2]]), d=1)
+        view = ObjectView(bson)
+        self.assertEqual(view.a.b[0].c, 1)
+        # reading copies nothing but the list itself
+        self.assert_(view._data is bson and view.a._data is bson['a'])
+        view.a.b[0].c = 3
+        view.a.b[1].append(4)
+        view.a.b.append(5)
+        self.assertEqual(bson, dict(a=dict(b=[dict(c=1), [2]]), d=1))
+        self.assert_(view._data is bson)
+        obj = view.to_object()
+        self.assertEqual(obj, dict(a=dict(b=[dict(c=3), [2, 4], 5]), d=1))
+        self.assertEqual(type(obj.a.b[0]), Object)
+        self.assertRaises(S.Invalid, S.SchemaItem.make(dict(d=int)).validate,
+                          ObjectView(dict(d=1)))
+
     def test_safe(self):
         now = datetime.now()
         oid = ObjectId()
@@ -157,11 +203,11 @@ class TestDocument(TestCase):
 
 
     def test_migrate(self):
-        doc = self.TestDoc.make(dict(a=5))
-        self.MockSession.find = mock.Mock(return_value=[doc])
-        self.TestDoc.m.migrate()
-        self.MockSession.find.assert_called_with(self.TestDoc, {})
-        self.MockSession.save.assert_called_with(doc)
+        with mock.patch('ming.base.MigrationRunner') as Runner:
+            self.TestDoc.m.migrate(batch_size=10)
+            Runner.assert_called_with(self.TestDoc, session=self.MockSession,
+                                      batch_size=10)
+            self.assert_(Runner.return_value.run.called)
 
 class TestIndexes(TestCase):
     
@@ -201,6 +247,114 @@ class TestIndexes(TestCase):
             args
         )
 
+    @mock.patch('ming.session.Session.ensure_index')
+    def test_ensure_indexes_once(self, ensure_index):
+        self.MyDoc.m
+        self.assertEqual(ensure_index.call_count, 2)
+        doc = self.MyDoc.make(dict(test1='a'))
+        doc.m
+        self.MyDoc.m
+        self.assertEqual(ensure_index.call_count, 2)
+        self.MyDoc.m.sync_indexes()
+        self.assertEqual(ensure_index.call_count, 4)
+        self.MyDoc.__mongometa__.session.bind = mock.Mock()
+        self.MyDoc.m.session
+        self.assertEqual(ensure_index.call_count, 6)
+
+    @mock.patch('ming.session.Session.ensure_index')
+    def test_manager_cache(self, ensure_index):
+        self.assert_(self.MyDoc.m is self.MyDoc.m)
+        doc = self.MyDoc.make(dict(test1='a'))
+        self.assert_(doc.m is doc.m)
+        self.assert_(doc.m is not self.MyDoc.m)
+        self.assert_(doc.m.instance is doc)
+        self.assert_('_manager' not in doc.__getstate__())
+        other = copy.copy(doc)
+        self.assert_(other.m.instance is other)
+
+class PickledDoc(Document):
+    class __mongometa__:
+        name='pickled_doc'
+        slots = True
+    _id=Field(int)
+    a=Field(int)
+    b=Field(dict(c=int))
+
+class TestRecord(TestCase):
+
+    def setUp(self):
+        self.MockSession = mock.Mock()
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.MockSession
+                slots = True
+            _id=Field(int)
+            a=Field(int)
+            b=Field(dict(c=int))
+        self.TestDoc = TestDoc
+
+    def test_make(self):
+        doc = self.TestDoc.make(dict(_id=1, a=2))
+        Record = self.TestDoc.__mongometa__.record_class
+        self.assertEqual(type(doc), Record)
+        self.assert_(not hasattr(doc, '__dict__'))
+        self.assertEqual(doc, dict(_id=1, a=2, b=dict(c=None)))
+        self.assertEqual(doc.b.c, None)
+        self.assertEqual(doc['a'], 2)
+        doc.a = 3
+        self.assertEqual(doc['a'], 3)
+        del doc['a']
+        self.assert_('a' not in doc)
+        self.assertRaises(KeyError, doc.__getitem__, 'a')
+        self.assertRaises(AttributeError, getattr, doc, 'a')
+        self.assertRaises(KeyError, doc.__setitem__, 'x', 1)
+        self.assertEqual(sorted(doc.keys()), ['_id', 'b'])
+        self.assertEqual(len(doc), 2)
+        self.assertEqual(doc.to_dict(), dict(_id=1, b=dict(c=None)))
+        self.assertEqual(type(doc.to_dict()), Object)
+        docs = self.TestDoc.make_many([ dict(_id=1), dict(_id=2) ])
+        self.assertEqual([ type(d) for d in docs ], [ Record, Record ])
+
+    def test_save(self):
+        doc = self.TestDoc.make(dict(_id=1, a=2))
+        doc.m.save()
+        self.MockSession.save.assert_called_with(doc)
+
+    def test_write_back(self):
+        doc = self.TestDoc.make(dict(_id=1, a=2))
+        self.assert_(isinstance(doc, self.TestDoc))
+        self.assert_(isinstance(doc, Document))
+        self.assert_(not isinstance(doc, PickledDoc))
+        self.assert_(not isinstance(Object(), self.TestDoc))
+        self.assertEqual(self.TestDoc.make(doc), doc)
+        self.assertEqual(self.TestDoc.make_many([ doc ]), [ doc ])
+        empty = self.TestDoc.__mongometa__.record_class()
+        self.assertEqual(self.TestDoc.make_many([ empty ]),
+                         [ dict(_id=None, a=None, b=dict(c=None)) ])
+        self.assertEqual(_safe_bson(dict(x=doc)),
+                         dict(x=dict(_id=1, a=2, b=dict(c=None))))
+
+    def test_pickle(self):
+        doc = PickledDoc.make(dict(_id=1, a=2, b=dict(c=3)))
+        del doc['a']
+        for protocol in (0, 2):
+            other = pickle.loads(pickle.dumps(doc, protocol))
+            self.assertEqual(type(other), type(doc))
+            self.assertEqual(other, dict(_id=1, b=dict(c=3)))
+            self.assert_('a' not in other)
+
+    def test_bad_fields(self):
+        class mongometa:
+            slots=True
+        def make(**fields):
+            dct = dict((k, Field(v)) for k, v in fields.iteritems())
+            dct['__mongometa__'] = mongometa
+            return type(Document)('Bad', (Document,), dct)
+        # the record class is built with the schema, when it is first used
+        for bad in (make(keys=int), make(__x=int)):
+            self.assertRaises(ValueError, getattr, bad.__mongometa__, 'schema')
+
 class TestCursor(TestCase):
 
     def setUp(self):
@@ -227,6 +381,7 @@ class TestCursor(TestCase):
         obj = dict(a=None, b=dict(a=None))
         self.assertEqual(len(self.cursor), 3)
         self.assertEqual(self.cursor.count(), 3)
+        self.assertEqual(self.cursor.cursor.count.call_count, 1)
         self.assertEqual(self.cursor.next(), obj)
         self.cursor.limit(100)
         self.cursor.skip(10)
@@ -238,6 +393,20 @@ class TestCursor(TestCase):
         self.cursor.cursor.hint.assert_called_with('foo')
         self.cursor.cursor.sort.assert_called_with('a')
 
+    def test_view(self):
+        self.cursor.cursor.next = iter([ dict(a=1, b=dict(a=2)) ]).next
+        self.cursor.view = True
+        doc = self.cursor.next()
+        self.assertEqual(type(doc), ObjectView)
+        self.assertEqual(doc.b.a, 2)
+
+    def test_raw(self):
+        bson = dict(a='x', c=1)
+        self.cursor.cursor.next = iter([ bson, bson ]).next
+        self.assert_(self.cursor.raw() is self.cursor)
+        self.assert_(self.cursor.next() is bson)
+        self.assertEqual(self.cursor.all(), [ bson ])
+
     def test_first(self):
         obj = dict(a=None, b=dict(a=None))
         self.assertEqual(self.cursor.first(), obj)
@@ -252,6 +421,10 @@ class TestCursor(TestCase):
         self.cursor.all()
         self.assertRaises(ValueError, self.cursor.one)
                                  
+    def test_batches(self):
+        obj = dict(a=None, b=dict(a=None))
+        self.assertEqual(list(self.cursor.batches(2)), [ [obj, obj], [obj] ])
+
     def test_one_ok(self):
         self.cursor.next()
         self.cursor.next()
@@ -285,8 +458,141 @@ class TestPolymorphic(TestCase):
                          dict(type='base', a=None))
         self.assertEqual(self.Base.make(dict(type='derived')),
                          dict(type='derived', a=None, b=None))
+
+    def test_dispatch(self):
+        schema = self.Base.__mongometa__.schema
+        self.assertNotEqual(schema.compiled, schema._interpret)
+        doc = self.Base.make(dict(type='derived', a=1, b=2))
+        self.assertEqual(doc.__class__, self.Derived)
+        self.assertEqual(doc, dict(type='derived', a=1, b=2))
+        self.assertRaises(S.Invalid, self.Base.make, dict(type='derived', b='x'))
+        self.assertRaises(S.Invalid, self.Base.make, dict(type='base', b=2))
+        doc = self.Base.make(dict(a=1))
+        self.assertEqual(doc, dict(type='base', a=1))
+        class Derived2(self.Base):
+            class __mongometa__:
+                polymorphic_identity='derived2'
+            c=Field(int)
+        doc = self.Base.make(dict(type='derived2', c=3))
+        self.assertEqual(doc.__class__, Derived2)
+        self.assertEqual(doc, dict(type='derived2', a=None, c=3))
+
+    def test_make_many(self):
+        docs = self.Base.make_many([
+                dict(type='derived', b=1), dict(a=2), dict(type='base') ])
+        self.assertEqual([ d.__class__ for d in docs ],
+                         [ self.Derived, self.Base, self.Base ])
+        self.assertEqual(docs, [ dict(type='derived', a=None, b=1),
+                                 dict(type='base', a=2),
+                                 dict(type='base', a=None) ])
+        self.assertRaises(S.Invalid, self.Base.make_many, [
+                dict(type='derived', b='foo'), dict(a=2) ])
+        # an unknown discriminator is an error, as it is for make()
+        self.assertRaises(KeyError, self.Base.make, dict(type='other'))
+        self.assertRaises(KeyError, self.Base.make_many, [
+                dict(type='other'), dict(a=2) ])
         
 
+class TestTrusted(TestCase):
+
+    def setUp(self):
+        self.MockSession = mock.Mock()
+        class Base(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.MockSession
+                polymorphic_on='type'
+                polymorphic_identity='base'
+                trusted=True
+            type=Field(str)
+            a=Field(int)
+            b=Field([dict(c=int)])
+        class Derived(Base):
+            class __mongometa__:
+                polymorphic_identity='derived'
+            d=Field(int, if_missing=5)
+        self.Base = Base
+        self.Derived = Derived
+
+    def test_trusted(self):
+        doc = self.Base.make(dict(type='base', a='not an int', b=[{}]))
+        self.assertEqual(doc, dict(type='base', a='not an int', b=[dict(c=None)]))
+        self.assertEqual(doc.b[0].__class__, Object)
+        doc = self.Base.make(dict(type='derived', a=1))
+        self.assertEqual(doc.__class__, self.Derived)
+        self.assertEqual(doc, dict(type='derived', a=1, b=[], d=5))
+        doc = self.Base.make(dict(a=1))
+        self.assertEqual(doc, dict(type='base', a=1, b=[]))
+        self.assertRaises(S.Invalid, self.Base.make, dict(a='foo'),
+                          trusted=False)
+
+    def test_sample(self):
+        self.Base.__mongometa__.validate_sample = 1
+        self.assertRaises(S.Invalid, self.Base.make, dict(a='foo'))
+
+    def test_cursor(self):
+        self.Base.__mongometa__.trusted = False
+        cursor = Cursor(self.Base, iter([dict(a='foo')]), trusted=True)
+        self.assertEqual(cursor.next().a, 'foo')
+
+class TestLazy(TestCase):
+
+    def setUp(self):
+        self.bind = mock_datastore()
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+                lazy = True
+            _id=Field(int)
+            a=Field(int)
+            b=Field(dict(c=int))
+            d=Field(int, if_missing=5)
+        self.TestDoc = TestDoc
+
+    def test_lazy(self):
+        doc = self.TestDoc.make(dict(_id=1, a=1.0, b=dict()))
+        self.assertEqual(doc.__dict__['_lazy'], dict(_id=1, a=1.0, b={}))
+        self.assertEqual(len(doc), 4)
+        self.assert_('a' in doc)
+        self.assertEqual(doc.a, 1)
+        self.assertEqual(doc.a.__class__, int)
+        self.assertEqual(doc['b'], dict(c=None))
+        self.assertEqual(doc.get('b').__class__, Object)
+        self.assertEqual(doc.d, 5)
+        doc.a = 2
+        self.assertEqual(doc, dict(_id=1, a=2, b=dict(c=None), d=5))
+        self.assertEqual(doc.__dict__['_lazy'], {})
+
+    def test_lazy_errors(self):
+        self.assertRaises(S.Invalid, self.TestDoc.make, dict(_id=1, e=5))
+        doc = self.TestDoc.make(dict(_id=1, a='foo'))
+        self.assertEqual(doc._id, 1)
+        self.assertRaises(S.Invalid, getattr, doc, 'a')
+        self.assertRaises(S.Invalid, getattr, doc, 'a')
+        self.assertRaises(S.Invalid, self.session.save, doc)
+        doc.a = 5
+        self.session.save(doc)
+        self.bind.db['test_doc'].save.assert_called_with(
+            dict(_id=1, a=5, b=dict(c=None), d=5), safe=True)
+
+    def test_lazy_copy(self):
+        full = dict(_id=1, a=1, b=dict(c=None), d=5)
+        doc = self.TestDoc.make(dict(_id=1, a=1.0, b=dict()))
+        self.assertEqual(copy.copy(doc), full)
+        self.assertEqual(Object(doc.iteritems()), full)
+        # the C fast path of dict() does not see the pending fields...
+        doc = self.TestDoc.make(dict(_id=1, a=1.0, b=dict()))
+        doc.a
+        self.assertEqual(dict(doc), dict(a=1, d=5))
+        # ...unless they are resolved first
+        self.assert_(doc.resolve() is doc)
+        self.assertEqual(dict(doc), full)
+        other = {}
+        other.update(self.TestDoc.make(dict(_id=1)).resolve())
+        self.assertEqual(other, dict(_id=1, a=None, b=dict(c=None), d=5))
+
 class TestHooks(TestCase):
 
     def setUp(self):
@@ -351,6 +657,59 @@ class TestMigration(TestCase):
     def testMigration(self):
         self.assertEqual(self.TestDoc.make(dict(version=1, a=5)),
                          dict(version=2, a=5, b=42))
+
+class TestVersionedMigration(TestCase):
+
+    def setUp(self):
+        self.MockSession = mock.Mock()
+        self.migrated = []
+
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.MockSession
+                schema_version = 1
+            a=Field(int)
+
+        migrated = self.migrated
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.MockSession
+                schema_version = 2
+                version_of = TestDoc
+                def migrate(old_doc):
+                    migrated.append(old_doc)
+                    return dict(old_doc, b=str(old_doc['a']))
+            a=Field(int)
+            b=Field(str, required=True)
+        self.TestDoc = TestDoc
+
+    def test_stamp(self):
+        doc = self.TestDoc.make(dict(a=5, b='x'))
+        self.assertEqual(doc, dict(_version=2, a=5, b='x'))
+
+    def test_current(self):
+        schema = self.TestDoc.__mongometa__.schema
+        schema.old = mock.Mock()
+        doc = self.TestDoc.make(dict(_version=2, a=5, b='x'))
+        self.assertEqual(doc, dict(_version=2, a=5, b='x'))
+        self.assertEqual(schema.old.validate.call_count, 0)
+        self.assertEqual(self.migrated, [])
+        self.assertRaises(S.Invalid, self.TestDoc.make, dict(_version=2, a=5))
+        self.assertEqual(self.migrated, [])
+
+    def test_old(self):
+        schema = self.TestDoc.__mongometa__.schema
+        schema.new = mock.Mock(wraps=schema.new)
+        doc = self.TestDoc.make(dict(_version=1, a=5))
+        self.assertEqual(doc, dict(_version=2, a=5, b='5'))
+        self.assertEqual(schema.new.validate.call_count, 1)
+        self.assertEqual(len(self.migrated), 1)
+
+    def test_unversioned(self):
+        doc = self.TestDoc.make(dict(a=5))
+        self.assertEqual(doc, dict(_version=2, a=5, b='5'))
         
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+from datetime import datetime
+from decimal import Decimal
+from unittest import TestCase
+
+import mock
+
+from ming.base import Document, Field, _safe_bson, _Deferred, _SchemaBuilder
+from ming.session import Session
+from ming import schema as S
+
+class Counted(S.FancySchemaItem):
+    calls = 0
+
+    def _validate(self, value, **kw):
+        Counted.calls += 1
+        if not isinstance(value, int):
+            raise S.Invalid('%r is not an int' % value, value, None)
+        return value
+
+class TestSinglePass(TestCase):
+
+    def setUp(self):
+        self.schema = S.Object(dict(
+                a=Counted(),
+                b=[Counted()],
+                c=dict(d=Counted(), e=[dict(f=Counted())])))
+        self.valid = dict(a=1, b=[1, 2, 3], c=dict(d=4, e=[dict(f=5)] * 3))
+
+    def _cost(self, doc):
+        Counted.calls = 0
+        try:
+            self.schema.validate(doc)
+        except S.Invalid:
+            pass
+        return Counted.calls
+
+    def test_bad_field_costs_no_more(self):
+        base = self._cost(self.valid)
+        self.assertEqual(base, 8)
+        for bad in (dict(self.valid, a='x'),
+                    dict(self.valid, b=[1, 'x', 3]),
+                    dict(self.valid, c=dict(d=4, e=[dict(f=5), dict(f='x')]))):
+            self.assertRaises(S.Invalid, self.schema.validate, bad)
+            self.assert_(self._cost(bad) <= base)
+
+    def test_errors_collected(self):
+        bad = dict(a='x', b=[1, 'y'], c=dict(d=4, e=[]))
+        try:
+            self.schema.validate(bad)
+        except S.Invalid, inv:
+            self.assertEqual(sorted(inv.error_dict), ['a', 'b'])
+            self.assertEqual(inv.error_dict['b'].error_list[0], None)
+            self.assert_(inv.error_dict['b'].error_list[1])
+        else:
+            self.fail('Invalid not raised')
+
+class TestSavePipeline(TestCase):
+
+    def setUp(self):
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = Session(mock.Mock())
+            _id=Field(int)
+            a=Field(str)
+            b=Field([dict(c=float, d=str, e=[int])])
+            f=Field(dict(g=datetime, h=int))
+        self.TestDoc = TestDoc
+        self.doc = TestDoc.make(dict(
+                _id=1, a='x',
+                b=[ dict(c=1.0, d='y', e=range(10)) for i in range(20) ],
+                f=dict(g=datetime.utcnow(), h=3)))
+
+    def test_single_pass(self):
+        calls = []
+        def safe_bson(obj):
+            calls.append(obj)
+            return _safe_bson(obj)
+        session = self.TestDoc.__mongometa__.session
+        with mock.patch('ming.base._safe_bson', safe_bson):
+            session._prepare(self.doc)
+            self.assertEqual(calls, [])
+            self.doc.b[0].c = Decimal('0.5')
+            self.doc.b[0].e = (1, 2)
+            session._prepare(self.doc)
+            self.assertEqual(calls, [ Decimal('0.5') ])
+        self.assertEqual(self.doc.b[0], dict(c=0.5, d='y', e=[1, 2]))
+
+    def test_fewer_calls(self):
+        # make_safe() then validate() converts every value of the document;
+        # the single pass only converts those which are not already safe
+        schema = self.TestDoc.__mongometa__.schema
+        session = self.TestDoc.__mongometa__.session
+        doc = self.doc
+        calls = []
+        def safe_bson(obj):
+            calls.append(obj)
+            return _safe_bson(obj)
+        with mock.patch('ming.base._safe_bson', safe_bson):
+            doc.make_safe()
+            doc.update(schema.validate(doc))
+            separate = len(calls)
+            del calls[:]
+            session._prepare(doc)
+            single = len(calls)
+        self.assert_(separate > 280, separate)
+        self.assertEqual(single, 0)
+
+class TestStartup(TestCase):
+
+    def _define(self, n):
+        classes = []
+        for i in range(n):
+            class __mongometa__:
+                name = 'startup_%d' % i
+            dct = dict(('f%d' % j, Field(int)) for j in range(6))
+            dct.update(
+                _id=Field(S.ObjectId),
+                sub=Field(dict(a=str, b=[dict(c=int, d=datetime)])),
+                __mongometa__=__mongometa__)
+            classes.append(type(Document)('Startup%d' % i, (Document,), dct))
+        return classes
+
+    def test_schemas_deferred(self):
+        classes = self._define(20)
+        for cls in classes:
+            self.assert_(isinstance(
+                    cls.__mongometa__.__dict__['schema'], _Deferred))
+        self.assertEqual(len(classes[0].__mongometa__.schema.fields), 8)
+        self.assert_(isinstance(
+                classes[0].__mongometa__.__dict__['schema'], S.Object))
+
+    def test_import_cost(self):
+        # defining classes builds none of their schemas; each is built (once)
+        # when it is first used
+        built = []
+        build = _SchemaBuilder._build
+        def counting_build(self):
+            built.append(self.cls)
+            return build(self)
+        with mock.patch_object(_SchemaBuilder, '_build', counting_build):
+            classes = self._define(100)
+            self.assertEqual(built, [])
+            classes[0].make(dict(f0=1))
+            classes[0].make(dict(f0=2))
+            self.assertEqual(built, [ classes[0] ])
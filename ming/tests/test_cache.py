@@ -0,0 +1,185 @@
+from unittest import TestCase
+
+import mock
+
+from ming.base import Document, Field
+from ming.datastore import DataStore
+from ming.session import Session, BufferedSession
+from ming.cache import QueryCache, freeze
+from ming import schema as S
+
+class TestQueryCache(TestCase):
+
+    def test_lru(self):
+        cache = QueryCache(max_size=2)
+        cache.put('a', 0, 1)
+        cache.put('b', 0, 2)
+        self.assertEqual(cache.get('a', 0), 1)
+        cache.put('c', 0, 3)
+        self.assertEqual(cache.get('b', 0), None)
+        self.assertEqual(cache.get('a', 0), 1)
+        self.assertEqual(cache.get('c', 0), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        self.assertEqual(len(cache), 2)
+        # putting a key again makes it the most recently used
+        cache.put('a', 0, 4)
+        cache.put('d', 0, 5)
+        self.assertEqual(cache.get('c', 0), None)
+        self.assertEqual(cache.get('a', 0), 4)
+        self.assertEqual(cache.get('d', 0), 5)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a', 0), None)
+        cache.put('e', 0, 6)
+        self.assertEqual(cache.get('e', 0), 6)
+
+    def test_generation(self):
+        cache = QueryCache()
+        cache.put('a', 0, 1)
+        self.assertEqual(cache.get('a', 1), None)
+        self.assertEqual(cache.get('a', 0), None)
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=10)
+        with mock.patch('time.time') as time:
+            time.return_value = 100.0
+            cache.put('a', 0, 1)
+            time.return_value = 109.0
+            self.assertEqual(cache.get('a', 0), 1)
+            time.return_value = 111.0
+            self.assertEqual(cache.get('a', 0), None)
+
+    def test_freeze(self):
+        self.assertEqual(freeze(dict(a=1, b=[1, dict(c=2)])),
+                         freeze(dict(b=[1, dict(c=2)], a=1)))
+        self.assertNotEqual(freeze(dict(a=1)), freeze(dict(a=2)))
+        hash(freeze(((dict(a=[1]),), dict(sort=[('a', 1)]))))
+
+class TestCachedSession(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_cache')
+        self.bind.conn.drop_database('test_cache')
+        self.cache = QueryCache()
+        self.session = Session(self.bind, cache=self.cache)
+        class Setting(Document):
+            class __mongometa__:
+                name='setting'
+                session = self.session
+                cached = True
+            _id=Field(str)
+            value=Field(int)
+            tags=Field([str])
+        class Log(Document):
+            class __mongometa__:
+                name='log'
+                session = self.session
+            _id=Field(int)
+        self.Setting = Setting
+        self.Log = Log
+        for i, name in enumerate('abc'):
+            Setting(dict(_id=name, value=i, tags=['x'])).m.save()
+        self.coll = self.session.db['setting']
+
+    def find_calls(self, func):
+        with mock.patch_object(
+            self.coll, 'find', mock.Mock(wraps=self.coll.find)) as find:
+            result = func()
+        return result, find.call_count
+
+    def test_find(self):
+        q = lambda: self.Setting.m.find(dict(value={'$gt':0})).all()
+        r0, calls = self.find_calls(q)
+        self.assertEqual(calls, 1)
+        r1, calls = self.find_calls(q)
+        self.assertEqual(calls, 1)
+        self.assertEqual(r0, r1)
+        self.assertEqual(sorted(d._id for d in r1), ['b', 'c'])
+        self.assertEqual(self.cache.hits, 1)
+        # hits are fresh documents
+        r1[0].tags.append('y')
+        self.assertEqual(q()[0].tags, ['x'])
+        # cursor options are part of the key
+        r = self.Setting.m.find().sort('value', -1).limit(1).all()
+        self.assertEqual([ d._id for d in r ], ['c'])
+        r = self.Setting.m.find().sort('value', 1).limit(1).all()
+        self.assertEqual([ d._id for d in r ], ['a'])
+        self.assertEqual(self.Setting.m.find().sort('value', 1).first()._id, 'a')
+
+    def test_get(self):
+        self.assertEqual(self.Setting.m.get(_id='a').value, 0)
+        self.assertEqual(self.Setting.m.get(_id='z'), None)
+        self.assertEqual(self.Setting.m.get(_id='a').value, 0)
+        self.assertEqual(self.Setting.m.get(_id='z'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_invalidate(self):
+        self.assertEqual(len(self.Setting.m.find().all()), 3)
+        other = Session(self.bind)
+        doc = self.Setting.m(other).get(_id='a')
+        doc.m(other).set(dict(value=10))
+        docs = self.Setting.m.find(dict(value=10)).all()
+        self.assertEqual([ d._id for d in docs ], ['a'])
+        self.Setting.m.remove(dict(_id='a'))
+        self.assertEqual(len(self.Setting.m.find().all()), 2)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_not_cached(self):
+        self.Log(dict(_id=1)).m.save()
+        self.Log.m.find().all()
+        self.Log.m.get(_id=1)
+        self.assertEqual(len(self.cache), 0)
+
+class TestCountCache(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_count')
+        self.bind.conn.drop_database('test_count')
+        self.cache = QueryCache(ttl=60)
+        self.session = Session(self.bind, count_cache=self.cache)
+        class Item(Document):
+            class __mongometa__:
+                name='item'
+                session = self.session
+            _id=Field(int)
+            odd=Field(bool)
+        self.Item = Item
+        for i in range(5):
+            Item(dict(_id=i, odd=bool(i % 2))).m.save()
+
+    def test_count(self):
+        self.assertEqual(self.Item.m.count(), 5)
+        self.assertEqual(self.Item.m.count(dict(odd=True)), 2)
+        self.assertEqual(self.Item.m.count(approximate=True), 5)
+        # approximate is ignored with a spec
+        self.assertEqual(self.Item.m.count(dict(odd=False), approximate=True), 3)
+        self.assertEqual(self.cache.misses, 4)
+        self.assertEqual(self.Item.m.count(dict(odd=True)), 2)
+        self.assertEqual(self.Item.m.find(dict(odd=True)).limit(1).count(), 2)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_invalidate(self):
+        self.assertEqual(self.Item.m.count(dict(odd=True)), 2)
+        self.Item(dict(_id=5, odd=True)).m.save()
+        self.assertEqual(self.Item.m.count(dict(odd=True)), 3)
+        self.assertEqual(self.Item.m.count(approximate=True), 6)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_cursor(self):
+        cursor = self.Item.m.find(dict(odd=False))
+        self.assertEqual(len(cursor), 3)
+        self.assertEqual(cursor.count(), 3)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(len(self.Item.m.find(dict(odd=False))), 3)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_buffered(self):
+        session = BufferedSession(self.bind, count_cache=self.cache)
+        self.assert_(session.count_cache is self.cache)
+        self.Item.__mongometa__.session = session
+        self.assertEqual(self.Item.m.count(), 5)
+        self.Item(dict(_id=5, odd=True)).m.save()
+        # counting flushes the queued save, which invalidates the count
+        self.assertEqual(self.Item.m.count(), 6)
+        self.assertEqual(self.Item.m.count(), 6)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
@@ -0,0 +1,100 @@
+from __future__ import with_statement
+from unittest import TestCase
+
+import mock
+import pymongo.errors
+
+from ming.base import Document, Field
+from ming.datastore import DataStore
+from ming.session import Session
+from ming.migration import MigrationRunner, diff
+from ming import schema as S
+
+class TestMigrationRunner(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_migration')
+        self.bind.conn.drop_database('test_migration')
+        self.session = Session(self.bind)
+        class OldDoc(Document):
+            class __mongometa__:
+                name='doc'
+                session = self.session
+            _id=Field(int)
+            a=Field(int)
+            c=Field(int)
+        class NewDoc(Document):
+            class __mongometa__:
+                name='doc'
+                session = self.session
+                version_of = OldDoc
+                def migrate(data):
+                    result = dict(data, b=data['a'] * 2)
+                    del result['c']
+                    return result
+            _id=Field(int)
+            a=Field(int)
+            b=Field(int, required=True)
+        self.NewDoc = NewDoc
+        self.coll = self.session.db['doc']
+        for i in range(10):
+            self.coll.insert(dict(_id=i, a=i, c=0))
+        self.coll.insert(dict(_id=10, a='bad', c=0))
+        self.coll.insert(dict(_id=11, a=11, b=22))
+
+    def test_run(self):
+        stats = MigrationRunner(self.NewDoc, batch_size=3).run()
+        self.assertEqual(stats['scanned'], 12)
+        self.assertEqual(stats['updated'], 10)
+        self.assertEqual(stats['failed'], 1)
+        docs = sorted(self.coll.find(), key=lambda d:d['_id'])
+        self.assertEqual(docs[:10], [ dict(_id=i, a=i, b=2*i) for i in range(10) ])
+        self.assertEqual(docs[10], dict(_id=10, a='bad', c=0))
+
+    def test_manager_session(self):
+        bind = DataStore(master='mim:///test_migration_other')
+        bind.conn.drop_database('test_migration_other')
+        other = Session(bind)
+        other.db['doc'].insert(dict(_id=0, a=1, c=0))
+        stats = self.NewDoc.m(other).migrate(batch_size=3)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(other.db['doc'].find_one(dict(_id=0)), dict(_id=0, a=1, b=2))
+        self.assertEqual(self.coll.find_one(dict(_id=0)), dict(_id=0, a=0, c=0))
+
+    def test_write_errors(self):
+        runner = MigrationRunner(self.NewDoc, batch_size=3)
+        update = self.coll.update
+        def failing_update(spec, doc, **kwargs):
+            self.assertEqual(kwargs, dict(safe=True))
+            if spec['_id'] == 4:
+                raise pymongo.errors.OperationFailure('write failed')
+            return update(spec, doc, **kwargs)
+        with mock.patch_object(self.coll, 'update', failing_update):
+            stats = runner.run()
+        self.assertEqual(stats['updated'], 9)
+        self.assertEqual(stats['failed'], 2)
+        self.assertEqual(self.coll.find_one(dict(_id=4)), dict(_id=4, a=4, c=0))
+
+    def test_pool(self):
+        stats = MigrationRunner(self.NewDoc, batch_size=4, processes=2).run()
+        self.assertEqual(stats['updated'], 10)
+        self.assertEqual(self.coll.find_one(dict(_id=7)), dict(_id=7, a=7, b=14))
+
+    def test_resume(self):
+        runner = MigrationRunner(self.NewDoc, batch_size=3)
+        runner.checkpoints.save(dict(
+                _id='doc', last_id=5, done=False, scanned=6, updated=6,
+                failed=0))
+        stats = runner.run()
+        self.assertEqual(stats['scanned'], 12)
+        self.assertEqual(self.coll.find_one(dict(_id=5)), dict(_id=5, a=5, c=0))
+        self.assertEqual(self.coll.find_one(dict(_id=6)), dict(_id=6, a=6, b=12))
+        cp = runner.checkpoint()
+        self.assertEqual(cp['done'], True)
+        self.assertEqual(cp['last_id'], 11)
+
+    def test_diff(self):
+        self.assertEqual(diff(dict(_id=1, a=1, b=[1], c=2),
+                              dict(_id=1, a=1.0, b=[1], d=3)),
+                         {'$set':dict(a=1.0, d=3), '$unset':dict(c=1)})
+        self.assertEqual(diff(dict(a=dict(b=1)), dict(a=dict(b=1))), {})
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from mock import Mock
+from mock import Mock, patch_object
 
 from ming import schema as S
 from ming import datastore as DS
@@ -298,3 +298,97 @@ class TestPolymorphic(TestCase):
         assert r[0].__class__ is self.Base
         assert r[1].__class__ is self.Derived
 
+
+class TestLazyCompile(TestCase):
+
+    def setUp(self):
+        self.bind = DS.DataStore(master='mim:///')
+        self.doc_session = Session(self.bind)
+        self.orm_session = ORMSession(self.doc_session)
+        self.doc_session.db.drop_collection('test_lazy_doc')
+        class LazyBase(MappedClass):
+            class __mongometa__:
+                name='test_lazy_doc'
+                session = self.orm_session
+                polymorphic_on='type'
+                polymorphic_identity='base'
+            _id = FieldProperty(S.ObjectId)
+            type=FieldProperty(str, if_missing='base')
+            a=FieldProperty(int)
+        class LazyDerived(LazyBase):
+            class __mongometa__:
+                polymorphic_identity='derived'
+            type=FieldProperty(str, if_missing='derived')
+            b=FieldProperty(int)
+        self.Base = LazyBase
+        self.Derived = LazyDerived
+
+    def test_compiled_on_use(self):
+        self.assert_(not mapper(self.Base)._compiled)
+        self.assert_(not mapper(self.Derived)._compiled)
+        self.Derived(a=2,b=2)
+        self.assert_(mapper(self.Derived)._compiled)
+        self.Base(a=1)
+        self.orm_session.flush()
+        self.orm_session.clear()
+        r = sorted(self.Base.query.find().all())
+        assert r[0].__class__ is self.Base
+        assert r[1].__class__ is self.Derived
+
+    def test_subclasses_compiled_with_base(self):
+        self.Base.query
+        self.assert_(mapper(self.Derived)._compiled)
+
+class TestWriteConcern(TestCase):
+
+    def setUp(self):
+        self.bind = DS.DataStore(master='mim:///')
+        self.doc_session = Session(self.bind)
+        self.orm_session = ORMSession(self.doc_session, write_concern=False)
+        self.doc_session.db.drop_collection('test_wc_doc')
+        class Doc(MappedClass):
+            class __mongometa__:
+                name='test_wc_doc'
+                session = self.orm_session
+            _id = FieldProperty(int)
+            a=FieldProperty(int)
+        self.Doc = Doc
+        self.coll = self.doc_session.db['test_wc_doc']
+
+    def test_flush(self):
+        doc = self.Doc(_id=1, a=1)
+        with patch_object(self.coll, 'insert') as insert:
+            self.orm_session.flush()
+        self.assertEqual(insert.call_args[1], dict(safe=False))
+        doc.a = 2
+        with patch_object(self.coll, 'save') as save:
+            self.orm_session.flush(write_concern=dict(w=2))
+        self.assertEqual(save.call_args[1], dict(safe=True, w=2))
+        self.assertEqual(self.orm_session.write_concern, False)
+
+class TestPartial(TestCase):
+
+    def setUp(self):
+        self.bind = DS.DataStore(master='mim:///')
+        self.doc_session = Session(self.bind)
+        self.orm_session = ORMSession(self.doc_session)
+        self.doc_session.db.drop_collection('test_partial_doc')
+        class Doc(MappedClass):
+            class __mongometa__:
+                name='test_partial_doc'
+                session = self.orm_session
+            _id = FieldProperty(int)
+            a=FieldProperty(int)
+            b=FieldProperty(str, if_missing='dflt')
+        self.Doc = Doc
+        self.coll = self.doc_session.db['test_partial_doc']
+        self.coll.insert(dict(_id=1, a=1, b='real'))
+
+    def test_flush(self):
+        doc = self.Doc.query.find({'_id':1}, ['a']).one()
+        self.assertEqual(doc.a, 1)
+        self.assertRaises(AttributeError, getattr, doc, 'b')
+        doc.a = 5
+        self.orm_session.flush()
+        self.assertEqual(self.coll.find_one(dict(_id=1)),
+                         dict(_id=1, a=5, b='real'))
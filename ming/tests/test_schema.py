@@ -56,6 +56,22 @@ class TestSchemaItem(TestCase):
         self.assertEqual(si.validate(dict(a=10)),
                          dict(a=10, b=5))
 
+    def test_missing_factory(self):
+        si = S.SchemaItem.make(dict(
+                a=S.Int(if_missing=5),
+                b=S.Array(int, if_missing=[1, 2]),
+                c=dict(d=S.ObjectId, e=[int]),
+                f=S.Anything()))
+        r1 = si.validate({})
+        r2 = si.validate({})
+        self.assertEqual(r1, dict(a=5, b=[1, 2], c=dict(d=r1.c.d, e=[])))
+        self.assert_(r1.b is not r2.b)
+        self.assert_(r1.c.e is not r2.c.e)
+        self.assertNotEqual(r1.c.d, r2.c.d)
+        si = S.Int(required=True)
+        self.assertRaises(S.Invalid, si.missing_factory)
+        self.assertRaises(S.Invalid, si.validate, S.Missing)
+
     def test_validation(self):
         si = S.SchemaItem.make({str:int})
         self.assertEqual(si.validate(dict(a=5)), dict(a=5))
@@ -78,6 +94,109 @@ class TestSchemaItem(TestCase):
         self.assertEqual(si.validate(dict(version=4)), dict(version=4))
         self.assertRaises(S.Invalid, si.validate, dict(version=3))
     
+    def test_compiled(self):
+        si = S.SchemaItem.make(dict(
+                a=int, b=str, c=[int], d=dict(e=float),
+                f=S.Int(if_missing=5), g=S.ObjectId))
+        oid = ObjectId()
+        doc = dict(a=1, b='foo', c=[1,2], d=dict(e=1.5), g=oid)
+        self.assertEqual(si.compiled(doc), si._interpret(doc))
+        self.assertEqual(si.validate(doc), dict(
+                a=1, b='foo', c=[1,2], d=dict(e=1.5), f=5, g=oid))
+        self.assertEqual(si.validate(dict(a=1.0, g=str(oid))), dict(
+                a=1, b=None, c=[], d=dict(e=None), f=5, g=oid))
+        self.assertRaises(S.Invalid, si.validate, dict(a='foo'))
+        self.assertRaises(S.Invalid, si.validate, dict(c=['foo']))
+        self.assertRaises(S.Invalid, si.validate, dict(extra=5))
+        self.assertEqual(si.validate(dict(extra=5), allow_extra=True)['extra'], 5)
+        self.assert_('extra' not in si.validate(
+                dict(extra=5), allow_extra=True, strip_extra=True))
+
+    def test_compiled_fallback(self):
+        si = S.SchemaItem.make({str:int})
+        self.assertEqual(si.compiled, si._interpret)
+        si = S.SchemaItem.make(dict(a=int))
+        compiled = si.compiled
+        si.extend(S.SchemaItem.make(dict(b=int)))
+        self.assertNotEqual(si.compiled, compiled)
+        self.assertEqual(si.validate(dict(b=1)), dict(a=None, b=1))
+
+    def test_compiled_anything(self):
+        si = S.SchemaItem.make(dict(a=None, b=[None]))
+        for validate in (si.validate, si.validate_safe,
+                         lambda d: si.validate_many([d])[0]):
+            result = validate(dict(a=dict(x=1), b=[dict(y=2)]))
+            self.assertEqual(result.a.x, 1)
+            self.assertEqual(result.b[0].y, 2)
+
+    def test_compiled_override(self):
+        class Upper(S.String):
+            def validate(self, value, **kw):
+                return value.upper()
+        si = S.SchemaItem.make(dict(a=Upper(), b=[Upper()]))
+        self.assertEqual(si.validate(dict(a='x', b=['y'])), dict(a='X', b=['Y']))
+        self.assertEqual(si.validate_safe(dict(a='x', b=['y'])),
+                         dict(a='X', b=['Y']))
+
+    def test_missing_override(self):
+        class Stamped(S.FancySchemaItem):
+            def validate(self, value, **kw):
+                if value is S.Missing: return 'stamped'
+                return value
+        si = S.SchemaItem.make(dict(a=Stamped(), b=S.Anything(if_missing=5)))
+        for validate in (si.validate, si.validate_safe, si.trusted,
+                         lambda d: si.validate_many([d])[0],
+                         lambda d: si.validate_lazy(d)[0]):
+            self.assertEqual(validate({}), dict(a='stamped'))
+
+    def test_reset_nested(self):
+        inner = S.SchemaItem.make(dict(b=int))
+        si = S.Object(dict(a=inner))
+        arr = S.Array(inner)
+        self.assertEqual(si.validate(dict(a=dict(b=1))), dict(a=dict(b=1)))
+        self.assertEqual(arr.validate([dict(b=1)]), [dict(b=1)])
+        inner.extend(S.SchemaItem.make(dict(c=int)))
+        self.assertEqual(si.validate(dict(a=dict(c=2))),
+                         dict(a=dict(b=None, c=2)))
+        self.assertEqual(arr.validate([dict(c=2)]), [dict(b=None, c=2)])
+
+    def test_scalar_array(self):
+        si = S.SchemaItem.make([int])
+        value = [1, 2L, True, None]
+        result = si.validate(value)
+        self.assertEqual(result, value)
+        self.assert_(result is not value)
+        self.assertEqual(si.validate([1, 2.0]), [1, 2])
+        self.assertEqual(si.validate([1, 2.0])[1].__class__, int)
+        try:
+            si.validate([1, 'a', 2, 'b'])
+        except S.Invalid, inv:
+            self.assertEqual(inv.error_list[0], None)
+            self.assertNotEqual(inv.error_list[1], None)
+            self.assertNotEqual(inv.error_list[3], None)
+        else:
+            assert False, 'validate should have raised Invalid'
+        si = S.SchemaItem.make([str])
+        self.assertEqual(si.validate(['a', u'b']), ['a', u'b'])
+        self.assertRaises(S.Invalid, si.validate, ['a', 1])
+
+    def test_validate_many(self):
+        si = S.SchemaItem.make(dict(a=int, b=dict(c=str)))
+        result = si.validate_many([ dict(a=1), dict(b=dict(c='foo')) ])
+        self.assertEqual(result, [ dict(a=1, b=dict(c=None)),
+                                   dict(a=None, b=dict(c='foo')) ])
+        try:
+            si.validate_many([ dict(a=1), dict(a='x'), dict(d=1) ])
+        except S.Invalid, inv:
+            self.assertEqual(inv.error_list[0], None)
+            self.assertEqual(inv.error_list[1].error_dict.keys(), ['a'])
+            self.assert_('Extra keys' in str(inv.error_list[2]))
+        else:
+            assert False, 'validate_many should have raised Invalid'
+        si = S.SchemaItem.make({str:int})
+        self.assertEqual(si.validate_many([ dict(a=1) ]), [ dict(a=1) ])
+        self.assertRaises(S.Invalid, si.validate_many, [ dict(a='a') ])
+
     def test_missing(self):
         self.assertEqual(repr(S.Missing), '<Missing>')
 
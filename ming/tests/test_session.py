@@ -1,4 +1,5 @@
 from collections import defaultdict
+from decimal import Decimal
 from unittest import TestCase, main
 
 import mock
@@ -6,12 +7,15 @@ import pymongo
 
 from ming.base import Object, Document, Field, Cursor
 from ming import schema as S
-from ming.session import Session
+from ming import exc
+from ming.session import Session, BufferedSession
+from ming.datastore import DataStore
 from ming.utils import ThreadLocalProxy
 
 def mock_datastore():
     ds = mock.Mock()
     ds.db = defaultdict(mock_collection)
+    ds.write_concern = None
     return ds
 
 def mock_collection():
@@ -42,6 +46,57 @@ class TestSession(TestCase):
         self.TestDoc = TestDoc
         self.TestDocNoSchema = TestDocNoSchema
 
+    def test_save_safe(self):
+        impl = self.bind.db['test_doc']
+        doc = self.TestDoc(dict(a=Decimal('5'), cc=dict(dd=1, ee=2)))
+        self.session.save(doc)
+        self.assertEqual(doc.a, 5)
+        self.assertEqual(type(doc.a), int)
+        impl.save.assert_called_with(doc, safe=True)
+        doc = self.TestDocNoSchema(dict(_id=1, a=Decimal('0.5'), b=dict(c=1)))
+        self.session.save(doc)
+        self.assertEqual(doc, dict(_id=1, a=0.5, b=dict(c=1)))
+        doc = self.TestDocNoSchema(dict(a=(1,2)))
+        self.assertRaises(AssertionError, self.session.save, doc)
+
+    def test_save_record(self):
+        impl = self.bind.db['test_doc']
+        class TestRecordDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+                slots = True
+            _id=Field(int)
+            a=Field(int, if_missing=3)
+        doc = TestRecordDoc.make(dict(_id=1))
+        del doc.a
+        doc.m.save()
+        self.assertEqual(doc.a, 3)
+        impl.save.assert_called_with(dict(_id=1, a=3), safe=True)
+        self.assertEqual(type(impl.save.call_args[0][0]), TestRecordDoc)
+
+    def test_write_concern(self):
+        impl = self.bind.db['test_doc']
+        self.bind.write_concern = None
+        doc = self.TestDocNoSchema(dict(_id=1, a=2))
+        doc.m.save()
+        impl.save.assert_called_with(doc, safe=True)
+        self.bind.write_concern = dict(w=2)
+        doc.m.delete()
+        impl.remove.assert_called_with(dict(_id=1), safe=True, w=2)
+        doc.m(Session(self.bind, write_concern=False)).set(dict(a=3))
+        impl.update.assert_called_with(
+            dict(_id=1), {'$set':dict(a=3)}, safe=False)
+        self.TestDocNoSchema.__mongometa__.write_concern = dict(w=3, wtimeout=10)
+        doc.m.insert()
+        impl.insert.assert_called_with(doc, safe=True, w=3, wtimeout=10)
+        self.TestDocNoSchema.m.remove(dict(a=3), write_concern=True)
+        impl.remove.assert_called_with(dict(a=3), safe=True)
+        self.TestDocNoSchema.m.update_partial(dict(a=3), {'$set':dict(a=4)},
+                                      write_concern=dict(safe=False, w=2))
+        impl.update.assert_called_with(
+            dict(a=3), {'$set':dict(a=4)}, False, safe=False, w=2)
+
     def testByName(self):
         session0 = Session.by_name('foo')
         session1 = Session.by_name('foo')
@@ -98,6 +153,8 @@ class TestSession(TestCase):
         sess.ensure_index(self.TestDoc, 'a')
         impl.find.assert_called_with(dict(a=5))
         impl.count.assert_called_with()
+        sess.count(self.TestDoc, dict(a=5))
+        impl.find.assert_called_with(dict(a=5))
         impl.ensure_index.assert_called_with([ ('a', pymongo.ASCENDING) ])
         impl.ensure_index.reset_mock()
         
@@ -132,6 +189,283 @@ class TestSession(TestCase):
         sess.drop_indexes(self.TestDoc)
         impl.drop_indexes.assert_called_with()
 
+class TestTrackChanges(TestCase):
+
+    def setUp(self):
+        self.bind = mock_datastore()
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+                track_changes = True
+            _id=Field(int)
+            a=Field(int)
+            b=Field(dict(c=int, d=[int]))
+            e=Field(str, if_missing=S.Missing)
+            big=Field(str)
+        self.TestDoc = TestDoc
+        self.impl = self.bind.db['test_doc']
+        self.raw = dict(_id=1, a=1, b=dict(c=2, d=[1,2]), e=u'x',
+                        big=u'x' * 100)
+
+    def test_diff(self):
+        doc = self.TestDoc.make(self.raw, stored=True)
+        doc.a = 2
+        doc.b.d.append(3)
+        del doc.e
+        doc.m.save()
+        self.assertEqual(self.impl.save.call_count, 0)
+        self.impl.update.assert_called_with(
+            dict(_id=1), {'$set':{'a':2, 'b.d':[1,2,3]}, '$unset':{'e':1}},
+            safe=True)
+        # the snapshot follows the saved state
+        doc.b.c = 3
+        doc.m.save()
+        self.impl.update.assert_called_with(
+            dict(_id=1), {'$set':{'b.c':3}}, safe=True)
+        doc.m.save()
+        self.assertEqual(self.impl.update.call_count, 2)
+
+    def test_full_save(self):
+        # every field but _id is set by the update
+        doc = self.TestDoc.make(dict(_id=1, big=u'x' * 100), stored=True)
+        doc.big = 'y' * 100
+        doc.m.save()
+        self.assertEqual(self.impl.update.call_count, 0)
+        self.impl.save.assert_called_with(doc, safe=True)
+        doc = self.TestDoc(dict(self.raw))
+        doc.m.save()
+        self.assertEqual(self.impl.save.call_count, 2)
+        doc.a = 5
+        doc.m.save()
+        self.impl.update.assert_called_with(
+            dict(_id=1), {'$set':{'a':5}}, safe=True)
+
+    def test_make_many(self):
+        docs = self.TestDoc.make_many([ self.raw, dict(self.raw, _id=2) ],
+                                      stored=True)
+        docs[1].a = 3
+        docs[1].m.save()
+        self.impl.update.assert_called_with(
+            dict(_id=2), {'$set':{'a':3}}, safe=True)
+
+class TestTrackChangesWrites(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_track_changes')
+        self.bind.conn.drop_database('test_track_changes')
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+                track_changes = True
+            _id=Field(int)
+            a=Field(int)
+            b=Field(dict(c=int, d=int))
+        self.TestDoc = TestDoc
+        self.coll = self.session.db['test_doc']
+        TestDoc.make(dict(_id=1, a=1, b=dict(c=1, d=1))).m.save()
+        self.doc = TestDoc.m.get(_id=1)
+
+    def assertStored(self):
+        self.assertEqual(self.coll.find_one(dict(_id=1)), self.doc)
+
+    def test_set(self):
+        doc = self.doc
+        doc.m.set({'a':2})
+        doc.a = 1
+        doc.m.save()
+        self.assertStored()
+        # unsaved changes next to the set path are still sent
+        doc.b.d = 5
+        doc.m.set({'b.c':2})
+        doc.m.save()
+        self.assertStored()
+
+    def test_atomic(self):
+        doc = self.doc
+        doc.m.inc({'a':1, 'b.c':1})
+        doc.b.c = 1
+        doc.m.save()
+        self.assertStored()
+        doc.m.max({'a':5})
+        doc.a = 2
+        doc.m.save()
+        self.assertStored()
+
+    def test_save_fields(self):
+        doc = self.doc
+        doc.a = 3
+        doc.m.save('a')
+        doc.a = 1
+        doc.m.save()
+        self.assertStored()
+
+    def test_increase_field(self):
+        doc = self.doc
+        doc.m.increase_field(a=10)
+        # the stored value is unknown: doc's is sent, as without tracking
+        doc.m.save()
+        self.assertStored()
+
+class TestAtomic(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_atomic')
+        self.bind.conn.drop_database('test_atomic')
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+            _id=Field(int)
+            views=Field(int, if_missing=0)
+            stats=Field(dict(hits=int, high=int))
+            tags=Field([str])
+            items=Field([dict(name=str, n=int)])
+        self.TestDoc = TestDoc
+        self.coll = self.session.db['test_doc']
+        self.doc = TestDoc.make(dict(_id=1, tags=['a'], stats=dict(hits=0),
+                                     items=[dict(name='x', n=1)]))
+        self.doc.m.save()
+
+    def assertStored(self):
+        self.assertEqual(self.coll.find_one(dict(_id=1)), self.doc)
+
+    def test_operators(self):
+        doc = self.doc
+        doc.m.inc({'views':2, 'stats.hits':1})
+        self.assertEqual((doc.views, doc.stats.hits), (2, 1))
+        self.assertStored()
+        doc.m.push({'tags':'b'})
+        doc.m.add_to_set({'tags':'a'})
+        doc.m.add_to_set({'tags':'c'})
+        self.assertEqual(doc.tags, ['a', 'b', 'c'])
+        self.assertStored()
+        doc.m.pull({'tags':'b'})
+        doc.m.push({'items':dict(name='y', n=2)})
+        doc.m.pull({'items':dict(name='x')})
+        self.assertEqual(doc.tags, ['a', 'c'])
+        self.assertEqual(doc.items, [ dict(name='y', n=2) ])
+        self.assertStored()
+        doc.m.atomic('$set', {'stats.high':5})
+        doc.m.max({'stats.high':3})
+        self.assertEqual(doc.stats.high, 5)
+        doc.m.max({'stats.high':7})
+        doc.m.min({'views':1})
+        self.assertEqual((doc.views, doc.stats.high), (1, 7))
+        self.assertStored()
+
+    def test_pull_query(self):
+        doc = self.doc
+        doc.m.push({'items':dict(name='y', n=7)})
+        doc.m.push({'tags':'b'})
+        doc.m.pull({'items':{'n':{'$gt':5}}, 'tags':{'$in':['a', 'c']}})
+        self.assertEqual(doc.items, [ dict(name='x', n=1) ])
+        self.assertEqual(doc.tags, ['b'])
+        self.assertStored()
+        self.assertRaises(ValueError, doc.m.pull,
+                          {'items':{'n':{'$gt':0, '$lt':5}}})
+        self.assertRaises(ValueError, doc.m.pull,
+                          {'items':{'name':{'$regex':'x'}}})
+
+    def test_concurrent_inc(self):
+        self.TestDoc.__mongometa__.track_changes = True
+        doc = self.TestDoc.m.get(_id=1)
+        doc.m.inc({'views':1})
+        self.TestDoc.m.get(_id=1).m.inc({'views':1})
+        doc.m.save()
+        self.assertEqual(self.coll.find_one(dict(_id=1))['views'], 2)
+
+    def test_guard(self):
+        other = self.TestDoc.m.get(_id=1)
+        other.m.max({'stats.high':10})
+        self.doc.m.max({'stats.high':4})
+        self.assertEqual(self.coll.find_one(dict(_id=1))['stats']['high'], 10)
+
+    def test_validate(self):
+        self.assertRaises(S.Invalid, self.doc.m.inc, {'views':'x'})
+        self.assertRaises(S.Invalid, self.doc.m.push, {'tags':1})
+        self.assertRaises(S.Invalid, self.doc.m.push, {'items':dict(n='y')})
+        self.assertRaises(ValueError, self.doc.m.max, {'views':1, 'tags':2})
+        self.assertRaises(ValueError, self.doc.m.atomic, '$rename', {})
+        self.assertStored()
+        self.doc.m.push({'items':dict(name='z')})
+        self.assertEqual(self.doc.items[-1], dict(name='z', n=None))
+
+class TestPartial(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_partial')
+        self.bind.conn.drop_database('test_partial')
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+            _id=Field(int)
+            a=Field(int)
+            b=Field(str, if_missing='default')
+            c=Field(dict(d=int, e=int))
+        self.TestDoc = TestDoc
+        self.coll = self.session.db['test_doc']
+        self.coll.insert(dict(_id=1, a=1, c=dict(d=2, e=3)))
+
+    def test_load(self):
+        doc = self.TestDoc.m.find({}, ['a']).one()
+        self.assertEqual(dict(doc), dict(_id=1, a=1))
+        self.assertRaises(exc.FieldNotLoaded, getattr, doc, 'b')
+        self.assertRaises(exc.FieldNotLoaded, lambda: doc['c'])
+        self.assertRaises(AttributeError, getattr, doc, 'nonesuch')
+        doc = self.TestDoc.m.find({}, dict(c=0)).all()[0]
+        self.assertEqual(dict(doc), dict(_id=1, a=1, b='default'))
+        doc = self.TestDoc.m.find({}, fields=['c.d']).one()
+        self.assertEqual(doc.c, dict(d=2))
+        self.assertRaises(exc.FieldNotLoaded, getattr, doc, 'a')
+        # the whole document
+        doc = self.TestDoc.m.find({}, ['a', 'b', 'c']).one()
+        self.assertEqual(doc.b, 'default')
+        self.assertRaises(S.Invalid, self.TestDoc.make_partial,
+                          dict(_id=1, a='x'), ['_id', 'a'])
+
+    def test_empty_projection(self):
+        for fields in ([], {}):
+            doc = self.TestDoc.m.find({}, fields).one()
+            self.assertEqual(dict(doc), dict(_id=1))
+            self.assertRaises(exc.FieldNotLoaded, getattr, doc, 'a')
+            doc.m.save()
+            self.assertEqual(self.coll.find_one(dict(_id=1)),
+                             dict(_id=1, a=1, c=dict(d=2, e=3)))
+
+    def test_save(self):
+        doc = self.TestDoc.m.find({}, ['a', 'b']).one()
+        doc.a = 5
+        doc.m.save()
+        self.assertEqual(self.coll.find_one(dict(_id=1)),
+                         dict(_id=1, a=5, b='default', c=dict(d=2, e=3)))
+        doc = self.TestDoc.m.find({}, ['c.e']).one()
+        doc.c.e = 4
+        doc.b = 'x'
+        doc.m.save()
+        self.assertEqual(self.coll.find_one(dict(_id=1)),
+                         dict(_id=1, a=5, b='x', c=dict(d=2, e=3)))
+        doc = self.TestDoc.m.find({}, ['a']).one()
+        doc.a = 'x'
+        self.assertRaises(S.Invalid, doc.m.save)
+
+    def test_fetch_unloaded(self):
+        self.TestDoc.__mongometa__.fetch_unloaded = True
+        doc = self.TestDoc.m.find({}, ['a', 'c.d']).one()
+        doc.a = 5
+        self.assertEqual(doc.b, 'default')
+        self.assertEqual(doc, dict(_id=1, a=5, b='default', c=dict(d=2, e=3)))
+        doc.m.save()
+        self.assertEqual(self.coll.find_one(dict(_id=1)), doc)
+        doc = self.TestDoc.m.find({}, dict(_id=0, a=1)).one()
+        self.assertRaises(exc.FieldNotLoaded, getattr, doc, 'b')
+
 class TestThreadLocalSession(TestSession):
 
     def setUp(self):
@@ -160,7 +494,204 @@ class TestThreadLocalSession(TestSession):
     def test_basic_tl_session(self):
         pass
         
+class TestInsertMany(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_insert_many')
+        self.bind.conn.drop_database('test_insert_many')
+        self.session = Session(self.bind)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+                def before_save(data):
+                    data['b'] = data['a'] * 2
+            _id=Field(S.ObjectId, if_missing=None)
+            a=Field(int)
+            b=Field(int)
+        self.TestDoc = TestDoc
+        self.coll = self.session.db['test_doc']
+
+    def test_insert_many(self):
+        docs = [ self.TestDoc(dict(a=i)) for i in range(5) ]
+        docs.append(dict(a=5))
+        failures = self.TestDoc.m.insert_many(docs, batch_size=2)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.coll.find().count(), 6)
+        for i, doc in enumerate(docs[:5]):
+            self.assert_(isinstance(doc._id, pymongo.objectid.ObjectId))
+            self.assertEqual(self.coll.find_one(dict(_id=doc._id)),
+                             dict(_id=doc._id, a=i, b=i*2))
+
+    def test_prepare_errors(self):
+        def before_save(data):
+            if data['a'] == 3: raise ValueError, 'bad a'
+            data['b'] = data['a'] * 2
+        self.TestDoc.__mongometa__.before_save = before_save
+        docs = [ self.TestDoc(dict(a=1)),
+                 self.TestDoc(dict(a=2, c=set([1]))),
+                 self.TestDoc(dict(a=3)),
+                 self.TestDoc(dict(a=4)) ]
+        failures = self.TestDoc.m.insert_many(docs)
+        self.assertEqual([ doc for doc, error in failures ],
+                         [ docs[1], docs[2] ])
+        self.assert_(isinstance(failures[1][1], ValueError))
+        self.assertEqual(sorted(d['a'] for d in self.coll.find()), [1, 4])
+
+    def test_validate_once(self):
+        schema = self.TestDoc.__mongometa__.schema
+        validate_each = mock.Mock(wraps=schema.validate_each)
+        schema.validate_each = validate_each
+        try:
+            self.TestDoc.m.insert_many(
+                [ self.TestDoc(dict(a=i)) for i in range(5) ])
+        finally:
+            del schema.validate_each
+        self.assertEqual(self.coll.find().count(), 5)
+        self.assertEqual(validate_each.call_count, 1)
+
+    def test_failures(self):
+        dup = self.TestDoc(dict(a=1))
+        self.TestDoc.m.insert_many([ dup ])
+        docs = [ self.TestDoc(dict(a=0)),
+                 self.TestDoc(dict(a='bad')),
+                 self.TestDoc(dict(a=3, _id=dup._id)),
+                 self.TestDoc(dict(a=2)) ]
+        failures = self.session.insert_many(self.TestDoc, docs, batch_size=10)
+        self.assertEqual([ doc for doc, error in failures ],
+                         [ docs[1], docs[2] ])
+        self.assert_(isinstance(failures[0][1], S.Invalid))
+        self.assert_(isinstance(failures[1][1], pymongo.errors.OperationFailure))
+        self.assertEqual(self.coll.find().count(), 3)
+        self.assertEqual(self.coll.find_one(dict(_id=docs[3]._id))['a'], 2)
+
         
+class TestBufferedSession(TestCase):
+
+    def setUp(self):
+        self.bind = mock_datastore()
+        self.session = BufferedSession(self.bind, max_size=10, max_age=60)
+        class TestDoc(Document):
+            class __mongometa__:
+                name='test_doc'
+                session = self.session
+            _id=Field(int)
+            a=Field(int, if_missing=0)
+            b=Field(dict(c=int))
+        self.TestDoc = TestDoc
+        self.impl = self.bind.db['test_doc']
+
+    def calls(self):
+        return [ (name, args, kwargs)
+                 for name, args, kwargs in self.impl.method_calls ]
+
+    def test_coalesce(self):
+        doc = self.TestDoc(dict(_id=1))
+        doc.m.save()
+        doc.m.set({'a':2})
+        doc.m.set({'b.c':3})
+        self.assertEqual(self.impl.method_calls, [])
+        self.session.flush()
+        self.assertEqual(self.calls(), [
+                ('save', (dict(_id=1, a=2, b=dict(c=3)),), dict(safe=True)) ])
+        self.impl.reset_mock()
+        doc.m.set({'a':4})
+        doc.m.set({'b':dict(c=5)})
+        doc.m.set({'b.c':6})
+        self.session.flush()
+        self.assertEqual(self.calls(), [
+                ('update', ({'_id':1}, {'$set':{'a':4, 'b':dict(c=5)}}),
+                 dict(safe=True)),
+                ('update', ({'_id':1}, {'$set':{'b.c':6}}), dict(safe=True)) ])
+
+    def test_supersede(self):
+        doc = self.TestDoc(dict(_id=1))
+        doc.m.save()
+        doc.m.set({'a':2})
+        doc.m.delete()
+        self.session.flush()
+        self.assertEqual(self.calls(), [
+                ('remove', ({'_id':1},), dict(safe=True)) ])
+
+    def test_batch_insert(self):
+        docs = [ self.TestDoc(dict(_id=i)) for i in range(3) ]
+        for doc in docs:
+            doc.m.insert()
+        self.TestDoc(dict(a=1)).m.save()
+        self.session.flush(self.TestDoc)
+        self.assertEqual(len(self.calls()), 2)
+        self.assertEqual(self.calls()[0], (
+                'insert', ([ dict(_id=i, a=0, b=dict(c=None)) for i in range(3) ],),
+                dict(safe=True)))
+        self.assert_(
+            isinstance(self.calls()[1][1][0]['_id'], pymongo.objectid.ObjectId))
+
+    def test_ordering(self):
+        doc = self.TestDoc(dict(_id=1))
+        doc.m.set({'a':1})
+        self.TestDoc.m.update_partial({'a':1}, {'$inc':{'a':1}})
+        doc.m.set({'a':3})
+        self.session.flush()
+        self.assertEqual([ c[0] for c in self.calls() ], ['update'] * 3)
+        self.assertEqual([ c[2]['safe'] for c in self.calls() ],
+                         [ True, True, True ])
+
+    def test_write_concern(self):
+        self.TestDoc(dict(_id=1)).m.save(write_concern=dict(w=2))
+        self.TestDoc(dict(_id=2)).m.save(write_concern=False)
+        self.session.flush()
+        self.assertEqual([ c[2] for c in self.calls() ],
+                         [ dict(safe=True, w=2), dict(safe=False) ])
+        self.impl.reset_mock()
+        self.TestDoc(dict(_id=1)).m.save(write_concern=False)
+        self.TestDoc(dict(_id=2)).m.save(write_concern=dict(w=2))
+        self.session.flush()
+        self.assertEqual([ c[2] for c in self.calls() ],
+                         [ dict(safe=False), dict(safe=True, w=2) ])
+        self.impl.reset_mock()
+        # a batch insert is acknowledged if any of its inserts is
+        self.TestDoc(dict(_id=3)).m.insert(write_concern=dict(w=2))
+        self.TestDoc(dict(_id=4)).m.insert(write_concern=False)
+        self.session.flush()
+        self.assertEqual([ c[2] for c in self.calls() ],
+                         [ dict(safe=True, w=2) ])
+
+    def test_failed_flush(self):
+        def fail(*args, **kwargs):
+            raise pymongo.errors.OperationFailure('failed')
+        self.TestDoc(dict(_id=1)).m.save()
+        self.TestDoc.m.update_partial({'a':1}, {'$inc':{'a':1}})
+        self.TestDoc(dict(_id=2)).m.insert()
+        self.TestDoc(dict(_id=3)).m.insert()
+        self.impl.update.side_effect = fail
+        self.assertRaises(pymongo.errors.OperationFailure, self.session.flush)
+        self.assertEqual([ c[0] for c in self.calls() ], ['save', 'update'])
+        # the writes after the failed one are still queued
+        self.assertEqual(self.session._size, 2)
+        self.impl.reset_mock()
+        self.TestDoc(dict(_id=2)).m.set({'a':5})
+        self.session.flush()
+        self.assertEqual(self.calls(), [
+                ('insert', ([ dict(_id=2, a=5, b=dict(c=None)),
+                              dict(_id=3, a=0, b=dict(c=None)) ],),
+                 dict(safe=True)) ])
+        self.assertEqual(self.session._pending, {})
+
+    def test_triggers(self):
+        for i in range(9):
+            self.TestDoc(dict(_id=i)).m.save()
+        self.assertEqual(self.impl.method_calls, [])
+        self.TestDoc(dict(_id=9)).m.save()
+        self.assertEqual(len(self.impl.method_calls), 10)
+        self.impl.reset_mock()
+        self.TestDoc(dict(_id=10)).m.save()
+        self.TestDoc.m.find()
+        self.assertEqual([ c[0] for c in self.calls() ], ['save', 'find'])
+        self.impl.reset_mock()
+        self.session.max_age = 0
+        self.TestDoc(dict(_id=11)).m.save()
+        self.assertEqual([ c[0] for c in self.calls() ], ['save'])
+
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,140 @@
+import time
+from unittest import TestCase
+
+import mock
+
+from ming.base import Field
+from ming.datastore import DataStore
+from ming.session import Session
+from ming.workqueue import Job, WorkQueue
+
+class TestWorkQueue(TestCase):
+
+    def setUp(self):
+        self.bind = DataStore(master='mim:///test_workqueue')
+        self.bind.conn.drop_database('test_workqueue')
+        self.session = Session(self.bind)
+        class Email(Job):
+            class __mongometa__:
+                name='email'
+                session = self.session
+            to=Field(str)
+        self.Email = Email
+        self.coll = self.session.db['email']
+        self.queue = WorkQueue(Email, batch_size=3, lease=10, poll_interval=0.01)
+        for i in range(5):
+            self.queue.put(dict(to='user%d' % i))
+
+    def test_claim(self):
+        other = WorkQueue(self.Email, batch_size=3)
+        batch = self.queue.claim()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(len(set(j.lease_id for j in batch)), 1)
+        self.assertEqual([ j.attempts for j in batch ], [1, 1, 1])
+        rest = other.claim()
+        self.assertEqual(len(rest), 2)
+        self.assertEqual(
+            sorted(j.to for j in batch + rest),
+            [ 'user%d' % i for i in range(5) ])
+        self.assertEqual(other.claim(), [])
+
+    def test_consume(self):
+        with mock.patch_object(
+            self.coll, 'update', mock.Mock(wraps=self.coll.update)) as update:
+            jobs = list(self.queue)
+        self.assertEqual(len(jobs), 5)
+        # one claim per batch
+        self.assertEqual(update.call_count, 2)
+        self.queue.ack(*jobs[:4])
+        self.queue.retry(jobs[4], error='bounced')
+        self.assertEqual(self.coll.find().count(), 1)
+        job = self.queue.get(timeout=0)
+        self.assertEqual((job.to, job.attempts, job.error),
+                         (jobs[4].to, 2, 'bounced'))
+        self.queue.ack(job)
+        self.assertEqual(self.queue.get(timeout=0), None)
+
+    def test_lease(self):
+        now = time.time()
+        with mock.patch('time.time') as clock:
+            clock.return_value = now
+            jobs = self.queue.claim()
+            self.queue.extend(jobs[0], 100)
+            self.queue.ack(*self.queue.claim())
+            self.assertEqual(self.queue.claim(), [])
+            # the other leases expire
+            clock.return_value = now + 11
+            again = self.queue.claim()
+            self.assertEqual(sorted(j._id for j in again),
+                             sorted(j._id for j in jobs[1:]))
+            # a lost lease cannot be acknowledged
+            self.queue.ack(jobs[1])
+            self.assertEqual(self.coll.find().count(), 3)
+            self.assertEqual(jobs[1].state, 'ready')
+            self.queue.extend(jobs[2], 100)
+            self.assertEqual(jobs[2].lease_until, now + 10)
+            self.queue.ack(*again)
+            self.assertEqual(self.coll.find().count(), 1)
+
+    def test_expired_not_handed_out(self):
+        now = time.time()
+        with mock.patch('time.time') as clock:
+            clock.return_value = now
+            self.assert_(self.queue.get(timeout=0) is not None)
+            # the leases of the jobs still held by self.queue expire, and
+            # another consumer claims them
+            clock.return_value = now + 11
+            other = WorkQueue(self.Email, batch_size=5)
+            self.assertEqual(len(other.claim()), 5)
+            self.assertEqual(self.queue.get(timeout=0), None)
+            self.assertEqual(len(self.queue._jobs), 0)
+        # the jobs released were not the queue's any more
+        self.assertEqual(sorted(d['attempts'] for d in self.coll.find()),
+                         [1, 1, 2, 2, 2])
+
+    def test_max_attempts(self):
+        queue = WorkQueue(self.Email, batch_size=5, max_attempts=2,
+                          remove_done=False)
+        for job in queue.claim():
+            queue.retry(job)
+        jobs = queue.claim()
+        queue.ack(jobs[0])
+        for job in jobs[1:]:
+            queue.retry(job, error='failed')
+        self.assertEqual(queue.claim(), [])
+        states = sorted(d['state'] for d in self.coll.find())
+        self.assertEqual(states, ['done'] + ['failed'] * 4)
+
+    def test_max_attempts_expired(self):
+        queue = WorkQueue(self.Email, batch_size=5, lease=10, max_attempts=1,
+                          remove_done=False)
+        now = time.time()
+        with mock.patch('time.time') as clock:
+            clock.return_value = now
+            jobs = queue.claim()
+            queue.ack(jobs[0])
+            # the other leases expire without retry() or ack()
+            clock.return_value = now + 11
+            self.assertEqual(queue.claim(), [])
+        states = sorted(d['state'] for d in self.coll.find())
+        self.assertEqual(states, ['done'] + ['failed'] * 4)
+
+    def test_prefetch(self):
+        queue = WorkQueue(self.Email, batch_size=2, prefetch=True,
+                          poll_interval=0.01)
+        try:
+            # a batch is prefetched, and the next one claimed behind it
+            for i in range(100):
+                if (queue._prefetched.full() and
+                    self.coll.find(dict(lease_id=None)).count() == 1): break
+                time.sleep(0.01)
+            self.assertEqual(self.coll.find(dict(lease_id=None)).count(), 1)
+            jobs = [ queue.get(timeout=1) for i in range(3) ]
+            queue.ack(*jobs)
+        finally:
+            queue.close()
+        self.assertEqual(queue._thread.isAlive(), False)
+        # the unconsumed jobs were released
+        rest = self.queue.claim()
+        self.assertEqual(len(rest), 2)
+        self.assertEqual([ j.attempts for j in rest ], [1, 1])
@@ -1,7 +1,12 @@
 import cgi
+import json
 import urllib
+import decimal
+from datetime import datetime
 from threading import local
 
+import pymongo
+
 def parse_uri(uri, **kwargs):
     scheme, rest = urllib.splittype(uri)
     host, rest = urllib.splithost(rest)
@@ -103,3 +108,82 @@ def wordwrap(s, width=80, indent_first=0, indent_subsequent=0):
 def indent(s, level=2):
     prefix = ' ' * level
     return s.replace('\n', '\n' + prefix)
+
+def bson_update(old, new, deep=False):
+    '''The $set/$unset update that turns document old into new (leaving _id
+    alone).  Changed top-level fields are set whole, unless deep is True, in
+    which case the subdocuments both have are compared field by field so that
+    only the changed paths are sent.'''
+    to_set = {}
+    to_unset = {}
+    _diff(old, new, '', deep, to_set, to_unset)
+    to_set.pop('_id', None)
+    to_unset.pop('_id', None)
+    result = {}
+    if to_set: result['$set'] = to_set
+    if to_unset: result['$unset'] = to_unset
+    return result
+
+def _diff(old, new, prefix, deep, to_set, to_unset):
+    for k, v in new.iteritems():
+        path = prefix + k
+        if k not in old:
+            to_set[path] = v
+            continue
+        ov = old[k]
+        if deep and isinstance(v, dict) and isinstance(ov, dict):
+            _diff(ov, v, path + '.', deep, to_set, to_unset)
+        elif not same_bson(ov, v):
+            to_set[path] = v
+    for k in old:
+        if k not in new:
+            to_unset[prefix + k] = 1
+
+def same_bson(a, b):
+    '''Whether a and b would be stored as the same BSON value'''
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return a == b
+    if isinstance(a, dict):
+        if not isinstance(b, dict) or len(a) != len(b): return False
+        for k, v in a.iteritems():
+            if k not in b or not same_bson(v, b[k]): return False
+        return True
+    if isinstance(a, list):
+        if not isinstance(b, list) or len(a) != len(b): return False
+        for x, y in zip(a, b):
+            if not same_bson(x, y): return False
+        return True
+    return a.__class__ is b.__class__ and a == b
+
+def json_default(obj):
+    '''JSONEncoder default for the non-JSON types found in documents'''
+    if isinstance(obj, pymongo.objectid.ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError, '%r is not JSON serializable' % (obj,)
+
+def iter_json(docs, default=json_default, chunk_size=8192):
+    '''Encode the iterable docs as a JSON array, yielding strings of roughly
+    chunk_size characters as the documents are consumed (suitable as a WSGI
+    app_iter).  Use with Cursor.raw() to send documents to the client without
+    building Objects.'''
+    encoder = json.JSONEncoder(default=default, separators=(',', ':'))
+    buf = [ '[' ]
+    size = 1
+    sep = ''
+    for doc in docs:
+        if sep:
+            buf.append(sep)
+        sep = ','
+        for part in encoder.iterencode(doc):
+            buf.append(part)
+            size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    buf.append(']')
+    yield ''.join(buf)
@@ -0,0 +1,264 @@
+'''Work queues on top of a collection.
+
+The documents of a collection whose Document class derives from Job are jobs.
+A WorkQueue claims up to batch_size jobs at a time: it reads the _ids of
+available jobs, then marks those which are still available with a new lease
+in a single update, so that jobs are never claimed by two consumers at once.
+A claimed job is invisible to other consumers until its lease expires (after
+lease seconds, unless extended), when it becomes available again.  Consumers
+acknowledge jobs they are done with (removing them, or marking them done) and
+put back those they could not process with retry().  With prefetch, the next
+batch is claimed by a background thread while the current one is consumed.
+'''
+from __future__ import with_statement
+import time
+import logging
+import threading
+from Queue import Queue, Empty, Full
+from collections import deque
+
+from pymongo.objectid import ObjectId
+
+from .base import Document, Field
+from . import schema as S
+from . import cache
+
+log = logging.getLogger(__name__)
+
+class Job(Document):
+    '''Base class for the documents of a work queue.  The subclass's
+    __mongometa__ names the collection; its other fields are the job's data.
+
+    state - 'ready' (waiting to be claimed, or being processed if it has a
+            current lease), 'done' (acknowledged) or 'failed' (out of attempts)
+    lease_id - the claim which holds (or last held) the job
+    lease_until - the time (as returned by time.time()) at which the job
+                  becomes available to claim
+    attempts - the number of times the job has been claimed
+    error - the error given to the last retry()
+    '''
+    class __mongometa__:
+        indexes = [ ('state', 'lease_until'), 'lease_id' ]
+    _id=Field(S.ObjectId)
+    state=Field(str, if_missing='ready')
+    lease_id=Field(S.ObjectId, if_missing=None)
+    lease_until=Field(float, if_missing=0.0)
+    attempts=Field(int, if_missing=0)
+    error=Field(str, if_missing=None)
+
+class WorkQueue(object):
+    '''Consume the jobs of Job class cls.
+
+    batch_size - the maximum number of jobs claimed per round trip
+    lease - the number of seconds for which claimed jobs are invisible to
+            other consumers
+    max_attempts - if set, jobs are not claimed more than this many times;
+                   a job that has used them all is marked failed by retry(),
+                   or by claim() once its last lease has expired
+    remove_done - if True, acknowledged jobs are removed rather than marked
+                  done
+    prefetch - if True, a background thread claims the next batch while the
+               current one is being consumed (call close() when done).  Up
+               to three batches may then be held at once: the prefetched one,
+               the one the thread is waiting to hand over, and one claimed by
+               get() when nothing was prefetched yet.  Jobs whose lease
+               expires before they are handed out are released, not returned.
+    poll_interval - number of seconds between claims when the queue is empty
+    '''
+
+    def __init__(self, cls, batch_size=10, lease=60.0, max_attempts=None,
+                 remove_done=True, prefetch=False, poll_interval=1.0):
+        self.cls = cls
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.remove_done = remove_done
+        self.poll_interval = poll_interval
+        self._jobs = deque()
+        self._prefetched = self._thread = None
+        self._stopped = threading.Event()
+        if prefetch:
+            self._prefetched = Queue(batch_size)
+            self._thread = threading.Thread(target=self._prefetch)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    @property
+    def session(self):
+        return self.cls.__mongometa__.session
+
+    @property
+    def collection(self):
+        return self.session._impl(self.cls)
+
+    def put(self, data, delay=0):
+        '''Add a job made from data (a dict of the job's fields), available
+        after delay seconds.  Returns the job.'''
+        job = self.cls.make(dict(data, state='ready',
+                                 lease_until=time.time() + delay))
+        job.m.insert()
+        return job
+
+    def claim(self):
+        '''Claim up to batch_size available jobs, returning the list of them
+        (which may be empty)'''
+        now = time.time()
+        spec = { 'state':'ready', 'lease_until':{'$lte':now} }
+        coll = self.collection
+        if self.max_attempts:
+            # Jobs whose last attempt's lease expired without retry() or ack()
+            # are failed now
+            coll.update(dict(spec, attempts={'$gte':self.max_attempts}),
+                        {'$set':{'state':'failed'}}, multi=True, safe=True)
+            spec['attempts'] = {'$lt':self.max_attempts}
+        ids = [ d['_id'] for d in
+                coll.find(spec, ['_id']).limit(self.batch_size) ]
+        if not ids: return []
+        lease_id = ObjectId()
+        spec['_id'] = {'$in':ids}
+        # Jobs claimed by someone else since they were read no longer match
+        coll.update(spec, {'$set':{'lease_id':lease_id,
+                                   'lease_until':now + self.lease},
+                           '$inc':{'attempts':1}},
+                    multi=True, safe=True)
+        cache.invalidate(self.cls.__mongometa__.name)
+        return [ self.cls.make(d)
+                 for d in coll.find({'lease_id':lease_id}) ]
+
+    def get(self, timeout=None):
+        '''The next claimed job, waiting for up to timeout seconds (or
+        forever if timeout is None) for one to become available.  Returns
+        None on timeout.'''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            job = self._next()
+            if job is not None: return job
+            wait = self.poll_interval
+            if timeout is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0: return None
+            time.sleep(wait)
+
+    def __iter__(self):
+        '''Iterate over the jobs until none is available'''
+        while True:
+            job = self.get(timeout=0)
+            if job is None: break
+            yield job
+
+    def _next(self):
+        while True:
+            job = self._take()
+            if job is None or job.lease_until > time.time():
+                return job
+            # The lease expired while the job waited, so another consumer
+            # may have claimed it: put it back (if it is still ours)
+            self.release(job)
+
+    def _take(self):
+        if not self._jobs and self._prefetched is not None:
+            try:
+                self._jobs.append(self._prefetched.get_nowait())
+            except Empty:
+                pass
+        if not self._jobs:
+            # Nothing prefetched (yet): claim a batch in this thread
+            self._jobs.extend(self.claim())
+        if self._jobs:
+            return self._jobs.popleft()
+        return None
+
+    def ack(self, *jobs):
+        '''Acknowledge jobs (claimed in the same batch, or not) as done.
+        Jobs whose lease has been lost to another consumer are left alone.'''
+        self._update(jobs, {'$set':{'state':'done', 'lease_until':0.0}},
+                     remove=self.remove_done)
+
+    def retry(self, job, delay=0, error=None):
+        '''Put back a job that could not be processed, to be claimed again
+        after delay seconds.  If the job has used up max_attempts, it is
+        marked failed instead.'''
+        state = 'ready'
+        if self.max_attempts and job.attempts >= self.max_attempts:
+            state = 'failed'
+        self._update([ job ], {'$set':{'state':state,
+                                       'lease_until':time.time() + delay,
+                                       'error':error}})
+
+    def extend(self, job, lease=None):
+        '''Extend the lease on a job by lease (default: the queue's lease)
+        seconds from now'''
+        if lease is None: lease = self.lease
+        self._update([ job ], {'$set':{'lease_until':time.time() + lease}})
+
+    def release(self, *jobs):
+        '''Put back jobs that were claimed but not processed, making them
+        available at once and not counting the attempt'''
+        self._update(jobs, {'$set':{'lease_until':0.0},
+                            '$inc':{'attempts':-1}})
+
+    def close(self):
+        '''Stop prefetching and release the claimed jobs that have not been
+        handed out'''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        unused = list(self._jobs)
+        self._jobs.clear()
+        if self._prefetched is not None:
+            while True:
+                try:
+                    unused.append(self._prefetched.get_nowait())
+                except Empty:
+                    break
+        if unused:
+            self.release(*unused)
+
+    def _update(self, jobs, update, remove=False):
+        '''Apply update to (or remove) the jobs whose lease is still held,
+        and mirror it on those jobs'''
+        by_lease = {}
+        for job in jobs:
+            by_lease.setdefault(job.lease_id, []).append(job._id)
+        coll = self.collection
+        held = set()
+        for lease_id, ids in by_lease.iteritems():
+            spec = {'_id':{'$in':ids}, 'lease_id':lease_id}
+            ids = [ d['_id'] for d in coll.find(spec, ['_id']) ]
+            if not ids: continue
+            held.update(ids)
+            spec['_id'] = {'$in':ids}
+            if remove:
+                coll.remove(spec, safe=True)
+            else:
+                coll.update(spec, update, multi=True, safe=True)
+        cache.invalidate(self.cls.__mongometa__.name)
+        for job in jobs:
+            if job._id not in held: continue
+            for op, values in update.iteritems():
+                for k, v in values.iteritems():
+                    if op == '$inc':
+                        job[k] += v
+                    else:
+                        job[k] = v
+
+    def _prefetch(self):
+        while not self._stopped.isSet():
+            try:
+                jobs = self.claim()
+            except Exception:
+                log.exception('Error claiming jobs from %s',
+                              self.cls.__mongometa__.name)
+                jobs = []
+            if not jobs:
+                self._stopped.wait(self.poll_interval)
+                continue
+            while jobs:
+                try:
+                    self._prefetched.put(jobs[0], True, self.poll_interval)
+                    jobs.pop(0)
+                except Full:
+                    if self._stopped.isSet(): break
+            if jobs:
+                self.release(*jobs)